@@ -10,7 +10,7 @@ import scipy.stats
 
 # Models
 from srplasticity.srp import ExpSRP, ExponentialKernel, _convolve_spiketrain_with_kernel
-from srplasticity.inference import fit_srp_model, _nll
+from srplasticity.inference import fit_srp_model, nll_landscape, _nll
 from srplasticity.tools import get_stimvec
 
 # Plotting
@@ -215,19 +215,26 @@ def nll_gridsearch(variable_params):
     x = np.linspace(xTrue * 0.5, xTrue * 1.5, n_gridnodes)
     y = np.linspace(yTrue * 0.5, yTrue * 1.5, n_gridnodes)
     xgrid, ygrid = np.meshgrid(x, y)
-    nll = np.zeros((n_gridnodes, n_gridnodes))
 
-    for xix, xvalue in enumerate(x):
-        for yix, yvalue in enumerate(y):
-
-            # make model with parameters
-            temp = true_parameters.copy()
-            temp[variable_params[0]] = xvalue
-            temp[variable_params[1]] = yvalue
-            model = ExpSRP(**temp)
-
-            means, sigmas, _ = model.run_ISIvec(ISIs)
-            nll[xix, yix] = _nll(efficacies_true, means, sigmas)
+    # vectorized evaluation of all grid nodes, other parameters held at true values
+    true_x = [
+        true_parameters[parameter]
+        for parameter in (
+            "mu_baseline",
+            "mu_amps",
+            "sigma_baseline",
+            "sigma_amps",
+            "sigma_scale",
+        )
+    ]
+    nll = nll_landscape(
+        true_x,
+        {variable_params[0]: x, variable_params[1]: y},
+        {0: ISIs},
+        {0: efficacies_true},
+        mu_tau,
+        sigma_tau,
+    )
 
     return {"xgrid": xgrid, "ygrid": ygrid, "nll": nll}
 
@@ -16,7 +16,9 @@ from srplasticity.srp import (
     _convolve_spiketrain_with_kernel,
     get_stimvec,
 )
-from srplasticity.inference import fit_srp_model_gridsearch
+from srplasticity.inference import fit_srp_model_crossvalidation
+from srplasticity.study import Study
+from srplasticity.tools import FitExecutor
 
 # Plotting
 from spiffyplots import MultiPanel
@@ -498,33 +500,13 @@ def fitting_tm_model(stim, targets):
         tm_param_ranges,
         loss="equal",
         disp=True,  # display output
-        workers=-1,  # split over all available CPU cores
+        workers=executor,  # split over all available CPU cores
         full_output=True,  # save function value at each grid node
     )
 
     return tm_params, tm_sse, grid, sse_grid
 
 
-def fitting_srp_model(stim, targets):
-
-    srp_params, bestfit, starts, fvals, allsols = fit_srp_model_gridsearch(
-        stim,
-        targets,
-        mu_kernel_taus,
-        sigma_kernel_taus,
-        param_ranges=srp_param_ranges,
-        mu_scale=None,  # normalized data
-        sigma_scale=4,
-        bounds="default",
-        method="L-BFGS-B",
-        loss="equal",
-        workers=-1,
-        options={"maxiter": 500, "disp": False, "ftol": 1e-12, "gtol": 1e-9},
-    )
-
-    return srp_params, bestfit, starts, fvals, allsols
-
-
 def load_bootstrap_results():
     """ Loads bootstrap fits from scripts/modelfits/bootstrap directory """
 
@@ -643,6 +625,12 @@ for key in stimulus_dict:
 # example trace
 example_trace = load_pickle(Path(data_dir / "example_trace.pkl"))
 
+# All fits of this script share one pool of worker processes. Fits run at module level,
+# so workers are forked (spawned workers would import and run this script again).
+executor = None
+if fitting_tm or fitting_srp or do_bootstrap:
+    executor = FitExecutor(workers=-1, start_method="fork")
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #
 # FITTING TM MODEL
@@ -686,8 +674,24 @@ if fitting_srp:
     print("\nFitting SRP model to Chamberland et al. (2018) data...")
 
     # Step 1: Fitting to whole dataset
+    # Step 2: Holding out test sets defined in test_keys one at a time, warm-started
+    # from the local optima of the fit to the whole dataset
     print("Fitting SRP model to all protocols...")
-    srp_params, bestfit, _, _, _ = fitting_srp_model(stimulus_dict, target_dict)
+    srp_params, bestfit, srp_testparams, _ = fit_srp_model_crossvalidation(
+        stimulus_dict,
+        target_dict,
+        mu_kernel_taus,
+        sigma_kernel_taus,
+        test_keys=test_keys,
+        param_ranges=srp_param_ranges,
+        mu_scale=None,  # normalized data
+        sigma_scale=4,
+        bounds="default",
+        method="L-BFGS-B",
+        loss="equal",
+        workers=executor,
+        options={"maxiter": 500, "disp": False, "ftol": 1e-12, "gtol": 1e-9},
+    )
 
     print("BEST SOLUTION:")
     print(bestfit)
@@ -695,18 +699,6 @@ if fitting_srp:
     # Save fitted SRP model parameters
     save_pickle(srp_params, modelfit_dir / "chamberland2018_SRPmodel.pkl")
 
-    # Step 2: Holding out test sets defined in test_keys one at a time
-    srp_testparams = {}
-    for testkey in test_keys:
-        print("\nHolding out {} Hz data".format(testkey))
-
-        srp_testparams[testkey], _bestfit, _, _, _ = fitting_srp_model(
-            stimulus_dict, get_train_dict(target_dict, testkey)
-        )
-
-        print("BEST SOLUTION:")
-        print(_bestfit)
-
     save_pickle(
         srp_testparams, modelfit_dir / "chamberland2018_SRPmodel_validation.pkl"
     )
@@ -728,12 +720,17 @@ if do_bootstrap:
     print("\n STARTING BOOTSTRAP...")
     print("Seriously, go make a coffee. This will take a while.")
 
-    # Iterate over 10 / 20 bootstraps
-    for bootstrap_index in range(n_bootstrap):
-        print("\n Bootstrap number {} of {}".format(bootstrap_index + 1, n_bootstrap))
+    # All bootstraps and held-out protocols run as one study on a single process pool.
+    # Completed starts and grid chunks are journaled, an interrupted bootstrap resumes here.
+    # All starts of all fits are recorded in an indexed store.
+    study = Study(
+        "chamberland2018",
+        workers=executor,
+        checkpoint=bootstrap_dir / "checkpoint.journal",
+        fitstore=bootstrap_dir / "fitstore",
+    )
 
-        srp_temp = {}
-        tm_temp = {}
+    for bootstrap_index in range(n_bootstrap):
 
         # 1. Randomly exclude 20% of cells
         bt_target_dict = get_bootstrap_target_dict(
@@ -752,18 +749,48 @@ if do_bootstrap:
             # Use bootstrap target dictionary to make training dictionary
             bt_train_dict = get_train_dict(bt_target_dict, testkey)
 
-            srp_temp[testkey], _, _, _, _ = fitting_srp_model(
-                stimulus_dict, get_train_dict(bt_train_dict, testkey)
+            study.add_srp_fit(
+                stimulus_dict,
+                get_train_dict(bt_train_dict, testkey),
+                mu_kernel_taus,
+                sigma_kernel_taus,
+                bootstrap=bootstrap_index,
+                fold=testkey,
+                param_ranges=srp_param_ranges,
+                mu_scale=None,  # normalized data
+                sigma_scale=4,
+                bounds="default",
+                method="L-BFGS-B",
+                loss="equal",
+                options={"maxiter": 500, "disp": False, "ftol": 1e-12, "gtol": 1e-9},
             )
-
-            tm_temp[testkey], _, _, _ = fitting_tm_model(
-                stimulus_dict, get_train_dict(bt_train_dict, testkey)
+            study.add_tm_fit(
+                stimulus_dict,
+                get_train_dict(bt_train_dict, testkey),
+                tm_param_ranges,
+                bootstrap=bootstrap_index,
+                fold=testkey,
+                loss="equal",
             )
 
-        # Save parameter estimates
+    study_results = study.run()
+
+    # Save parameter estimates
+    for bootstrap_index in range(n_bootstrap):
+        srp_temp = {
+            testkey: study_results[(bootstrap_index, testkey, "SRP")][0]
+            for testkey in test_keys
+        }
+        tm_temp = {
+            testkey: study_results[(bootstrap_index, testkey, "TM")][0]
+            for testkey in test_keys
+        }
         save_pickle(srp_temp, bootstrap_dir / "SRP_{}.pkl".format(bootstrap_index + 1))
         save_pickle(tm_temp, bootstrap_dir / "TM_{}.pkl".format(bootstrap_index + 1))
 
+if executor is not None:
+    executor.close()
+
 # Load bootstrap fits
 bootstrap_fits_tm, bootstrap_fits_srp, bootstrap_traindata = load_bootstrap_results()
 
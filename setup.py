@@ -20,4 +20,7 @@ setup(name='srplasticity',
           'numpy',
           'scipy',
           ],
+      extras_require={
+          'jit': ['numba'],
+          },
       zip_safe=False)
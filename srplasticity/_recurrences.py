@@ -0,0 +1,212 @@
+"""
+_recurrences.py Module
+
+This module contains the sequential per-spike recurrences of the SRP and TM models:
+- states of exponential kernels integrated between spikes (SRP model and its design matrices)
+- TM model integrated between spikes
+- TM model integrated with forward Euler steps
+
+If numba is installed, the recurrences are compiled to machine code. Otherwise, NumPy
+implementations with the same results are used.
+
+Copyright (C) 2021 Julian Rossbroich, Daniel Trotter, John Beninger, Richard Naud
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+try:
+    import numba
+
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _jit(function):
+    """ compiles `function` with numba if it is installed """
+    if HAS_NUMBA:
+        # release the GIL, such that threads can evaluate models concurrently
+        return numba.njit(cache=True, nogil=True)(function)
+    return function
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# EXPONENTIAL KERNELS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def _exp_kernel_states_numpy(isivec, amps, taus, state):
+    """ NumPy implementation of `exp_kernel_states`, vectorized over time constants """
+    states = np.zeros((len(isivec), len(taus)))
+    if len(isivec) > 0:
+        states[0] = state
+
+    for spike in range(1, len(isivec)):
+        state = (state + amps) * np.exp(-isivec[spike] / taus)
+        states[spike] = state
+
+    return states
+
+
+def _exp_kernel_states_loops(isivec, amps, taus, state):
+    """ Loop implementation of `exp_kernel_states` for compilation """
+    states = np.zeros((len(isivec), len(taus)))
+    if len(isivec) > 0:
+        states[0] = state
+
+    for spike in range(1, len(isivec)):
+        for k in range(len(taus)):
+            states[spike, k] = (states[spike - 1, k] + amps[k]) * np.exp(
+                -isivec[spike] / taus[k]
+            )
+
+    return states
+
+
+def exp_kernel_states(isivec, amps, taus, state=None):
+    """
+    States of exponential kernels at each spike, integrated between spikes.
+    At every spike, each kernel is incremented by its amplitude and then decays
+    exponentially over the following ISI.
+
+    :param isivec: ISI vector (in ms)
+    :param amps: amplitude of each exponential kernel
+    :param taus: time constant of each exponential kernel
+    :param state: Optional - states of the kernels at the first spike. Defaults to zero
+                  (kernels have decayed before the first spike).
+    :return: np.array of shape [n_spikes, n_taus]
+    """
+    isivec = np.ascontiguousarray(isivec, dtype=float)
+    amps = np.ascontiguousarray(amps, dtype=float)
+    taus = np.ascontiguousarray(taus, dtype=float)
+    if state is None:
+        state = np.zeros(len(taus))
+    state = np.array(state, dtype=float)
+    return _exp_kernel_states(isivec, amps, taus, state)
+
+
+if HAS_NUMBA:
+    _exp_kernel_states = _jit(_exp_kernel_states_loops)
+else:
+    _exp_kernel_states = _exp_kernel_states_numpy
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# TSODYKS-MARKRAM MODEL
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+@_jit
+def _tm_isivec(isivec, u, r, U, f, tau_u, tau_r, amp, adapted):
+    efficacies = np.empty(len(isivec))
+
+    for spike in range(len(isivec)):
+        if spike > 0:
+            # At the first spike, read out baseline efficacy
+            # At every following spike, integrate over the ISI and then read out efficacy
+            dt = isivec[spike]
+            r_new = 1 - (1 - r * (1 - u)) * np.exp(-dt / tau_r)
+            if adapted:
+                u = U + (u + f * (1 - u) * u - U) * np.exp(-dt / tau_u)
+            else:
+                u = U + (u + f * (1 - u) - U) * np.exp(-dt / tau_u)
+            r = r_new
+        efficacies[spike] = r * u * amp
+
+    return efficacies, u, r
+
+
+def tm_isivec(isivec, u, r, U, f, tau_u, tau_r, amp, adapted=False):
+    """
+    TM model integrated between spikes (see `TsodyksMarkramModel.run_ISIvec`)
+
+    :param isivec: vector of inter-spike intervals
+    :param u: facilitation state at the first spike
+    :param r: depression state at the first spike
+    :param U, f, tau_u, tau_r, amp: parameters of the TM model
+    :param adapted: use the update of the adapted TM model
+    :return: vector of efficacies, final states u and r
+    """
+    isivec = np.ascontiguousarray(isivec, dtype=float)
+    return _tm_isivec(
+        isivec,
+        float(u),
+        float(r),
+        float(U),
+        float(f),
+        float(tau_u),
+        float(tau_r),
+        float(amp),
+        bool(adapted),
+    )
+
+
+@_jit
+def _tm_spiketrain(spiketrain, dt, u, r, U, f, tau_u, tau_r, amp, adapted):
+    nsteps = len(spiketrain)
+    u_trace = np.zeros(nsteps)
+    r_trace = np.zeros(nsteps)
+    efficacies = np.empty(nsteps)
+    nspikes = 0
+
+    for ix in range(nsteps):
+        s = spiketrain[ix]
+        if s == 1:
+            efficacies[nspikes] = r * u * amp
+            nspikes += 1
+
+        r_new = r + ((1 - r) * dt / tau_r - u * r * s)
+        if adapted:
+            u = u + ((U - u) * dt / tau_u + f * (1 - u) * u * s)
+        else:
+            u = u + ((U - u) * dt / tau_u + f * (1 - u) * s)
+        r = r_new
+
+        u_trace[ix] = u
+        r_trace[ix] = r
+
+    return efficacies[:nspikes], u_trace, r_trace, u, r
+
+
+def tm_spiketrain(spiketrain, dt, u, r, U, f, tau_u, tau_r, amp, adapted=False):
+    """
+    TM model integrated with forward Euler steps (see `TsodyksMarkramModel.run_spiketrain`)
+
+    :param spiketrain: binary spiketrain
+    :param dt: timestep
+    :param u: initial facilitation state
+    :param r: initial depression state
+    :param U, f, tau_u, tau_r, amp: parameters of the TM model
+    :param adapted: use the update of the adapted TM model
+    :return: efficacies at each spike, traces of u and r, final states u and r
+    """
+    spiketrain = np.ascontiguousarray(spiketrain, dtype=float)
+    return _tm_spiketrain(
+        spiketrain,
+        float(dt),
+        float(u),
+        float(r),
+        float(U),
+        float(f),
+        float(tau_u),
+        float(tau_r),
+        float(amp),
+        bool(adapted),
+    )
@@ -0,0 +1,589 @@
+"""
+distributed.py Module
+
+This module contains a distributed execution backend for the fitting functions:
+- brokers that hold tasks and results: a shared directory queue and a TCP socket coordinator
+- an executor that submits the tasks of a fit to a broker
+- worker processes that pull tasks from a broker, possibly on other machines
+
+Tasks are tuples of an input (e.g. an initial start) and the hash of the function to evaluate,
+which holds the objective and data. Workers load each function once from the broker.
+
+Start workers on every node with:
+
+    python -m srplasticity.distributed --directory /shared/queue --processes 8
+
+or, for a socket coordinator started by the fitting script:
+
+    python -m srplasticity.distributed --address host:port --authkey key --processes 8
+
+Copyright (C) 2021 Julian Rossbroich, Daniel Trotter, John Beninger, Richard Naud
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict, deque
+from multiprocessing.connection import Listener, Client
+from pathlib import Path
+import argparse
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import traceback
+import uuid
+from srplasticity.store import fingerprint
+from srplasticity.tools import Executor
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# BROKERS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# Brokers implement a client side used by `DistributedExecutor`:
+#   open(), publish(key, function), retract(key), submit(token, index, key, x),
+#   collect(token), cancel(token), shutdown()
+# and a worker side used by `run_worker`:
+#   fetch(), load(key) (None for retracted functions), complete(token, index, output),
+#   is_shutdown()
+# Results of tasks whose map was cancelled are discarded.
+
+
+class DirectoryBroker(object):
+    """
+    Broker on a directory that is shared by all nodes (e.g. a network file system).
+    Functions, tasks and results are pickled files. Workers claim a task by renaming
+    it atomically into the directory of claimed tasks, and renew their claim by touching
+    the file every `heartbeat_interval` seconds while the task runs. Claimed tasks whose
+    file was not touched for `lease` seconds (e.g. because their worker crashed) are
+    moved back to the queue by the executor.
+
+    :param path: shared directory
+    :param lease: seconds after which a claimed task without heartbeat is queued again
+    """
+
+    # seconds between two heartbeats of a worker on its claimed task
+    heartbeat_interval = 1.0
+
+    def __init__(self, path, lease=60.0):
+        self.path = Path(path)
+        self.lease = lease
+        for subdir in ("functions", "tasks", "claimed", "results"):
+            (self.path / subdir).mkdir(parents=True, exist_ok=True)
+        # modification time of each claimed task and when it was last seen to change,
+        # by the clock of this process (clocks of the nodes may differ)
+        self._claims = {}
+        self._heartbeat = None
+
+    def __repr__(self):
+        return "DirectoryBroker({})".format(self.path)
+
+    @staticmethod
+    def _write(path, obj):
+        """ writes atomically, such that readers never see partial files """
+        tmp = path.with_name(".{}.{}".format(path.name, uuid.uuid4().hex))
+        with open(tmp, "wb") as file:
+            pickle.dump(obj, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    # CLIENT SIDE
+
+    def open(self):
+        (self.path / "stop").unlink(missing_ok=True)
+
+    def publish(self, key, function):
+        path = self.path / "functions" / "{}.pkl".format(key)
+        if not path.exists():
+            self._write(path, function)
+
+    def retract(self, key):
+        (self.path / "functions" / "{}.pkl".format(key)).unlink(missing_ok=True)
+
+    def submit(self, token, index, key, x):
+        path = self.path / "tasks" / "{}_{:08d}.pkl".format(token, index)
+        self._write(path, (key, x))
+
+    def collect(self, token):
+        completed = []
+        for path in (self.path / "results").glob("{}_*.pkl".format(token)):
+            completed.append((int(path.stem.split("_")[-1]), self._read(path)))
+            path.unlink()
+        self._requeue_stale(token)
+        return completed
+
+    def _requeue_stale(self, token):
+        """ queues claimed tasks of `token` without heartbeat for `lease` seconds again """
+        now = time.monotonic()
+        claims = {}
+        for path in (self.path / "claimed").glob("{}_*.pkl".format(token)):
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                # completed in the meantime
+                continue
+
+            last = self._claims.get(path.name)
+            if last is None or last[0] != mtime:
+                claims[path.name] = (mtime, now)
+            elif now - last[1] <= self.lease:
+                claims[path.name] = last
+            else:
+                try:
+                    os.rename(path, self.path / "tasks" / path.name)
+                except FileNotFoundError:
+                    pass
+        self._claims = claims
+
+    def cancel(self, token):
+        # claimed tasks are removed before results, such that workers that complete
+        # a task in the meantime discard its result (see `complete`)
+        for subdir in ("tasks", "claimed", "results"):
+            for path in (self.path / subdir).glob("{}_*.pkl".format(token)):
+                path.unlink(missing_ok=True)
+
+    def shutdown(self):
+        (self.path / "stop").touch()
+
+    # WORKER SIDE
+
+    def fetch(self):
+        for name in sorted(os.listdir(self.path / "tasks")):
+            if name.startswith("."):
+                continue
+            claimed = self.path / "claimed" / name
+            try:
+                os.rename(self.path / "tasks" / name, claimed)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            self._start_heartbeat(claimed)
+            key, x = self._read(claimed)
+            token, index = claimed.stem.rsplit("_", 1)
+            return token, int(index), key, x
+        return None
+
+    def _start_heartbeat(self, claimed):
+        """ touches the file of a claimed task until the task is completed """
+        os.utime(claimed)
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_interval):
+                try:
+                    os.utime(claimed)
+                except FileNotFoundError:
+                    return
+
+        threading.Thread(target=beat, daemon=True).start()
+        self._heartbeat = stop
+
+    def load(self, key):
+        try:
+            return self._read(self.path / "functions" / "{}.pkl".format(key))
+        except FileNotFoundError:
+            return None
+
+    def complete(self, token, index, output):
+        if self._heartbeat is not None:
+            self._heartbeat.set()
+            self._heartbeat = None
+        name = "{}_{:08d}.pkl".format(token, index)
+        self._write(self.path / "results" / name, output)
+        try:
+            (self.path / "claimed" / name).unlink()
+        except FileNotFoundError:
+            # unless the task was queued again, its map was cancelled
+            if not (self.path / "tasks" / name).exists():
+                (self.path / "results" / name).unlink(missing_ok=True)
+
+    def is_shutdown(self):
+        return (self.path / "stop").exists()
+
+
+class SocketBroker(object):
+    """
+    Broker in the process of the fitting script, that coordinates workers over TCP.
+    Workers connect with `SocketBroker.connect`. Tasks of workers that disconnect before
+    returning their results are queued again.
+
+    :param address: (host, port) to listen on. Port 0 picks a free port.
+    :param authkey: Optional - key that workers authenticate with (bytes).
+            Defaults to a random key.
+    """
+
+    def __init__(self, address=("localhost", 0), authkey=None):
+        self.authkey = os.urandom(16) if authkey is None else authkey
+        self._address = address
+        self._listener = None
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._tasks = deque()
+        self._results = {}
+        self._shutdown = False
+
+    def __repr__(self):
+        return "SocketBroker({}:{})".format(*self.address)
+
+    @property
+    def address(self):
+        """ address that workers connect to """
+        return self._listener.address if self._listener else self._address
+
+    @staticmethod
+    def connect(address, authkey):
+        """ :return: worker side of the broker at `address` """
+        return _SocketBrokerConnection(address, authkey)
+
+    def _accept(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                if self._listener is not listener:
+                    # listener was closed
+                    return
+                continue
+            threading.Thread(
+                target=self._serve, args=(connection,), daemon=True
+            ).start()
+
+    def _serve(self, connection):
+        claimed = {}
+        try:
+            while True:
+                request = connection.recv()
+
+                if request[0] == "fetch":
+                    with self._lock:
+                        task = self._tasks.popleft() if self._tasks else None
+                        shutdown = self._shutdown
+                    if task is not None:
+                        claimed[task[:2]] = task
+                    connection.send((task, shutdown))
+
+                elif request[0] == "load":
+                    with self._lock:
+                        function = self._functions.get(request[1])
+                    connection.send(function)
+
+                elif request[0] == "complete":
+                    _, token, index, output = request
+                    claimed.pop((token, index), None)
+                    with self._lock:
+                        # results of cancelled maps are discarded
+                        if token in self._results:
+                            self._results[token].append((index, output))
+
+        except (EOFError, OSError):
+            # worker disconnected: queue its unfinished tasks again
+            with self._lock:
+                self._tasks.extendleft(
+                    task for task in claimed.values() if task[0] in self._results
+                )
+        finally:
+            connection.close()
+
+    # CLIENT SIDE
+
+    def open(self):
+        if self._listener is None:
+            self._listener = Listener(self._address, authkey=self.authkey)
+            threading.Thread(
+                target=self._accept, args=(self._listener,), daemon=True
+            ).start()
+        self._shutdown = False
+
+    def publish(self, key, function):
+        with self._lock:
+            if key not in self._functions:
+                self._functions[key] = pickle.dumps(function, pickle.HIGHEST_PROTOCOL)
+
+    def retract(self, key):
+        with self._lock:
+            self._functions.pop(key, None)
+
+    def submit(self, token, index, key, x):
+        with self._lock:
+            self._results.setdefault(token, [])
+            self._tasks.append((token, index, key, x))
+
+    def collect(self, token):
+        with self._lock:
+            completed, self._results[token] = self._results[token], []
+        return completed
+
+    def cancel(self, token):
+        with self._lock:
+            self._results.pop(token, None)
+            self._tasks = deque(task for task in self._tasks if task[0] != token)
+
+    def shutdown(self):
+        self._shutdown = True
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+
+
+class _SocketBrokerConnection(object):
+    """ Worker side of a `SocketBroker` """
+
+    def __init__(self, address, authkey):
+        self.connection = Client(tuple(address), authkey=authkey)
+        self._shutdown = False
+
+    def _request(self, *request):
+        try:
+            self.connection.send(request)
+            return self.connection.recv()
+        except (EOFError, OSError):
+            # coordinator has stopped
+            self._shutdown = True
+            return None
+
+    def fetch(self):
+        reply = self._request("fetch")
+        if reply is None:
+            return None
+        task, self._shutdown = reply
+        return task
+
+    def load(self, key):
+        function = self._request("load", key)
+        return None if function is None else pickle.loads(function)
+
+    def complete(self, token, index, output):
+        try:
+            self.connection.send(("complete", token, index, output))
+        except OSError:
+            self._shutdown = True
+
+    def is_shutdown(self):
+        return self._shutdown
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# EXECUTOR AND WORKERS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+class DistributedExecutor(Executor):
+    """
+    Executor that runs tasks on workers connected to a broker.
+    The function of a map (objective and data) is published once under its hash,
+    tasks carry the hash and their input only. Functions are retracted from the broker
+    once the last map that uses them is finished or cancelled.
+
+    :param broker: `DirectoryBroker` or `SocketBroker`
+    :param poll_interval: seconds between polls for results
+    """
+
+    def __init__(self, broker, poll_interval=0.05):
+        self.broker = broker
+        self.poll_interval = poll_interval
+        self.broker.open()
+        # functions are published under keys unique to this executor, such that
+        # executors that share a broker do not retract each other's functions
+        self._client = uuid.uuid4().hex[:8]
+        # number of running maps of each published function
+        self._published = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "DistributedExecutor({!r})".format(self.broker)
+
+    def _publish(self, func):
+        """ :return: key of the published function """
+        key = "{}-{}".format(fingerprint(func), self._client)
+        with self._lock:
+            if key not in self._published:
+                self.broker.publish(key, func)
+            self._published[key] = self._published.get(key, 0) + 1
+        return key
+
+    def _retract(self, key):
+        with self._lock:
+            self._published[key] -= 1
+            if not self._published[key]:
+                del self._published[key]
+                self.broker.retract(key)
+
+    def _map(self, func, iterable, ordered):
+        key = self._publish(func)
+
+        # tokens sort in order of submission, such that workers pull earlier maps first
+        token = "{:016x}-{}".format(time.time_ns(), uuid.uuid4().hex[:8])
+        ntasks = 0
+        try:
+            for index, x in enumerate(iterable):
+                self.broker.submit(token, index, key, x)
+                ntasks += 1
+
+            pending = set(range(ntasks))
+            buffered = {}
+            next_index = 0
+            while pending:
+                completed = self.broker.collect(token)
+                if not completed:
+                    time.sleep(self.poll_interval)
+                    continue
+
+                for index, (success, output) in completed:
+                    if index not in pending:
+                        # task was queued again and completed twice
+                        continue
+                    if not success:
+                        raise RuntimeError(
+                            "Task {} failed on a worker:\n{}".format(index, output)
+                        )
+                    pending.discard(index)
+                    if ordered:
+                        buffered[index] = output
+                    else:
+                        yield output
+
+                while next_index in buffered:
+                    yield buffered.pop(next_index)
+                    next_index += 1
+        finally:
+            self.broker.cancel(token)
+            self._retract(key)
+
+    def map(self, func, iterable, on_lost=None):
+        # tasks of workers that died are requeued by the broker, so no task is lost
+        return self._map(func, iterable, ordered=True)
+
+    def map_unordered(self, func, iterable, on_lost=None):
+        return self._map(func, iterable, ordered=False)
+
+    def close(self):
+        """ stops the workers """
+        self.broker.shutdown()
+
+
+def run_worker(broker, idle_timeout=None, poll_interval=0.1, cache_size=4):
+    """
+    Pulls tasks from a broker and pushes their results back, until the broker is shut down
+
+    :param broker: worker side of a broker
+    :param idle_timeout: Optional - stop after this many seconds without tasks
+    :param poll_interval: seconds between polls for tasks
+    :param cache_size: number of functions to keep loaded
+    :return: number of completed tasks
+    """
+    functions = OrderedDict()
+    ntasks = 0
+    idle_since = time.time()
+
+    while True:
+        task = broker.fetch()
+        if task is None:
+            if broker.is_shutdown():
+                return ntasks
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                return ntasks
+            time.sleep(poll_interval)
+            continue
+
+        token, index, key, x = task
+        if key not in functions:
+            function = broker.load(key)
+            if function is None:
+                # the map was cancelled and its function retracted: the broker
+                # discards the result
+                broker.complete(token, index, (False, "Function was retracted"))
+                continue
+            while len(functions) >= cache_size:
+                functions.popitem(last=False)
+            functions[key] = function
+        functions.move_to_end(key)
+
+        try:
+            output = (True, functions[key](x))
+        except Exception:
+            output = (False, traceback.format_exc())
+        broker.complete(token, index, output)
+
+        ntasks += 1
+        idle_since = time.time()
+
+
+def _connect(directory=None, address=None, authkey=None):
+    """ :return: worker side of the broker given by a directory or address """
+    if directory is not None:
+        return DirectoryBroker(directory)
+    return SocketBroker.connect(address, authkey)
+
+
+def _worker_process(broker_args, idle_timeout):
+    ntasks = run_worker(_connect(**broker_args), idle_timeout=idle_timeout)
+    print("- Worker {} completed {} tasks".format(os.getpid(), ntasks))
+
+
+def start_workers(
+    processes, directory=None, address=None, authkey=None, idle_timeout=None
+):
+    """
+    Starts worker processes on this machine
+
+    :param processes: number of worker processes
+    :param directory: directory of a `DirectoryBroker`
+    :param address: (host, port) of a `SocketBroker`
+    :param authkey: key of the `SocketBroker`
+    :param idle_timeout: Optional - stop workers after this many seconds without tasks
+    :return: list of started processes
+    """
+    broker_args = {"directory": directory, "address": address, "authkey": authkey}
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_worker_process, args=(broker_args, idle_timeout))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Starts srplasticity fitting workers")
+    broker = parser.add_mutually_exclusive_group(required=True)
+    broker.add_argument("--directory", help="directory of a DirectoryBroker")
+    broker.add_argument("--address", help="host:port of a SocketBroker")
+    parser.add_argument("--authkey", default="", help="key of the SocketBroker (hex)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--idle-timeout", type=float, default=None)
+    args = parser.parse_args()
+
+    address = None
+    if args.address is not None:
+        host, port = args.address.rsplit(":", 1)
+        address = (host, int(port))
+
+    for worker in start_workers(
+        args.processes,
+        directory=args.directory,
+        address=address,
+        authkey=bytes.fromhex(args.authkey),
+        idle_timeout=args.idle_timeout,
+    ):
+        worker.join()
@@ -17,16 +17,40 @@ Copyright (C) 2021 Julian Rossbroich, Daniel Trotter, John Beninger, Richard Nau
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from abc import ABC, abstractmethod
+import copy
 import numpy as np
 from scipy.special import gamma  # gamma function
-from scipy.optimize import minimize
+from scipy.special import gammaln, digamma, polygamma, expit, ndtri
+from scipy.optimize import minimize, OptimizeResult
 from scipy._lib._util import MapWrapper
-from srplasticity.srp import ExpSRP
-from srplasticity.tools import MinimizeWrapper
 
-# Multiprocessing
-import copyreg
-import types
+try:
+    from scipy.stats import qmc
+except ImportError:
+    # scipy < 1.7
+    qmc = None
+
+from srplasticity.srp import (
+    ExpSRPParameters,
+    run_srp_ISIvec,
+    _exp_kernel_design,
+)
+from srplasticity.store import (
+    Checkpoint,
+    FitCache,
+    ResultsTable,
+    fingerprint,
+    fit_key,
+)
+from srplasticity.tools import (
+    Executor,
+    MinimizeWrapper,
+    failed_result,
+    ChunkedTargets,
+    SharedMemoryPool,
+    iter_sweep_chunks,
+)
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #
@@ -112,14 +136,18 @@ def _objective_function(x, *args):
     # Unroll arguments
     target_dict, stimulus_dict, mu_taus, sigma_taus, mu_scale, loss = args
 
-    # Initialize model
-    model = ExpSRP(*_convert_fitting_params(x, mu_taus, sigma_taus, mu_scale))
+    # Initialize model parameters
+    params = ExpSRPParameters(
+        *_convert_fitting_params(x, mu_taus, sigma_taus, mu_scale)
+    )
 
-    # compute estimates
+    # compute estimates (without sampling responses)
     mean_dict = {}
     sigma_dict = {}
     for key, ISIvec in stimulus_dict.items():
-        mean_dict[key], sigma_dict[key], _ = model.run_ISIvec(ISIvec)
+        (mean_dict[key], sigma_dict[key], _), _ = run_srp_ISIvec(
+            params, ISIvec, ntrials=0
+        )
 
     # return loss
     if loss == "default":
@@ -137,6 +165,26 @@ def _objective_function(x, *args):
         )
 
 
+def _make_objective(stimulus_dict, target_dict, mu_taus, sigma_taus, mu_scale, loss):
+    """
+    Returns the objective function, its arguments and whether it returns the gradient.
+    Built-in losses are evaluated from sufficient statistics with analytical gradients
+    (see `SRPObjective`), which also allows for out-of-core targets.
+    Custom loss functions need the full response matrices in memory.
+    """
+    if callable(loss):
+        if any(isinstance(targets, ChunkedTargets) for targets in target_dict.values()):
+            raise ValueError("Custom loss functions require in-memory target arrays")
+
+        args = (target_dict, stimulus_dict, mu_taus, sigma_taus, mu_scale, loss)
+        return _objective_function, args, False
+
+    objective = SRPObjective(
+        stimulus_dict, target_dict, mu_taus, sigma_taus, mu_scale, loss
+    )
+    return objective, (), True
+
+
 def _convert_fitting_params(x, mu_taus, sigma_taus, mu_scale=None):
     """
     Converts a vector of parameters for fitting `x` and independent variables
@@ -167,6 +215,19 @@ def _convert_fitting_params(x, mu_taus, sigma_taus, mu_scale=None):
     )
 
 
+def _parameter_groups(nr_mu_exps, nr_sigma_exps):
+    """
+    Returns the indices of each group of parameters in the vector of fitting parameters
+    """
+    return {
+        "mu_baseline": [0],
+        "mu_amps": list(range(1, 1 + nr_mu_exps)),
+        "sigma_baseline": [1 + nr_mu_exps],
+        "sigma_amps": list(range(2 + nr_mu_exps, 2 + nr_mu_exps + nr_sigma_exps)),
+        "sigma_scale": [2 + nr_mu_exps + nr_sigma_exps],
+    }
+
+
 def _default_parameter_bounds(mu_taus, sigma_taus):
     """ returns default parameter boundaries for the SRP fitting procedure """
     return [
@@ -273,12 +334,18 @@ def _get_grid(ranges, Ns=3):
 
 class RandomDisplacement(object):
     """
-    Random displacement of SRP parameters
-    Calling this updates `x` in-place.
+    Random displacement of SRP parameters, within the parameter bounds.
+    Calling this returns a displaced copy of `x`.
 
     Parameters
     ----------
-    max_stepsize: np.array: maximum stepsize in each dimension
+    bounds: list of (min, max) pairs for each parameter, or False for no bounds
+    max_stepsize: np.array: maximum stepsize in each dimension. Defaults to 2 for the
+        baselines, the time constants for the amplitudes and 1 for the sigma scale.
+    mu_taus: mu time constants (for the default stepsize)
+    sigma_taus: sigma time constants (for the default stepsize)
+    disp: print each new initial guess
+    seed: seed or np.random.Generator of the displacements
     """
 
     def __init__(
@@ -288,16 +355,27 @@ class RandomDisplacement(object):
         mu_taus=None,
         sigma_taus=None,
         disp=True,
+        seed=None,
     ):
 
         self.disp = disp
-        if max_stepsize == "default":
-            self.max_stepsize = np.array(
-                [(2, *np.array(mu_taus), 2, *np.array(sigma_taus), 1)]
-            )
+        if isinstance(max_stepsize, str) and max_stepsize == "default":
+            max_stepsize = [
+                2,
+                *np.atleast_1d(mu_taus),
+                2,
+                *np.atleast_1d(sigma_taus),
+                1,
+            ]
+        self.max_stepsize = np.asarray(max_stepsize, dtype=float)
+
+        if bounds is False or bounds is None:
+            bounds = None
+        self.lower, self.upper = _bounds_to_arrays(bounds, len(self.max_stepsize))
+        self.rng = np.random.default_rng(seed)
 
     def __call__(self, x):
-        newx = x + self._sample()
+        newx = np.clip(x + self._sample(), self.lower, self.upper)
         if self.disp:
             print("New initial guess:")
             print(newx)
@@ -305,7 +383,7 @@ class RandomDisplacement(object):
         return newx
 
     def _sample(self):
-        return np.random.uniform(-self.max_stepsize, self.max_stepsize)
+        return self.rng.uniform(-self.max_stepsize, self.max_stepsize)
 
 
 class Grid(object):
@@ -330,132 +408,2316 @@ class Grid(object):
         return newx
 
 
+class StartDesign(ABC):
+    """
+    Space-filling design of a fixed number of initial starts for the SRP gridsearch, instead
+    of the product grid of parameter ranges whose size grows exponentially with the number
+    of ranges. Pass an instance as `param_ranges` to `fit_srp_model_gridsearch`.
+
+    Points are generated in blocks, in the box spanned by `ranges` intersected with the
+    parameter bounds, and converted into initial starts like grid points (see `_starts_from_grid`).
+
+    :param n: number of starts
+    :param ranges: Optional - 2, 3 or 5 ranges of grid dimensions as (low, high) tuples or
+            slice objects (whose step is ignored). Defaults to the default parameter ranges.
+    :param seed: Optional - seed of the random number generator
+    :param blocksize: number of points generated at once
+    """
+
+    def __init__(self, n, ranges="default", seed=None, blocksize=4096):
+        if ranges == "default":
+            ranges = _default_parameter_ranges()
+
+        self.n = int(n)
+        self.ranges = np.array(
+            [(r.start, r.stop) if isinstance(r, slice) else r for r in ranges],
+            dtype=float,
+        )
+        # the seed is fixed when the design is created, such that its starts can be
+        # recovered from checkpoints and caches
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.blocksize = blocksize
+
+    def __len__(self):
+        return self.n
+
+    @abstractmethod
+    def _unit_blocks(self, rng):
+        """ :return: generator of blocks of points in the unit hypercube """
+        pass
+
+    def blocks(self, lower=None, upper=None):
+        """
+        :param lower: Optional - lower bounds of the grid dimensions
+        :param upper: Optional - upper bounds of the grid dimensions
+        :return: generator of blocks of points of shape [n_points, n_ranges]
+        """
+        low, high = self.ranges.T
+        if lower is not None:
+            low = np.maximum(low, lower)
+        if upper is not None:
+            high = np.minimum(high, upper)
+
+        rng = np.random.default_rng(self.seed)
+        for block in self._unit_blocks(rng):
+            yield low + block * (high - low)
+
+
+class SobolDesign(StartDesign):
+    """
+    Scrambled Sobol' sequence (requires scipy >= 1.7).
+    The sequence is best balanced if the number of starts is a power of 2.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if qmc is None:
+            raise ImportError("SobolDesign requires scipy >= 1.7")
+        super().__init__(*args, **kwargs)
+
+    def _unit_blocks(self, rng):
+        engine = qmc.Sobol(len(self.ranges), scramble=True, seed=rng)
+        for start in range(0, self.n, self.blocksize):
+            yield engine.random(min(self.blocksize, self.n - start))
+
+
+class LatinHypercubeDesign(StartDesign):
+    """
+    Latin hypercube: every grid dimension is divided into `n` intervals, each of which
+    holds exactly one start.
+    """
+
+    def _unit_blocks(self, rng):
+        strata = np.array([rng.permutation(self.n) for _ in self.ranges]).T
+        for start in range(0, self.n, self.blocksize):
+            block = strata[start : start + self.blocksize]
+            yield (block + rng.random(block.shape)) / self.n
+
+
+class StratifiedDesign(StartDesign):
+    """
+    Stratified random design: the box is divided into k^d equal cells (the largest k with
+    k^d <= n), each of which holds one uniformly drawn start. The remaining starts are
+    drawn uniformly from the whole box.
+    """
+
+    def _unit_blocks(self, rng):
+        ndims = len(self.ranges)
+        k = int(np.floor(self.n ** (1 / ndims) + 1e-9))
+        ncells = k ** ndims
+
+        for start in range(0, self.n, self.blocksize):
+            ix = np.arange(start, min(start + self.blocksize, self.n))
+            cells = np.array(np.unravel_index(np.minimum(ix, ncells - 1), (k,) * ndims))
+            uniform = rng.random(cells.T.shape)
+            yield np.where((ix < ncells)[:, None], (cells.T + uniform) / k, uniform)
+
+
+def _grid_bounds(bounds, ndims, mu_taus, sigma_taus, sigma_scale=None):
+    """
+    Bounds of the grid dimensions, such that the initial starts converted from grid points
+    (see `_starts_from_grid`) are within the parameter bounds
+
+    :return: arrays of lower and upper bounds of the grid dimensions
+    """
+    offset = _starts_from_grid(np.zeros((1, ndims)), mu_taus, sigma_taus, sigma_scale)
+    coefs = _starts_from_grid(np.eye(ndims), mu_taus, sigma_taus, sigma_scale) - offset
+    lower, upper = _bounds_to_arrays(bounds, coefs.shape[1])
+
+    grid_lower = np.full(ndims, -np.inf)
+    grid_upper = np.full(ndims, np.inf)
+    for dim in range(ndims):
+        # each parameter is a multiple of a single grid dimension
+        for ix in np.flatnonzero(coefs[dim]):
+            limits = (np.array([lower[ix], upper[ix]]) - offset[0, ix]) / coefs[dim, ix]
+            grid_lower[dim] = max(grid_lower[dim], limits.min())
+            grid_upper[dim] = min(grid_upper[dim], limits.max())
+
+    return grid_lower, grid_upper
+
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #
-# MAKE THINGS PICKLEABLE FOR MULTIPROCESSING
+# BATCHED OBJECTIVE
 #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
-def _pickle_method(method):
-    func_name = method.im_func.__name__
-    obj = method.im_self
-    cls = method.im_class
-    return _unpickle_method, (func_name, obj, cls)
+def _sufficient_statistics(targets):
+    """
+    Per-stimulus sufficient statistics of a response amplitude matrix.
+    The gamma NLL only depends on the data through the number of observations,
+    the sum of amplitudes and the sum of log amplitudes at each stimulus.
+    Statistics are accumulated in a single pass over chunks of sweeps.
+
+    :param targets: 2D np.array with response amplitudes of shape [n_sweep, n_stimulus],
+                    memory-mapped array or `ChunkedTargets`
+    Like in `_nll`, missing (NaN) and negative amplitudes, whose log is undefined, are
+    excluded from all three statistics. Zero amplitudes make the NLL infinite.
+
+    :return: np.array of shape [3, n_stimulus]: counts, sums and sums of logs
+    """
+    stats = 0
+    for chunk in iter_sweep_chunks(targets):
+        valid = chunk >= 0
+        with np.errstate(divide="ignore"):
+            logs = np.log(chunk, out=np.zeros(chunk.shape), where=valid)
+
+        stats = stats + np.array(
+            [
+                np.count_nonzero(valid, axis=0),
+                np.sum(chunk, axis=0, where=valid),
+                np.sum(logs, axis=0),
+            ]
+        )
+
+    return stats
+
+
+class SRPObjective(object):
+    """
+    Vectorized NLL of the ExpSRP model and its gradient.
+
+    With fixed time constants, the filtered spike train at each spike is linear in
+    the kernel amplitudes (see `srp._exp_kernel_design`) and the responses only enter
+    through per-stimulus sufficient statistics. The objective (and its analytical
+    gradient) can therefore be evaluated for many parameter vectors in one pass.
+
+    Parameter vectors are indexed against a set of cells: every row of a parameter
+    matrix is evaluated on the targets of the cell given in `cells`.
+
+    :param stimulus_dict: mapping of protocol keys to isi stimulation vectors
+    :param target_dicts: mapping of protocol keys to response matrices, or a list
+                         of such mappings (one per cell)
+    :param mu_taus: mu time constants
+    :param sigma_taus: sigma time constants
+    :param mu_scale: mu scale (defaults to None for normalized data)
+    :param loss: type of loss to be used. One of:
+            'default':  NLL across all observations
+            'equal':    Assign equal weight to each stimulation protocol instead of each observation.
+    """
+
+    def __init__(
+        self,
+        stimulus_dict,
+        target_dicts,
+        mu_taus,
+        sigma_taus,
+        mu_scale=None,
+        loss="default",
+    ):
+
+        if loss not in ("default", "equal"):
+            raise ValueError(
+                "Invalid loss function. The batched objective supports 'default' and 'equal' losses"
+            )
+
+        if isinstance(target_dicts, dict):
+            target_dicts = [target_dicts]
+
+        self.mu_taus = np.atleast_1d(mu_taus)
+        self.sigma_taus = np.atleast_1d(sigma_taus)
+        self.mu_scale = mu_scale
+        self.loss = loss
+        self.ncells = len(target_dicts)
+        self.nparams = 3 + len(self.mu_taus) + len(self.sigma_taus)
+
+        # Protocols with targets in at least one cell, in order of appearance.
+        # Design matrices are shared across cells, statistics are stored per cell
+        self.keys = []
+        self.designs = {}
+        self.stats = {}
+        for cell, target_dict in enumerate(target_dicts):
+            for key, targets in target_dict.items():
+                self._add_statistics(
+                    key, stimulus_dict[key], _sufficient_statistics(targets), cell
+                )
+
+        self._compute_weights()
+
+    def _add_statistics(self, key, isivec, stats, cell):
+        """ adds sufficient statistics of a protocol to those of a cell """
+
+        if key not in self.keys:
+            self.keys.append(key)
+            self.designs[key] = (
+                _exp_kernel_design(isivec, self.mu_taus),
+                _exp_kernel_design(isivec, self.sigma_taus),
+            )
+            self.stats[key] = np.zeros((3, self.ncells, len(isivec)))
+
+        self.stats[key][:, cell] += stats
+
+    def add_targets(self, key, isivec, targets, cell=0):
+        """
+        Adds response amplitudes (e.g. newly recorded sweeps) to the objective.
+        Only the sufficient statistics of the protocol are updated, such that the cost
+        does not depend on the amount of data that was added before.
+
+        :param key: protocol key
+        :param isivec: ISI vector of the protocol
+        :param targets: 2D np.array with response amplitudes of shape [n_sweep, n_stimulus]
+        :param cell: index of the cell the targets belong to
+        """
+        self._add_statistics(key, isivec, _sufficient_statistics(targets), cell)
+        self._compute_weights()
+
+    def _compute_weights(self):
+        """ weights of each protocol in the loss of each cell """
+
+        self.weights = {}
+        counts = {key: self.stats[key][0].sum(1) for key in self.keys}
+        n_protocols = np.sum([counts[key] > 0 for key in self.keys], axis=0)
+
+        for key in self.keys:
+            if self.loss == "equal":
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    self.weights[key] = np.where(
+                        counts[key] > 0, 1 / (counts[key] * n_protocols), 0
+                    )
+            else:
+                self.weights[key] = np.ones(self.ncells)
+
+    def _protocol_terms(self, X, cells, key, jac=True, weighted=True):
+        """
+        Loss (and gradient) contribution of a single stimulation protocol
+
+        :param X: parameter matrix of shape [n_vectors, n_params]
+        :param cells: cell index of each parameter vector
+        :param key: protocol key
+        :param jac: also compute the gradient
+        :param weighted: apply the protocol weights of the loss. If False, every observation
+                         has unit weight.
+        :return: losses of shape [n_vectors] and gradients of shape [n_vectors, n_params]
+        """
+        design_mu, design_sigma = self.designs[key]
+        n, ysum, logysum = self.stats[key][:, cells]
+        weight = self.weights[key][cells][:, None] if weighted else 1
+        nr_mu_exps = len(self.mu_taus)
+
+        # Nonlinear readout
+        mu_readout = expit(X[:, [0]] + X[:, 1 : 1 + nr_mu_exps] @ design_mu.T)
+        sigma_readout = expit(
+            X[:, [1 + nr_mu_exps]] + X[:, 2 + nr_mu_exps : -1] @ design_sigma.T
+        )
+        if self.mu_scale is None:
+            mu = mu_readout / expit(X[:, [0]])
+        else:
+            mu = mu_readout * self.mu_scale
+        sigma = sigma_readout * X[:, [-1]]
+
+        # NLL summed over sweeps
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            shape = mu ** 2 / sigma ** 2
+            logratio = np.log(mu / sigma ** 2)
+            terms = weight * (
+                ysum * mu / sigma ** 2
+                - (shape - 1) * (logysum + n * logratio)
+                + n * gammaln(shape)
+                - n * logratio
+            )
+        terms[n == 0] = 0
+        loss = np.nansum(terms, axis=1)
+
+        if not jac:
+            return loss, None
+
+        # Derivatives with respect to mu and sigma
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            psi = n * digamma(shape)
+            dmu = weight * (
+                (ysum - n * mu) / sigma ** 2
+                + 2 * mu / sigma ** 2 * (psi - logysum - n * logratio)
+            )
+            dsigma = weight * (
+                2 * mu / sigma ** 3 * (n * mu - ysum)
+                + 2 * mu ** 2 / sigma ** 3 * (logysum + n * logratio - psi)
+            )
+        dmu[n == 0] = 0
+        dsigma[n == 0] = 0
+
+        # Chain rule through nonlinear readout
+        dz_mu = dmu * mu * (1 - mu_readout)
+        dz_sigma = dsigma * sigma * (1 - sigma_readout)
+
+        grad = np.empty(X.shape)
+        grad[:, 0] = dz_mu.sum(1)
+        if self.mu_scale is None:
+            grad[:, 0] -= (dmu * mu).sum(1) * (1 - expit(X[:, 0]))
+        grad[:, 1 : 1 + nr_mu_exps] = dz_mu @ design_mu
+        grad[:, 1 + nr_mu_exps] = dz_sigma.sum(1)
+        grad[:, 2 + nr_mu_exps : -1] = dz_sigma @ design_sigma
+        grad[:, -1] = (dsigma * sigma_readout).sum(1)
+
+        return loss, grad
+
+    def _protocol_hessian(self, x, cell, key):
+        """
+        Hessian contribution of a single stimulation protocol, in closed form.
+
+        Per stimulus, the gamma NLL is a function of shape a = mu^2 / sigma^2 and
+        rate b = mu / sigma^2 only. Its second derivatives with respect to mu and sigma
+        are propagated through the nonlinear readout, which is linear in the parameters
+        (see `srp._exp_kernel_design`) up to the sigmoid.
+
+        :param x: parameter vector
+        :param cell: cell index of the parameter vector
+        :param key: protocol key
+        :return: Hessian of shape [n_params, n_params]
+        """
+        design_mu, design_sigma = self.designs[key]
+        n, ysum, logysum = self.stats[key][:, cell]
+        weight = self.weights[key][cell]
+        nr_mu_exps = len(self.mu_taus)
+
+        # Stimuli without observations do not contribute
+        observed = n > 0
+        n, ysum, logysum = n[observed], ysum[observed], logysum[observed]
+        v_mu = np.column_stack([np.ones(len(n)), design_mu[observed]])
+        v_sigma = np.column_stack([np.ones(len(n)), design_sigma[observed]])
+
+        # Nonlinear readout
+        mu_readout = expit(v_mu @ x[: 1 + nr_mu_exps])
+        sigma_readout = expit(v_sigma @ x[1 + nr_mu_exps : -1])
+        if self.mu_scale is None:
+            mu = mu_readout / expit(x[0])
+        else:
+            mu = mu_readout * self.mu_scale
+        sigma = sigma_readout * x[-1]
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            # Derivatives with respect to shape and rate
+            shape = mu ** 2 / sigma ** 2
+            rate = mu / sigma ** 2
+            da = n * digamma(shape) - logysum - n * np.log(rate)
+            db = ysum - n * mu
+            daa = n * polygamma(1, shape)
+            dab = -n / rate
+            dbb = n * shape / rate ** 2
+
+            # Derivatives of shape and rate with respect to mu and sigma
+            a_mu = 2 * mu / sigma ** 2
+            a_sigma = -2 * mu ** 2 / sigma ** 3
+            b_mu = 1 / sigma ** 2
+            b_sigma = -2 * mu / sigma ** 3
+
+            # First and second derivatives with respect to mu and sigma
+            dmu = weight * (da * a_mu + db * b_mu)
+            dsigma = weight * (da * a_sigma + db * b_sigma)
+            dmumu = weight * (
+                daa * a_mu ** 2
+                + 2 * dab * a_mu * b_mu
+                + dbb * b_mu ** 2
+                + da * 2 / sigma ** 2
+            )
+            dmusigma = weight * (
+                daa * a_mu * a_sigma
+                + dab * (a_mu * b_sigma + a_sigma * b_mu)
+                + dbb * b_mu * b_sigma
+                - da * 4 * mu / sigma ** 3
+                - db * 2 / sigma ** 3
+            )
+            dsigmasigma = weight * (
+                daa * a_sigma ** 2
+                + 2 * dab * a_sigma * b_sigma
+                + dbb * b_sigma ** 2
+                + da * 6 * mu ** 2 / sigma ** 4
+                + db * 6 * mu / sigma ** 4
+            )
+
+        # Derivatives of log(mu) and log(sigma) with respect to their parameters
+        dlogmu = (1 - mu_readout)[:, None] * v_mu
+        if self.mu_scale is None:
+            dlogmu[:, 0] -= 1 - expit(x[0])
+        dlogsigma = np.column_stack(
+            [(1 - sigma_readout)[:, None] * v_sigma, np.full(len(n), 1 / x[-1])]
+        )
 
+        # Chain rule through nonlinear readout:
+        # d2 mu = mu * (dlogmu dlogmu^T + d2 log(mu)), and accordingly for sigma
+        hess_mu = dlogmu.T @ ((mu ** 2 * dmumu + mu * dmu)[:, None] * dlogmu)
+        hess_mu -= v_mu.T @ ((mu * dmu * mu_readout * (1 - mu_readout))[:, None] * v_mu)
+        if self.mu_scale is None:
+            hess_mu[0, 0] += np.sum(mu * dmu) * expit(x[0]) * (1 - expit(x[0]))
 
-def _unpickle_method(func_name, obj, cls):
-    for cls in cls.mro():
-        try:
-            func = cls.__dict__[func_name]
-        except KeyError:
-            pass
+        hess_sigma = dlogsigma.T @ (
+            (sigma ** 2 * dsigmasigma + sigma * dsigma)[:, None] * dlogsigma
+        )
+        hess_sigma[:-1, :-1] -= v_sigma.T @ (
+            (sigma * dsigma * sigma_readout * (1 - sigma_readout))[:, None] * v_sigma
+        )
+        hess_sigma[-1, -1] -= np.sum(sigma * dsigma) / x[-1] ** 2
+
+        hess_cross = dlogmu.T @ ((mu * sigma * dmusigma)[:, None] * dlogsigma)
+
+        split = 1 + nr_mu_exps
+        hessian = np.empty((self.nparams, self.nparams))
+        hessian[:split, :split] = hess_mu
+        hessian[split:, split:] = hess_sigma
+        hessian[:split, split:] = hess_cross
+        hessian[split:, :split] = hess_cross.T
+
+        return hessian
+
+    def hessian(self, x, cell=0):
+        """
+        Hessian of the loss of a single parameter vector, in closed form
+        (see `_protocol_hessian`)
+
+        :param x: parameter vector
+        :param cell: cell index of the parameter vector
+        :return: symmetric Hessian of shape [n_params, n_params]
+        """
+        x = np.asarray(x, dtype=float)
+        hessian = np.zeros((self.nparams, self.nparams))
+        for key in self.keys:
+            hessian += self._protocol_hessian(x, cell, key)
+
+        return hessian
+
+    def mean_and_jacobian(self, x, key):
+        """
+        Mean response amplitudes of a protocol and their derivatives with respect to the parameters
+
+        :param x: parameter vector
+        :param key: protocol key
+        :return: means of shape [n_stimulus] and Jacobian of shape [n_stimulus, n_params]
+        """
+        x = np.asarray(x, dtype=float)
+        design_mu, _ = self.designs[key]
+        nr_mu_exps = len(self.mu_taus)
+
+        mu_readout = expit(x[0] + design_mu @ x[1 : 1 + nr_mu_exps])
+        if self.mu_scale is None:
+            scale = 1 / expit(x[0])
         else:
+            scale = self.mu_scale
+        mu = mu_readout * scale
+
+        jacobian = np.zeros((len(mu), self.nparams))
+        dz = scale * mu_readout * (1 - mu_readout)
+        jacobian[:, 0] = dz
+        if self.mu_scale is None:
+            jacobian[:, 0] -= mu * (1 - expit(x[0]))
+        jacobian[:, 1 : 1 + nr_mu_exps] = dz[:, None] * design_mu
+
+        return mu, jacobian
+
+    def segment(self, segment_length):
+        """
+        Splits every protocol into contiguous segments of at most `segment_length` stimuli.
+        Kernel states are carried over exactly from one segment to the next, because
+        they do not depend on the fitted parameters. The sum of the losses of all
+        segments therefore equals the loss of the full objective.
+
+        :param segment_length: number of stimuli per segment
+        :return: new objective with (protocol key, first stimulus) tuples as keys
+        """
+        segmented = copy.copy(self)
+        segmented.keys = []
+        segmented.designs = {}
+        segmented.stats = {}
+        segmented.weights = {}
+
+        for key in self.keys:
+            nstim = self.stats[key].shape[-1]
+            for start in range(0, nstim, segment_length):
+                window = slice(start, start + segment_length)
+                segmented.keys.append((key, start))
+                segmented.designs[(key, start)] = tuple(
+                    design[window] for design in self.designs[key]
+                )
+                segmented.stats[(key, start)] = self.stats[key][..., window]
+                segmented.weights[(key, start)] = self.weights[key]
+
+        return segmented
+
+    def loss_and_grad(self, X, cells=None, jac=True, keys=None):
+        """
+        Total loss and gradient of many parameter vectors.
+
+        :param X: parameter matrix of shape [n_vectors, n_params]
+        :param cells: cell index of each parameter vector. Defaults to the first cell.
+        :param jac: also compute the gradient
+        :param keys: Optional - subset of protocol keys to evaluate. Defaults to all protocols.
+        :return: losses of shape [n_vectors] and gradients of shape [n_vectors, n_params]
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        if cells is None:
+            cells = np.zeros(len(X), dtype=int)
+        if keys is None:
+            keys = self.keys
+
+        loss = np.zeros(len(X))
+        grad = np.zeros(X.shape) if jac else None
+        for key in keys:
+            key_loss, key_grad = self._protocol_terms(X, cells, key, jac)
+            loss += key_loss
+            if jac:
+                grad += key_grad
+
+        return loss, grad
+
+    def __call__(self, x, *args):
+        """ loss and gradient of a single parameter vector for scipy.optimize.minimize(jac=True) """
+        loss, grad = self.loss_and_grad(x)
+        return loss[0], grad[0]
+
+
+class HierarchicalSRPObjective(SRPObjective):
+    """
+    Joint NLL of many cells with parameters that are partly shared across cells.
+
+    The joint parameter vector holds each shared parameter once, followed by the
+    per-cell parameters of every cell. Design matrices are shared across cells and
+    every cell contributes through its own sufficient statistics, such that the gradient
+    of a shared parameter is the sum of the per-cell gradients.
+
+    :param shared: parameter groups shared across cells. Any of
+            'mu_baseline', 'mu_amps', 'sigma_baseline', 'sigma_amps', 'sigma_scale'
+    :param args, kwargs: positional and keyword arguments of `SRPObjective`
+    """
+
+    def __init__(self, *args, shared=("mu_amps", "sigma_amps"), **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        groups = _parameter_groups(len(self.mu_taus), len(self.sigma_taus))
+        for group in shared:
+            if group not in groups:
+                raise ValueError("Unknown parameter group '{}'".format(group))
+
+        is_shared = np.zeros(self.nparams, dtype=bool)
+        for group in shared:
+            is_shared[groups[group]] = True
+
+        # Map every entry of the per-cell parameter matrix to the joint vector
+        self.nshared = np.count_nonzero(is_shared)
+        self.ncellparams = self.nparams - self.nshared
+        self.index = np.zeros((self.ncells, self.nparams), dtype=int)
+        self.index[:, is_shared] = np.arange(self.nshared)
+        self.index[:, ~is_shared] = self.nshared + np.arange(
+            self.ncells * self.ncellparams
+        ).reshape(self.ncells, self.ncellparams)
+        self.is_shared = is_shared
+
+    @property
+    def njoint(self):
+        """ number of parameters in the joint vector """
+        return self.nshared + self.ncells * self.ncellparams
+
+    def to_joint(self, X):
+        """
+        Converts per-cell parameters of shape [n_params] or [n_cells, n_params] to a joint vector.
+        Shared parameters are averaged across cells.
+        """
+        X = np.broadcast_to(np.asarray(X, dtype=float), (self.ncells, self.nparams))
+        theta = np.bincount(self.index.ravel(), X.ravel(), minlength=self.njoint)
+        theta[: self.nshared] /= self.ncells
+        return theta
+
+    def to_cells(self, theta):
+        """ Converts a joint vector to per-cell parameters of shape [n_cells, n_params] """
+        return np.asarray(theta, dtype=float)[self.index]
+
+    def joint_bounds(self, bounds):
+        """ Converts per-cell parameter bounds to bounds for the joint vector """
+        joint = [None] * self.njoint
+        for cell in range(self.ncells):
+            for param, ix in enumerate(self.index[cell]):
+                joint[ix] = bounds[param]
+        return joint
+
+    def __call__(self, theta, *args):
+        """ joint loss and gradient for scipy.optimize.minimize(jac=True) """
+        loss, grad = self.loss_and_grad(self.to_cells(theta), np.arange(self.ncells))
+        return (
+            loss.sum(),
+            np.bincount(self.index.ravel(), grad.ravel(), minlength=self.njoint),
+        )
+
+
+class CrossValidationObjective(object):
+    """
+    Objectives of all folds of a leave-one-protocol-out cross-validation.
+
+    The loss of every fold is a weighted sum of the per-protocol loss contributions
+    (with the weight of the held-out protocol set to zero). Per-protocol contributions
+    and their gradients are computed once per parameter vector and cached, such that
+    the losses of all folds are derived from a single model evaluation. Rows of a
+    parameter matrix can belong to different folds, so that all folds are optimized
+    jointly in one vectorized pass per step (see `_minimize_batch`).
+
+    :param objective: instance of `SRPObjective` on all protocols
+    :param test_keys: held-out protocol of each fold
+    :param cache_size: maximum number of cached parameter vectors
+    """
+
+    def __init__(self, objective, test_keys, cache_size=4096):
+        self.objective = objective
+        self.test_keys = list(test_keys)
+        self.cache_size = cache_size
+        self._cache = {}
+
+        # weight of each protocol in the loss of each fold and cell
+        keys = objective.keys
+        counts = np.array([objective.stats[key][0].sum(1) for key in keys])
+        self.weights = np.zeros((len(self.test_keys), len(keys), objective.ncells))
+        for fold, testkey in enumerate(self.test_keys):
+            included = (counts > 0) & (np.array(keys, dtype=object) != testkey)[:, None]
+            if objective.loss == "equal":
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    self.weights[fold] = np.where(
+                        included, 1 / (counts * included.sum(0)), 0
+                    )
+            else:
+                self.weights[fold] = included
+
+    def contributions(self, X, cells=None):
+        """
+        Per-protocol loss contributions and gradients with unit weight per observation.
+        Parameter vectors that were evaluated before are read from the cache, the others
+        are evaluated once each in a single vectorized pass.
+
+        :param X: parameter matrix of shape [n_vectors, n_params]
+        :param cells: cell index of each parameter vector. Defaults to the first cell.
+        :return: losses of shape [n_vectors, n_protocols]
+                 and gradients of shape [n_vectors, n_protocols, n_params]
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        if cells is None:
+            cells = np.zeros(len(X), dtype=int)
+
+        rowkeys = [(cell, x.tobytes()) for cell, x in zip(cells, X)]
+        missing = {}
+        for row, rowkey in enumerate(rowkeys):
+            if rowkey not in self._cache and rowkey not in missing:
+                missing[rowkey] = row
+
+        if missing:
+            rows = np.array(list(missing.values()))
+            terms = [
+                self.objective._protocol_terms(
+                    X[rows], cells[rows], key, weighted=False
+                )
+                for key in self.objective.keys
+            ]
+            if len(self._cache) + len(rows) > self.cache_size:
+                self._cache.clear()
+            for ix, rowkey in enumerate(missing):
+                self._cache[rowkey] = (
+                    np.array([loss[ix] for loss, _ in terms]),
+                    np.array([grad[ix] for _, grad in terms]),
+                )
+
+        losses = np.array([self._cache[rowkey][0] for rowkey in rowkeys])
+        grads = np.array([self._cache[rowkey][1] for rowkey in rowkeys])
+        return losses, grads
+
+    def fold_losses(self, X, cells=None):
+        """
+        Losses of all folds for many parameter vectors
+
+        :param X: parameter matrix of shape [n_vectors, n_params]
+        :param cells: cell index of each parameter vector. Defaults to the first cell.
+        :return: losses of shape [n_vectors, n_folds]
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        if cells is None:
+            cells = np.zeros(len(X), dtype=int)
+
+        losses, _ = self.contributions(X, cells)
+        return np.einsum("vk,fkv->vf", losses, self.weights[:, :, cells])
+
+    def loss_and_grad(self, X, folds, cells=None):
+        """
+        Loss and gradient of many parameter vectors, each in its own fold
+
+        :param X: parameter matrix of shape [n_vectors, n_params]
+        :param folds: fold index of each parameter vector
+        :param cells: cell index of each parameter vector. Defaults to the first cell.
+        :return: losses of shape [n_vectors] and gradients of shape [n_vectors, n_params]
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        if cells is None:
+            cells = np.zeros(len(X), dtype=int)
+
+        losses, grads = self.contributions(X, cells)
+        weights = self.weights[folds, :, cells]
+
+        return (
+            np.einsum("vk,vk->v", losses, weights),
+            np.einsum("vkp,vk->vp", grads, weights),
+        )
+
+    def fold(self, testkey):
+        """
+        :param testkey: held-out protocol
+        :return: objective function of the fold for scipy.optimize.minimize(jac=True)
+        """
+        return _FoldObjective(self, self.test_keys.index(testkey))
+
+
+class _FoldObjective(object):
+    """ objective function of a single fold of a `CrossValidationObjective` """
+
+    def __init__(self, crossvalidation, fold):
+        self.crossvalidation = crossvalidation
+        self.fold = fold
+
+    def __call__(self, x, *args):
+        loss, grad = self.crossvalidation.loss_and_grad(x, [self.fold])
+        return loss[0], grad[0]
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# BATCHED OPTIMIZATION
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def _bounds_to_arrays(bounds, nparams):
+    """ converts a list of (min, max) pairs to arrays of lower and upper bounds """
+    if bounds is None:
+        bounds = [(None, None)] * nparams
+    lower = np.array([-np.inf if b[0] is None else b[0] for b in bounds], dtype=float)
+    upper = np.array([np.inf if b[1] is None else b[1] for b in bounds], dtype=float)
+    return lower, upper
+
+
+def _two_loop_recursion(grad, S, Y, rho):
+    """
+    L-BFGS two-loop recursion for a batch of problems.
+    Unused memory slots have `rho` equal to zero.
+
+    :param grad: gradients of shape [n_problems, n_params]
+    :param S: parameter differences of shape [n_problems, n_memory, n_params] (oldest first)
+    :param Y: gradient differences of shape [n_problems, n_memory, n_params] (oldest first)
+    :param rho: inverse curvatures of shape [n_problems, n_memory]
+    :return: approximate inverse Hessian times gradient
+    """
+    q = grad.copy()
+    nmem = S.shape[1]
+    alpha = np.zeros((len(q), nmem))
+
+    for i in reversed(range(nmem)):
+        alpha[:, i] = rho[:, i] * np.sum(S[:, i] * q, 1)
+        q -= alpha[:, [i]] * Y[:, i]
+
+    # Scale initial Hessian by the most recent curvature pair
+    yy = np.sum(Y[:, -1] ** 2, 1)
+    gamma_scale = np.ones(len(q))
+    recent = (rho[:, -1] > 0) & (yy > 0)
+    gamma_scale[recent] = np.sum(S[recent, -1] * Y[recent, -1], 1) / yy[recent]
+    r = gamma_scale[:, None] * q
+
+    for i in range(nmem):
+        beta = rho[:, i] * np.sum(Y[:, i] * r, 1)
+        r += S[:, i] * (alpha[:, i] - beta)[:, None]
+
+    return r
+
+
+# Options of scipy's L-BFGS-B that are supported by `_minimize_batch`
+_BATCH_OPTIONS = ("maxiter", "ftol", "gtol", "maxcor", "maxls", "disp")
+
+
+def _minimize_batch(
+    fun,
+    x0,
+    bounds=None,
+    maxiter=15000,
+    ftol=2.2204460492503131e-09,
+    gtol=1e-5,
+    maxcor=10,
+    maxls=20,
+    disp=False,
+    **unknown_options
+):
+    """
+    Minimizes many independent, bound-constrained problems simultaneously using a
+    projected L-BFGS method. The Hessian approximation of the joint problem is block-diagonal,
+    such that every problem keeps its own curvature memory, line search and convergence state.
+    Problems that have converged are dropped from the active set.
+
+    Options mirror those of scipy's L-BFGS-B implementation. Only the options in
+    `_BATCH_OPTIONS` are supported, others raise a ValueError instead of being ignored.
+
+    :param fun: callable mapping a parameter matrix of shape [n_active, n_params] and the
+                indices of the active problems to their losses and gradients
+    :param x0: initial guesses of shape [n_problems, n_params]
+    :param bounds: list of (min, max) pairs for each parameter
+    :return: list of scipy OptimizeResult objects, one per problem
+    """
+    if unknown_options:
+        raise ValueError(
+            "Options {} are not supported by the batched L-BFGS method. "
+            "Supported options are {}".format(
+                sorted(unknown_options), list(_BATCH_OPTIONS)
+            )
+        )
+
+    X = np.array(x0, dtype=float)
+    nprob, nparams = X.shape
+
+    lower, upper = _bounds_to_arrays(bounds, nparams)
+    X = np.clip(X, lower, upper)
+
+    f, G = fun(X, np.arange(nprob))
+    nfev = np.ones(nprob, dtype=int)
+    nit = np.zeros(nprob, dtype=int)
+    status = np.full(nprob, -1)
+    messages = np.empty(nprob, dtype=object)
+
+    # Curvature memory (oldest pair first)
+    S = np.zeros((nprob, maxcor, nparams))
+    Y = np.zeros((nprob, maxcor, nparams))
+    rho = np.zeros((nprob, maxcor))
+
+    active = np.arange(nprob)
+    while active.size:
+
+        # 1. CONVERGENCE CHECKS
+        projected_grad = X[active] - np.clip(X[active] - G[active], lower, upper)
+        converged = np.max(np.abs(projected_grad), 1) <= gtol
+        status[active[converged]] = 0
+        messages[active[converged]] = "CONVERGENCE: NORM_OF_PROJECTED_GRADIENT_<=_PGTOL"
+
+        exhausted = ~converged & (nit[active] >= maxiter)
+        status[active[exhausted]] = 1
+        messages[active[exhausted]] = "STOP: TOTAL NO. of ITERATIONS REACHED LIMIT"
+
+        active = active[~converged & ~exhausted]
+        if not active.size:
             break
-    return func.__get__(obj, cls)
 
+        # 2. SEARCH DIRECTION ON FREE VARIABLES
+        Xa, Ga = X[active], G[active]
+        free = ~(((Xa <= lower) & (Ga > 0)) | ((Xa >= upper) & (Ga < 0)))
+        direction = -_two_loop_recursion(Ga * free, S[active], Y[active], rho[active])
+        direction *= free
+
+        # Reset memory if the direction is not a descent direction
+        uphill = np.sum(direction * Ga, 1) >= 0
+        direction[uphill] = -(Ga * free)[uphill]
+        rho[active[uphill]] = 0
+
+        # 3. BACKTRACKING LINE SEARCH ALONG THE PROJECTED PATH
+        step = np.ones(len(active))
+        first = (nit[active] == 0) | uphill
+        step[first] = np.minimum(1, 1 / np.linalg.norm(direction[first], axis=1))
+
+        Xnew, fnew, Gnew = Xa.copy(), f[active].copy(), Ga.copy()
+        pending = np.arange(len(active))
+        for _ in range(maxls):
+            trial = np.clip(
+                Xa[pending] + step[pending, None] * direction[pending], lower, upper
+            )
+            ftrial, Gtrial = fun(trial, active[pending])
+            nfev[active[pending]] += 1
+
+            sufficient = np.isfinite(ftrial) & (
+                ftrial
+                <= f[active[pending]]
+                + 1e-4 * np.sum(Ga[pending] * (trial - Xa[pending]), 1)
+            )
+            accepted = pending[sufficient]
+            Xnew[accepted] = trial[sufficient]
+            fnew[accepted] = ftrial[sufficient]
+            Gnew[accepted] = Gtrial[sufficient]
+
+            pending = pending[~sufficient]
+            step[pending] *= 0.5
+            if not pending.size:
+                break
+
+        status[active[pending]] = 2
+        messages[active[pending]] = "ABNORMAL_TERMINATION_IN_LNSRCH"
+
+        # 4. UPDATE STATE AND CURVATURE MEMORY
+        moved = np.setdiff1d(np.arange(len(active)), pending)
+        ix = active[moved]
+        s = Xnew[moved] - X[ix]
+        y = Gnew[moved] - G[ix]
+        sy = np.sum(s * y, 1)
+        curved = sy > 1e-10 * np.sum(y ** 2, 1)
+
+        update = ix[curved]
+        S[update] = np.roll(S[update], -1, axis=1)
+        Y[update] = np.roll(Y[update], -1, axis=1)
+        rho[update] = np.roll(rho[update], -1, axis=1)
+        S[update, -1] = s[curved]
+        Y[update, -1] = y[curved]
+        rho[update, -1] = 1 / sy[curved]
+
+        reduction = f[ix] - fnew[moved]
+        X[ix], f[ix], G[ix] = Xnew[moved], fnew[moved], Gnew[moved]
+        nit[ix] += 1
+
+        small_reduction = reduction <= ftol * np.maximum(
+            np.maximum(np.abs(f[ix]), np.abs(f[ix] + reduction)), 1
+        )
+        converged = ix[small_reduction]
+        status[converged] = 0
+        messages[converged] = "CONVERGENCE: REL_REDUCTION_OF_F_<=_FACTR*EPSMCH"
+
+        active = active[status[active] == -1]
+
+        if disp:
+            print(
+                "Iteration {}: {} of {} problems active".format(
+                    nit.max(), active.size, nprob
+                )
+            )
+
+    return [
+        OptimizeResult(
+            x=X[i],
+            fun=f[i],
+            jac=G[i],
+            nit=nit[i],
+            nfev=nfev[i],
+            njev=nfev[i],
+            status=status[i],
+            success=bool(status[i] == 0),
+            message=messages[i],
+        )
+        for i in range(nprob)
+    ]
 
-copyreg.pickle(types.MethodType, _pickle_method, _unpickle_method)
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #
-# MAIN FITTING FUNCTIONS
+# STOCHASTIC OPTIMIZATION
 #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
-def fit_srp_model_gridsearch(
+def _parameter_scales(mu_taus, sigma_taus):
+    """ typical scale of each fitting parameter: amplitudes scale with their time constant """
+    return np.array([1, *mu_taus, 1, *sigma_taus, 1], dtype=float)
+
+
+def _minimize_stochastic(
+    objective,
+    x0,
+    bounds,
+    scales,
+    batch_size=8,
+    epochs=5,
+    method="adam",
+    learning_rate=None,
+    seed=None,
+    disp=False,
+):
+    """
+    Minimizes a segmented objective (see `SRPObjective.segment`) with stochastic
+    gradient steps on random minibatches of segments.
+
+    Steps are taken in parameter space rescaled by `scales`. Gradients are normalized
+    per observation, such that learning rates do not depend on the amount of data.
+
+    :param objective: segmented `SRPObjective`
+    :param x0: initial parameters
+    :param bounds: list of (min, max) pairs for each parameter
+    :param scales: scale of each parameter
+    :param batch_size: number of segments per minibatch
+    :param epochs: number of passes over all segments
+    :param method: 'adam' or 'svrg' (stochastic variance-reduced gradient)
+    :param learning_rate: step size. Defaults to 0.01 for 'adam' and 0.002 for 'svrg'
+    :param seed: seed for the random order of segments
+    :param disp: print progress after every epoch
+    :return: final parameters and number of equivalent full passes over the data
+    """
+    if method not in ("adam", "svrg"):
+        raise ValueError("Invalid method. Use either 'adam' or 'svrg'")
+    if learning_rate is None:
+        learning_rate = 0.01 if method == "adam" else 0.002
+
+    rng = np.random.default_rng(seed)
+    keys = objective.keys
+    nseg = len(keys)
+    batch_size = min(batch_size, nseg)
+
+    lower, upper = _bounds_to_arrays(bounds, len(scales))
+    lower, upper = lower / scales, upper / scales
+    z = np.clip(np.asarray(x0, dtype=float) / scales, lower, upper)
+
+    # Normalize gradients by the total (weighted) number of observations
+    nobs = np.sum(
+        [objective.weights[key][0] * objective.stats[key][0, 0].sum() for key in keys]
+    )
+
+    def minibatch_grad(z, batch):
+        _, grad = objective.loss_and_grad(z * scales, keys=batch)
+        return grad[0] * scales * nseg / len(batch) / nobs
+
+    # Adam moments
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    m = np.zeros(len(z))
+    v = np.zeros(len(z))
+    t = 0
+
+    evaluated = 0  # number of segment evaluations
+    for epoch in range(epochs):
+
+        if method == "svrg":
+            snapshot = z.copy()
+            snapshot_grad = minibatch_grad(snapshot, keys)
+            evaluated += nseg
+
+        order = rng.permutation(nseg)
+        for start in range(0, nseg, batch_size):
+            batch = [keys[i] for i in order[start : start + batch_size]]
+            grad = minibatch_grad(z, batch)
+            evaluated += len(batch)
+
+            if method == "adam":
+                t += 1
+                m = beta1 * m + (1 - beta1) * grad
+                v = beta2 * v + (1 - beta2) * grad ** 2
+                step = (
+                    learning_rate
+                    * (m / (1 - beta1 ** t))
+                    / (np.sqrt(v / (1 - beta2 ** t)) + eps)
+                )
+            else:
+                grad += snapshot_grad - minibatch_grad(snapshot, batch)
+                evaluated += len(batch)
+                step = learning_rate * grad
+
+            z = np.clip(z - step, lower, upper)
+
+        if disp:
+            print("Epoch {}: {} full data passes".format(epoch + 1, evaluated / nseg))
+
+    return z * scales, evaluated / nseg
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# MULTI-START HELPERS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def _iter_start_results(wrapped_minimizer, starts, workers):
+    """
+    Runs the wrapped minimizer from each start, possibly in parallel.
+
+    Starts whose worker process died (e.g. killed by the out-of-memory killer) are recorded
+    as failed with `lost=True`, as are starts without result long after their wall-clock
+    budget. This is not possible with a map-like callable as `workers`, or in a single process.
+
+    :return: generator of optimizer results, in the order of the starts
+    """
+
+    def lost(x0, message):
+        return failed_result(x0, message, lost=True)
+
+    if isinstance(workers, Executor):
+        yield from workers.map(wrapped_minimizer, starts, on_lost=lost)
+        return
+
+    if callable(workers) or int(workers) == 1:
+        # CODE COPIED FROM SCIPY.OPTIMIZE.BRUTE:
+        # iterate over input arrays, possibly in parallel
+        with MapWrapper(pool=workers) as mapper:
+            yield from mapper(wrapped_minimizer, starts)
+        return
+
+    timeout = None
+    if wrapped_minimizer.max_time is not None:
+        timeout = 2 * wrapped_minimizer.max_time
+
+    # objective and data are sent to the workers once through shared memory
+    with SharedMemoryPool(wrapped_minimizer, workers) as pool:
+        yield from pool.map(starts, timeout=timeout, on_lost=lost)
+
+
+def _map_starts(
+    wrapped_minimizer,
+    starts,
+    workers,
+    checkpoint=None,
+    callback=None,
+    cache=None,
+    preloaded=None,
+):
+    """
+    Runs the wrapped minimizer from each start, possibly in parallel
+
+    :param wrapped_minimizer: instance of `MinimizeWrapper`
+    :param starts: array of initial guesses
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :param checkpoint: Optional - `Checkpoint` to journal completed starts to. Starts that
+            were completed by a previous run with the same minimizer are not run again.
+            Failed starts and starts that exceeded their budget are not journaled.
+    :param callback: Optional - function called with the result of each completed start
+            and the best successful result so far. If it returns True, the remaining
+            starts are not run.
+    :param cache: Optional - `FitCache` to look up and store the result of each start
+    :param preloaded: Optional - function called like `callback` with each result read from
+            the checkpoint or cache, before any start is run. If it returns True, no
+            starts are run.
+    :return: list of optimizer results (None for starts that were not run)
+    """
+    starts = np.array(starts, dtype=float)
+    listres = [None] * len(starts)
+
+    if checkpoint is not None:
+        # results are only valid for the same objective, data and optimizer settings
+        checkpoint = checkpoint.scoped(fingerprint(wrapped_minimizer))
+        done = checkpoint.load()
+        for ix, x0 in enumerate(starts):
+            listres[ix] = done.get((x0.tobytes(),))
+
+    if cache is not None:
+        cache = cache.scoped("start", fingerprint(wrapped_minimizer))
+        for ix, x0 in enumerate(starts):
+            if listres[ix] is None:
+                listres[ix] = cache.get((x0.tobytes(),))
+
+    best = None
+    for res in listres:
+        if res is not None and _is_better(res, best):
+            best = res
+
+    if preloaded is not None:
+        for res in listres:
+            if res is not None and preloaded(res, best):
+                print("- Stopped by callback, remaining starts are not run")
+                return listres
+
+    todo = [ix for ix, res in enumerate(listres) if res is None]
+    if not todo:
+        return listres
+
+    results = _iter_start_results(wrapped_minimizer, starts[todo], workers)
+    try:
+        for ix, res in zip(todo, results):
+            listres[ix] = res
+            # results of starts that failed (possibly for transient reasons, e.g. memory)
+            # or were cut short by their wall-clock budget are not reproducible, and are
+            # run again when the fit is resumed
+            if _reproducible([res]):
+                if checkpoint is not None:
+                    checkpoint.save((starts[ix].tobytes(),), res)
+                if cache is not None:
+                    cache.save((starts[ix].tobytes(),), res)
+
+            if _is_better(res, best):
+                best = res
+            if callback is not None and callback(res, best):
+                print("- Stopped by callback, remaining starts are not run")
+                break
+    finally:
+        results.close()
+        if checkpoint is not None:
+            checkpoint.sync()
+
+    return listres
+
+
+def _is_better(res, best):
+    """ :return: True if `res` is a successful result that improves on `best` """
+    return res["success"] is True and (best is None or res["fun"] < best["fun"])
+
+
+def _race_starts(
+    wrapped_minimizer,
+    starts,
+    rungs,
+    keep,
+    workers,
+    checkpoint=None,
+    callback=None,
+    cache=None,
+    preloaded=None,
+):
+    """
+    Successive halving of multiple starts.
+    At every rung, all remaining starts continue from their current solution for the
+    iteration budget of that rung. Starts that have converged are final, of the others
+    only the best fraction `keep` continues. Survivors of the last rung are run to convergence.
+
+    :param wrapped_minimizer: instance of `MinimizeWrapper`
+    :param starts: array of initial guesses
+    :param rungs: list of iteration budgets
+    :param keep: fraction of starts that survives each rung
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :param checkpoint: Optional - `Checkpoint` to journal completed starts of each rung to
+    :param callback: Optional - callback of `_map_starts`, called at every rung
+    :param cache: Optional - `FitCache` to look up and store the starts of each rung
+    :param preloaded: Optional - `preloaded` of `_map_starts`, called at every rung
+    :return: list of optimizer results, with iterations and evaluations summed over rungs
+    """
+    listres = [None] * len(starts)
+    current = np.array(starts, dtype=float)
+    alive = np.arange(len(starts))
+    options = wrapped_minimizer.kwargs.get("options", {})
+
+    for budget in [*rungs, None]:
+        if budget is None:
+            rung_minimizer = wrapped_minimizer
+        else:
+            rung_minimizer = MinimizeWrapper(
+                wrapped_minimizer.func,
+                wrapped_minimizer.args,
+                max_time=wrapped_minimizer.max_time,
+                max_nfev=wrapped_minimizer.max_nfev,
+                **{
+                    **wrapped_minimizer.kwargs,
+                    "options": {**options, "maxiter": budget},
+                }
+            )
+
+        rungres = _map_starts(
+            rung_minimizer,
+            current[alive],
+            workers,
+            checkpoint,
+            callback,
+            cache,
+            preloaded,
+        )
+        for ix, res in zip(alive, rungres):
+            if res is None:
+                # not run, because the race was stopped by the callback
+                continue
+            if listres[ix] is not None:
+                for counter in ("nit", "nfev", "njev", "time"):
+                    if counter in res and counter in listres[ix]:
+                        res[counter] += listres[ix][counter]
+            listres[ix] = res
+            current[ix] = res["x"]
+
+        if budget is None or any(res is None for res in rungres):
+            break
+
+        # converged, failed and out-of-budget starts drop out of the race,
+        # the best unfinished starts survive
+        unfinished = np.array(
+            [
+                ix
+                for ix in alive
+                if not listres[ix]["success"]
+                and not listres[ix].get("failed", False)
+                and not listres[ix].get("budget_exceeded", False)
+            ]
+        )
+        if not unfinished.size:
+            break
+        nsurvivors = int(np.ceil(keep * len(unfinished)))
+        order = np.argsort([listres[ix]["fun"] for ix in unfinished])
+        alive = np.sort(unfinished[order[:nsurvivors]])
+
+    return listres
+
+
+def _setup_gridsearch(
     stimulus_dict,
     target_dict,
     mu_taus,
     sigma_taus,
-    param_ranges="default",
-    mu_scale=None,
-    sigma_scale=1,
-    bounds="default",
-    method="L-BFGS-B",
-    loss="default",
-    workers=1,
+    param_ranges,
+    mu_scale,
+    sigma_scale,
+    bounds,
+    method,
+    loss,
     **kwargs
 ):
     """
-    Fitting the SRP model using a gridsearch.
+    Wrapped minimizer and initial starts of a gridsearch (see `fit_srp_model_gridsearch`)
 
-    :param stimulus_dict: dictionary of protocol key - isivec mapping
-    :param target_dict: dictionary of protocol key - target amplitudes
-    :param mu_taus: mu time constants
-    :param sigma_taus: sigma time constants
-    :param target_dict: dictionary of protocol key - target amplitudes
-    :param param_ranges: Optional - ranges of parameters in form of a tuple of slice objects
-    :param mu_scale: mu scale (defaults to None for normalized data)
-    :param sigma_scale: sigma scale in case param_ranges only covers 2 dimensions
-    :param bounds: bounds for parameters to be passed to minimizer function
-    :param method: algorithm for minimizer function
-    :param loss: type of loss to be used. One of:
-            'default':  Sum of squared error across all observations
-            'equal':    Assign equal weight to each stimulation protocol instead of each observation.
-                        This computes the mean squared error for each protocol separately.
-    :param workers: number of processors
+    :return: instance of `MinimizeWrapper` and array of initial starts
     """
-
     # 1. SET PARAMETER BOUNDS
-    mu_taus = np.atleast_1d(mu_taus)
-    sigma_taus = np.atleast_1d(sigma_taus)
-
     if bounds == "default":
         bounds = _default_parameter_bounds(mu_taus, sigma_taus)
 
     # 2. INITIALIZE WRAPPED MINIMIZER FUNCTION
+    objective, args, jac = _make_objective(
+        stimulus_dict, target_dict, mu_taus, sigma_taus, mu_scale, loss
+    )
     wrapped_minimizer = MinimizeWrapper(
-        _objective_function,
-        args=(target_dict, stimulus_dict, mu_taus, sigma_taus, mu_scale, loss),
-        bounds=bounds,
-        method=method,
-        **kwargs
+        objective, args=args, jac=jac, bounds=bounds, method=method, **kwargs
     )
 
     # 3. MAKE GRID
     if param_ranges == "default":
         param_ranges = _default_parameter_ranges()
-    grid = _get_grid(param_ranges)
-    starts = _starts_from_grid(grid, mu_taus, sigma_taus, sigma_scale)
 
-    # 4. RUN
+    if isinstance(param_ranges, StartDesign):
+        lower, upper = _grid_bounds(
+            bounds, len(param_ranges.ranges), mu_taus, sigma_taus, sigma_scale
+        )
+        starts = np.concatenate(
+            [
+                _starts_from_grid(block, mu_taus, sigma_taus, sigma_scale)
+                for block in param_ranges.blocks(lower, upper)
+            ]
+        )
+    else:
+        grid = _get_grid(param_ranges)
+        starts = _starts_from_grid(grid, mu_taus, sigma_taus, sigma_scale)
+
+    return wrapped_minimizer, starts
 
-    print("STARTING GRID SEARCH FITTING PROCEDURE")
-    print("- Using {} cores in parallel".format(workers))
-    print("- Iterating over a total of {} initial starts".format(len(grid)))
 
-    print("Make a coffee. This might take a while...")
+class _ScreenChunk(object):
+    """ Picklable evaluation of the objective of a wrapped minimizer at a chunk of starts """
+
+    def __init__(self, wrapped_minimizer):
+        self.wrapped_minimizer = wrapped_minimizer
+
+    def __call__(self, X):
+        if isinstance(self.wrapped_minimizer.func, SRPObjective):
+            return self.wrapped_minimizer.func.loss_and_grad(X, jac=False)[0]
+        return np.array([_evaluate_objective(self.wrapped_minimizer, x) for x in X])
+
+
+def _screen_starts(
+    wrapped_minimizer, starts, n, diverse, scales, workers, memory_budget=2 ** 27
+):
+    """
+    Evaluates the objective at all starts in vectorized batches and selects the starts
+    to run local optimizations from.
+
+    :param wrapped_minimizer: instance of `MinimizeWrapper`
+    :param starts: array of initial starts
+    :param n: number of starts to select
+    :param diverse: select well-separated starts among the better half (see
+                    `_diverse_solutions`) instead of the `n` best starts
+    :param scales: typical scale of each parameter (see `_parameter_scales`)
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :param memory_budget: approximate memory (in bytes) available for one batch
+    :return: array of selected starts, best start first
+    """
+    if isinstance(wrapped_minimizer.func, SRPObjective):
+        chunks = _split_batches(wrapped_minimizer.func, starts, memory_budget)
+    else:
+        chunks = np.array_split(starts, max(1, len(starts) // 100))
+    fun = np.concatenate(_map_chunks(_ScreenChunk(wrapped_minimizer), chunks, workers))
+    fun = np.where(np.isnan(fun), np.inf, fun)
+
+    if diverse and np.any(np.isfinite(fun)):
+        return _diverse_solutions(starts, fun, scales, n)
+
+    return starts[np.argsort(fun, kind="stable")[:n]]
 
-    # CODE COPIED FROM SCIPY.OPTIMIZE.BRUTE:
-    # iterate over input arrays, possibly in parallel
-    with MapWrapper(pool=workers) as mapper:
-        listres = np.array(list(mapper(wrapped_minimizer, starts)))
 
-    fval = np.array(
-        [res["fun"] if res["success"] is True else np.nan for res in listres]
+class BasinClusters(object):
+    """
+    Online clustering of converged solutions into basins of attraction.
+    A solution joins the closest basin if it is within distance `tol` of the first solution of
+    that basin (in parameter space rescaled by `scales`, see `_parameter_scales`). Otherwise,
+    it joins the basin with the closest loss if the losses agree within the absolute tolerance
+    `ftol`, as converged solutions with the same loss often lie along flat, non-identifiable
+    directions of the loss landscape. The tolerance is absolute, such that distinct optima are
+    told apart independently of the scale of the loss (i.e. the number of observations).
+    Other solutions found a new basin.
+
+    Used as callback of `fit_srp_model_gridsearch`, the search is stopped once the estimated
+    probability that the next start finds an unseen basin with a lower loss than all basins
+    found so far is below `threshold` (see `p_unseen_better`).
+
+    :param scales: typical scale of each parameter
+    :param tol: distance below which solutions belong to the same basin
+    :param ftol: difference of the loss below which solutions belong to the same basin. The
+            default is well below differences of the NLL that distinguish optima, and above
+            the spread of the loss of loosely converged solutions.
+    :param threshold: Optional - probability of an unseen better basin below which the search
+            is stopped
+    """
+
+    def __init__(self, scales, tol=0.1, ftol=1e-2, threshold=None):
+        self.scales = np.asarray(scales, dtype=float)
+        self.tol = tol
+        self.ftol = ftol
+        self.threshold = threshold
+        self.centers = []
+        self.x = []
+        self.fun = []
+        self.counts = []
+
+    def _match(self, z, fun):
+        """ :return: index of the basin of a solution, None for a new basin """
+        if not self.centers:
+            return None
+
+        distance = np.linalg.norm(np.array(self.centers) - z, axis=1)
+        ix = int(np.argmin(distance))
+        if distance[ix] <= self.tol:
+            return ix
+
+        difference = np.abs(np.array(self.fun) - fun)
+        ix = int(np.argmin(difference))
+        if difference[ix] <= self.ftol:
+            return ix
+
+        return None
+
+    def add(self, res):
+        """
+        :param res: optimizer result
+        :return: index of the basin of `res` (-1 if it has not converged)
+        """
+        if res["success"] is not True:
+            return -1
+
+        z = np.ravel(res["x"]) / self.scales
+        ix = self._match(z, res["fun"])
+        if ix is None:
+            self.centers.append(z)
+            self.x.append(np.ravel(res["x"]))
+            self.fun.append(res["fun"])
+            self.counts.append(1)
+            return len(self.centers) - 1
+
+        self.counts[ix] += 1
+        if res["fun"] < self.fun[ix]:
+            self.x[ix] = np.ravel(res["x"])
+            self.fun[ix] = res["fun"]
+        return ix
+
+    def p_unseen_better(self):
+        """
+        Estimated probability that the next start converges to an unseen basin with a
+        lower loss than all basins found so far. The probability of an unseen basin is
+        the fraction of starts in basins that were found only once (Good-Turing estimate,
+        with add-one smoothing), and an unseen basin is equally likely to take any rank
+        among the w + 1 basins, i.e. to be the best one with probability 1 / (w + 1).
+
+        :return: probability
+        """
+        counts = np.array(self.counts)
+        n_singletons = np.count_nonzero(counts == 1)
+        p_unseen = (n_singletons + 1) / (counts.sum() + 1)
+        return p_unseen / (len(counts) + 1)
+
+    def summary(self):
+        """
+        :return: dictionary with the best solution `x`, loss `fun` and number of starts
+                 `count` of each basin, in the order the basins were found
+        """
+        return {
+            "x": np.array(self.x),
+            "fun": np.array(self.fun),
+            "count": np.array(self.counts, dtype=int),
+        }
+
+    def __call__(self, res, best):
+        self.add(res)
+        return self.threshold is not None and self.p_unseen_better() < self.threshold
+
+
+def _gridsearch_result(
+    listres, starts, mu_taus, sigma_taus, mu_scale, basin_tol=0.1, basin_ftol=1e-2
+):
+    """
+    Best solution of a gridsearch
+
+    :param listres: list of optimizer results of all starts (None for starts that were not run)
+    :param starts: array of initial starts
+    :param basin_tol: distance below which converged solutions belong to the same basin
+    :param basin_ftol: loss difference below which converged solutions belong to
+            the same basin (see `BasinClusters`)
+    :return: output of `fit_srp_model_gridsearch`
+    """
+    listres = [
+        res if res is not None else failed_result(x0, "Not run")
+        for res, x0 in zip(listres, starts)
+    ]
+
+    basins = BasinClusters(
+        _parameter_scales(mu_taus, sigma_taus), basin_tol, basin_ftol
     )
+    for res in listres:
+        res["basin"] = basins.add(res)
+    failed = [res for res in listres if res.get("failed", False)]
+    if failed:
+        print(
+            "- {} of {} starts failed or were not run".format(len(failed), len(listres))
+        )
+
+    table = ResultsTable.from_results(listres, starts)
+    fval = np.where(table["success"], table["fun"], np.nan)
+
+    if np.all(np.isnan(fval)):
+        # no start has converged: fall back to the best point of any start
+        print("- No start has converged, returning the best point evaluated")
+        if np.all(np.isnan(table["fun"])):
+            raise ValueError("All starts of the grid search failed")
+        bestsol_ix = np.nanargmin(table["fun"])
+    else:
+        bestsol_ix = np.nanargmin(fval)
 
-    bestsol_ix = np.nanargmin(fval)
     bestsol = listres[bestsol_ix]
     bestsol["initial_guess"] = starts[bestsol_ix]
+    bestsol["basins"] = basins.summary()
+    print("- Converged starts found {} distinct optima".format(len(basins.counts)))
 
     fitted_params = _convert_fitting_params(bestsol["x"], mu_taus, sigma_taus, mu_scale)
 
-    return fitted_params, bestsol, starts, fval, listres
+    return fitted_params, bestsol, starts, fval, table
 
 
-def fit_srp_model(
-    initial_guess,
-    stimulus_dict,
-    target_dict,
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# MAIN FITTING FUNCTIONS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def fit_srp_model_gridsearch(
+    stimulus_dict,
+    target_dict,
+    mu_taus,
+    sigma_taus,
+    param_ranges="default",
+    mu_scale=None,
+    sigma_scale=1,
+    bounds="default",
+    method="L-BFGS-B",
+    loss="default",
+    workers=1,
+    racing_rungs=None,
+    racing_keep=0.25,
+    screen=None,
+    screen_diverse=False,
+    stop_threshold=None,
+    basin_tol=0.1,
+    basin_ftol=1e-2,
+    seed=None,
+    checkpoint=None,
+    callback=None,
+    cache=None,
+    **kwargs
+):
+    """
+    Fitting the SRP model using a gridsearch.
+    Starts that raise an exception or whose worker crashes are recorded as failed
+    instead of aborting the gridsearch.
+
+    :param stimulus_dict: dictionary of protocol key - isivec mapping
+    :param target_dict: dictionary of protocol key - target amplitudes
+            (arrays, memory-mapped arrays or `ChunkedTargets`)
+    :param mu_taus: mu time constants
+    :param sigma_taus: sigma time constants
+    :param param_ranges: Optional - ranges of parameters in form of a tuple of slice objects,
+            or a `StartDesign` (e.g. `SobolDesign`) with a fixed number of starts
+    :param mu_scale: mu scale (defaults to None for normalized data)
+    :param sigma_scale: sigma scale in case param_ranges only covers 2 dimensions
+    :param bounds: bounds for parameters to be passed to minimizer function
+    :param method: algorithm for minimizer function
+    :param loss: type of loss to be used. One of:
+            'default':  Sum of squared error across all observations
+            'equal':    Assign equal weight to each stimulation protocol instead of each observation.
+                        This computes the mean squared error for each protocol separately.
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :param racing_rungs: Optional - list of iteration budgets for racing the starts
+            (successive halving). All starts are run for the first budget, the best
+            fraction `racing_keep` continues for the next budget and so on, before the
+            remaining starts are run to convergence. Defaults to None (no racing).
+    :param racing_keep: fraction of starts that survives each rung of the race
+    :param screen: Optional - number of starts to optimize. The loss at all grid points is
+            evaluated in vectorized batches first, and local optimizations are only run
+            from the best `screen` grid points. This allows for much denser grids at the
+            same cost. Defaults to None (optimize from all grid points).
+    :param screen_diverse: select well-separated grid points among the better half of the
+            screened grid points instead of the best ones
+    :param stop_threshold: Optional - stop launching starts once the estimated probability
+            that the next start finds an unseen basin with a lower loss is below this
+            threshold (see `BasinClusters`). Starts are run in random order, such that
+            the starts run before stopping cover the whole grid. Starts read from the
+            checkpoint or cache count towards the stop rule before new starts are run.
+    :param seed: Optional - seed of the random order of the starts with `stop_threshold`
+    :param basin_tol: distance below which converged solutions belong to the same basin,
+            in parameter space with amplitudes divided by their time constants
+    :param basin_ftol: loss difference below which converged solutions belong to
+            the same basin
+    :param checkpoint: Optional - `Checkpoint` or path of a journal file. Completed starts are
+            journaled as soon as they finish, such that an interrupted fit can be resumed
+            by calling this function again with the same checkpoint. The best solution so
+            far can be read at any time with `Checkpoint(path).best()`.
+    :param callback: Optional - function called with the result of each completed start
+            and the best successful result so far. If it returns True, the remaining starts
+            are not run and the best solution so far is returned.
+    :param cache: Optional - `FitCache` or directory of a cache. A fit with the same data
+            and settings returns the cached result, otherwise only starts that are not
+            in the cache are run.
+    :param kwargs: keyword args for the minimizer, and the budgets of each start:
+            max_time:   wall-clock budget in seconds
+            max_nfev:   number of objective function evaluations
+            Starts that exceed their budget return the best point they evaluated
+            and do not count as converged.
+    :return: fitted parameters, optimizer result of the best start, array of initial
+            starts, losses of all starts (NaN if not converged) and a `ResultsTable`
+            of all starts. The basin of each start is in the `basin` column of the table,
+            and the best solution of each basin in `basins` of the best optimizer result.
+            The table replaces the former list of optimizer results: iterating over it
+            or indexing it with an integer still yields one optimizer result per start,
+            `list(table)` restores the list.
+    """
+
+    mu_taus = np.atleast_1d(mu_taus)
+    sigma_taus = np.atleast_1d(sigma_taus)
+
+    if cache is not None:
+        if not isinstance(cache, FitCache):
+            cache = FitCache(cache)
+        fitkey = fit_key(
+            target_dict,
+            stimulus_dict,
+            mu_taus,
+            sigma_taus,
+            param_ranges,
+            mu_scale,
+            sigma_scale,
+            bounds,
+            method,
+            loss,
+            racing_rungs,
+            racing_keep,
+            screen,
+            screen_diverse,
+            stop_threshold,
+            basin_tol,
+            basin_ftol,
+            seed,
+            sorted(kwargs.items()),
+        )
+        result = cache.scoped("fit_srp_model_gridsearch").get(fitkey)
+        if result is not None:
+            print("Loaded grid search result from cache {}".format(cache.path))
+            return result
+
+    wrapped_minimizer, starts = _setup_gridsearch(
+        stimulus_dict,
+        target_dict,
+        mu_taus,
+        sigma_taus,
+        param_ranges,
+        mu_scale,
+        sigma_scale,
+        bounds,
+        method,
+        loss,
+        **kwargs
+    )
+
+    # RUN
+
+    print("STARTING GRID SEARCH FITTING PROCEDURE")
+    print("- Using {} cores in parallel".format(workers))
+
+    if screen is not None and screen < len(starts):
+        print("- Screening the loss at {} grid points".format(len(starts)))
+        starts = _screen_starts(
+            wrapped_minimizer,
+            starts,
+            screen,
+            screen_diverse,
+            _parameter_scales(mu_taus, sigma_taus),
+            workers,
+        )
+
+    print("- Iterating over a total of {} initial starts".format(len(starts)))
+
+    if stop_threshold is not None:
+        # starts in random order, such that stopping early does not leave out parts of the grid
+        starts = starts[np.random.default_rng(seed).permutation(len(starts))]
+        basins = BasinClusters(
+            _parameter_scales(mu_taus, sigma_taus),
+            basin_tol,
+            basin_ftol,
+            stop_threshold,
+        )
+        user_callback = callback
+
+        def preloaded(res, best):
+            # starts completed before (checkpoint or cache) count towards the stop rule
+            stop = basins(res, best)
+            if stop:
+                print(
+                    "- {} starts converged to {} distinct optima: the probability of an "
+                    "unseen better optimum is {:.2g}".format(
+                        sum(basins.counts),
+                        len(basins.counts),
+                        basins.p_unseen_better(),
+                    )
+                )
+            return stop
+
+        def callback(res, best):
+            stop = preloaded(res, best)
+            if user_callback is not None and user_callback(res, best):
+                return True
+            return stop
+
+    else:
+        preloaded = None
+
+    if checkpoint is not None:
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        print("- Journaling completed starts to {}".format(checkpoint.path))
+
+    print("Make a coffee. This might take a while...")
+
+    if racing_rungs is None:
+        listres = _map_starts(
+            wrapped_minimizer, starts, workers, checkpoint, callback, cache, preloaded
+        )
+    else:
+        print("- Racing starts over iteration budgets {}".format(racing_rungs))
+        listres = _race_starts(
+            wrapped_minimizer,
+            starts,
+            racing_rungs,
+            racing_keep,
+            workers,
+            checkpoint,
+            callback,
+            cache,
+            preloaded,
+        )
+
+    result = _gridsearch_result(
+        listres, starts, mu_taus, sigma_taus, mu_scale, basin_tol, basin_ftol
+    )
+    if cache is not None and _reproducible(listres):
+        cache.scoped("fit_srp_model_gridsearch").save(fitkey, result)
+
+    return result
+
+
+def _reproducible(listres):
+    """
+    :return: True if all starts were run, none failed and none depends on the wall-clock time
+    """
+    return all(
+        res is not None
+        and not res.get("lost", False)
+        and not res.get("failed", False)
+        and not res.get("budget_exceeded", False)
+        for res in listres
+    )
+
+
+def _evaluate_objective(wrapped_minimizer, x):
+    """
+    :param wrapped_minimizer: instance of `MinimizeWrapper`
+    :param x: parameters
+    :return: value of the objective function of the minimizer at `x`
+    """
+    value = wrapped_minimizer.func(x, *wrapped_minimizer.args)
+    if wrapped_minimizer.kwargs.get("jac") is True:
+        # objective also returns its gradient
+        return value[0]
+    return value
+
+
+def _diverse_solutions(x, fun, scales, n):
+    """
+    Selects distinct solutions: the best solution, then greedily the solution farthest from
+    all selected ones (in parameter space rescaled by `scales`), among the better half of
+    all finite solutions.
+
+    :param x: array of parameter vectors
+    :param fun: function values of the parameter vectors
+    :param scales: typical scale of each parameter (see `_parameter_scales`)
+    :param n: maximum number of solutions
+    :return: array of parameter vectors, best solution first
+    """
+    order = np.argsort(fun)
+    order = order[np.isfinite(np.asarray(fun)[order])]
+    candidates = np.asarray(x)[order[: max(1, len(order) // 2)]] / scales
+
+    selected = [0]
+    distance = np.linalg.norm(candidates - candidates[0], axis=1)
+    while len(selected) < min(n, len(candidates)) and distance.max() > 0:
+        ix = int(np.argmax(distance))
+        selected.append(ix)
+        distance = np.minimum(
+            distance, np.linalg.norm(candidates - candidates[ix], axis=1)
+        )
+
+    return candidates[selected] * scales
+
+
+def _chain_score(res):
+    """ :return: loss of a local minimization, infinite if it did not converge """
+    return res["fun"] if res["success"] is True else np.inf
+
+
+def fit_srp_model_basinhopping(
+    stimulus_dict,
+    target_dict,
+    mu_taus,
+    sigma_taus,
+    param_ranges="default",
+    n_chains=8,
+    niter=20,
+    T=1.0,
+    max_stepsize="default",
+    prune_tol=0.05,
+    niter_success=None,
+    mu_scale=None,
+    sigma_scale=1,
+    bounds="default",
+    method="L-BFGS-B",
+    loss="default",
+    workers=1,
+    seed=None,
+    checkpoint=None,
+    cache=None,
+    **kwargs
+):
+    """
+    Fitting the SRP model using parallel basin-hopping.
+
+    Independent chains of local minimizations start from well-separated grid points
+    (see `screen_diverse` in `fit_srp_model_gridsearch`). In each step, every chain displaces
+    its current minimum at random (see `RandomDisplacement`), the local minimizations of all
+    chains run in parallel, and each chain accepts its new minimum with the Metropolis
+    criterion. After each step, chains whose best loss is worse than the best loss of all
+    chains by more than `prune_tol` are stopped.
+
+    :param stimulus_dict: dictionary of protocol key - isivec mapping
+    :param target_dict: dictionary of protocol key - target amplitudes
+    :param mu_taus: mu time constants
+    :param sigma_taus: sigma time constants
+    :param param_ranges: Optional - ranges of parameters in form of a tuple of slice objects,
+            or a `StartDesign`. The chains start from `n_chains` of these starts.
+    :param n_chains: number of chains
+    :param niter: maximum number of basin-hopping steps of each chain
+    :param T: temperature of the Metropolis criterion (in units of the loss)
+    :param max_stepsize: maximum displacement of each parameter (see `RandomDisplacement`)
+    :param prune_tol: relative loss difference to the best chain above which chains are stopped
+    :param niter_success: Optional - stop a chain if its best loss has not improved
+            for this number of steps
+    :param mu_scale: mu scale (defaults to None for normalized data)
+    :param sigma_scale: sigma scale in case param_ranges only covers 2 dimensions
+    :param bounds: bounds for parameters to be passed to minimizer function and of the
+            displacements
+    :param method: algorithm for minimizer function
+    :param loss: type of loss to be used (see `fit_srp_model_gridsearch`)
+    :param workers: number of processors, an `Executor` or a map-like callable.
+            A `FitExecutor` keeps its worker processes across steps.
+    :param seed: Optional - seed of the random displacements and acceptance
+    :param checkpoint: Optional - `Checkpoint` or path of a journal file. Completed local
+            minimizations are journaled, such that an interrupted fit with the same seed
+            resumes by calling this function again with the same checkpoint.
+    :param cache: Optional - `FitCache` or directory of a cache of local minimizations
+    :param kwargs: keyword args for the minimizer, and the budgets of each local
+            minimization (see `fit_srp_model_gridsearch`)
+    :return: output of `fit_srp_model_gridsearch` for all local minimizations
+    """
+    mu_taus = np.atleast_1d(mu_taus)
+    sigma_taus = np.atleast_1d(sigma_taus)
+    if bounds == "default":
+        bounds = _default_parameter_bounds(mu_taus, sigma_taus)
+
+    wrapped_minimizer, starts = _setup_gridsearch(
+        stimulus_dict,
+        target_dict,
+        mu_taus,
+        sigma_taus,
+        param_ranges,
+        mu_scale,
+        sigma_scale,
+        bounds,
+        method,
+        loss,
+        **kwargs
+    )
+    if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+        checkpoint = Checkpoint(checkpoint)
+    if cache is not None and not isinstance(cache, FitCache):
+        cache = FitCache(cache)
+
+    print("STARTING BASIN-HOPPING FITTING PROCEDURE")
+    print("- Using {} cores in parallel".format(workers))
+
+    if n_chains < len(starts):
+        print("- Screening the loss at {} grid points".format(len(starts)))
+        starts = _screen_starts(
+            wrapped_minimizer,
+            starts,
+            n_chains,
+            True,
+            _parameter_scales(mu_taus, sigma_taus),
+            workers,
+        )
+    print("- Running {} chains of up to {} steps".format(len(starts), niter))
+
+    rng = np.random.default_rng(seed)
+    displace = RandomDisplacement(
+        bounds, max_stepsize, mu_taus, sigma_taus, disp=False, seed=rng
+    )
+
+    allstarts = list(starts)
+    listres = _map_starts(wrapped_minimizer, starts, workers, checkpoint, cache=cache)
+    current = list(listres)
+    best = list(listres)
+    stale = np.zeros(len(starts), dtype=int)
+    alive = np.ones(len(starts), dtype=bool)
+
+    for step in range(niter):
+        # shared best-so-far: stop chains that are far from the best chain
+        chain_best = np.array([_chain_score(res) for res in best])
+        best_fun = chain_best.min()
+        if np.isfinite(best_fun):
+            alive &= chain_best <= best_fun + prune_tol * np.abs(best_fun)
+        active = np.flatnonzero(alive)
+        if len(active) == 0:
+            break
+
+        proposals = np.array([displace(current[ix]["x"]) for ix in active])
+        stepres = _map_starts(
+            wrapped_minimizer, proposals, workers, checkpoint, cache=cache
+        )
+        allstarts.extend(proposals)
+        listres.extend(stepres)
+
+        for ix, res in zip(active, stepres):
+            new, old = _chain_score(res), _chain_score(current[ix])
+            # Metropolis criterion
+            if new <= old or (
+                np.isfinite(new) and rng.random() < np.exp(-(new - old) / T)
+            ):
+                current[ix] = res
+
+            if new < _chain_score(best[ix]):
+                best[ix] = res
+                stale[ix] = 0
+            else:
+                stale[ix] += 1
+                if niter_success is not None and stale[ix] >= niter_success:
+                    alive[ix] = False
+
+        print(
+            "- Step {}: {} chains, best loss {:.6g}".format(
+                step + 1, len(active), min(_chain_score(res) for res in best)
+            )
+        )
+
+    print("- Ran {} local minimizations".format(len(listres)))
+    return _gridsearch_result(
+        listres, np.array(allstarts), mu_taus, sigma_taus, mu_scale
+    )
+
+
+def fit_srp_model_crossvalidation(
+    stimulus_dict,
+    target_dict,
+    mu_taus,
+    sigma_taus,
+    test_keys=None,
+    param_ranges="default",
+    mu_scale=None,
+    sigma_scale=1,
+    bounds="default",
+    method="L-BFGS-B",
+    loss="default",
+    workers=1,
+    n_warm_starts=4,
+    restart_tol=1e-3,
+    cache=None,
+    **kwargs
+):
+    """
+    Leave-one-protocol-out cross-validation of the SRP model with warm-started folds.
+
+    The model is fitted to all protocols with a gridsearch once. The training set of each
+    fold differs from the full dataset by one protocol only, so its optimum lies in one of the
+    basins found by the full gridsearch. All local optima of the full gridsearch are ranked by
+    the loss of the fold (one function evaluation each), and the fold is fitted with local
+    refinements from the best and a few other diverse optima. A fold is refitted with the full
+    gridsearch if the refinement of the best-ranked optimum does not converge, or if another
+    start beats it by more than `restart_tol` (relative), which indicates that holding out
+    the protocol changed the loss landscape.
+
+    :param stimulus_dict: dictionary of protocol key - isivec mapping
+    :param target_dict: dictionary of protocol key - target amplitudes
+    :param mu_taus: mu time constants
+    :param sigma_taus: sigma time constants
+    :param test_keys: Optional - protocol keys to hold out (defaults to all protocols)
+    :param param_ranges: Optional - ranges of parameters in form of a tuple of slice objects
+    :param mu_scale: mu scale (defaults to None for normalized data)
+    :param sigma_scale: sigma scale in case param_ranges only covers 2 dimensions
+    :param bounds: bounds for parameters to be passed to minimizer function
+    :param method: algorithm for minimizer function
+    :param loss: type of loss to be used (see `fit_srp_model_gridsearch`)
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :param n_warm_starts: number of warm starts per fold
+    :param restart_tol: relative improvement of a diverse start over the best-ranked start
+            above which the fold is refitted with the full gridsearch
+    :param cache: Optional - `FitCache` or directory of a cache (see `fit_srp_model_gridsearch`)
+    :param kwargs: keyword args to be passed to the minimizer function. With the built-in
+            losses and L-BFGS-B, all folds are optimized jointly from cached per-protocol
+            loss contributions (see `CrossValidationObjective`) using the batched L-BFGS
+            method, which takes the `options` of the minimizer. Folds are optimized with
+            scipy if other keyword args or options the batched method does not support
+            (e.g. maxfun or eps) are given.
+    :return: fitted parameters and best solution on all protocols, dictionaries mapping
+             held-out protocols to fitted parameters and best solutions of the folds.
+             Best solutions of the folds have an entry `grid_restart`.
+    """
+    mu_taus = np.atleast_1d(mu_taus)
+    sigma_taus = np.atleast_1d(sigma_taus)
+    test_keys = list(target_dict.keys() if test_keys is None else test_keys)
+
+    if cache is not None:
+        if not isinstance(cache, FitCache):
+            cache = FitCache(cache)
+        fitkey = fit_key(
+            target_dict,
+            stimulus_dict,
+            mu_taus,
+            sigma_taus,
+            test_keys,
+            param_ranges,
+            mu_scale,
+            sigma_scale,
+            bounds,
+            method,
+            loss,
+            n_warm_starts,
+            restart_tol,
+            sorted(kwargs.items()),
+        )
+        result = cache.scoped("fit_srp_model_crossvalidation").get(fitkey)
+        if result is not None:
+            print("Loaded cross-validation result from cache {}".format(cache.path))
+            return result
+
+    # 1. FIT ALL PROTOCOLS
+    fitted_params, bestsol, starts, _, table = fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        mu_taus,
+        sigma_taus,
+        param_ranges=param_ranges,
+        mu_scale=mu_scale,
+        sigma_scale=sigma_scale,
+        bounds=bounds,
+        method=method,
+        loss=loss,
+        workers=workers,
+        cache=cache,
+        **kwargs
+    )
+    optima = table["x"][table["success"]]
+
+    # Built-in losses: all folds are derived from cached per-protocol contributions
+    # and optimized jointly with the batched L-BFGS method. Other minimizer arguments and
+    # options that the batched method does not support fall back to scipy.
+    batched = (
+        not callable(loss)
+        and method == "L-BFGS-B"
+        and set(kwargs) <= {"options"}
+        and set(kwargs.get("options", {})) <= set(_BATCH_OPTIONS)
+    )
+    if batched:
+        crossvalidation = CrossValidationObjective(
+            SRPObjective(
+                stimulus_dict, target_dict, mu_taus, sigma_taus, mu_scale, loss
+            ),
+            test_keys,
+        )
+        batch_bounds = (
+            _default_parameter_bounds(mu_taus, sigma_taus)
+            if bounds == "default"
+            else bounds
+        )
+
+    wrapped_minimizers = {}
+
+    def fold_minimizer(testkey):
+        """ wrapped minimizer of a fold, fitted to all protocols except `testkey` """
+        if testkey not in wrapped_minimizers:
+            train_dict = {
+                key: val for key, val in target_dict.items() if key != testkey
+            }
+            wrapped_minimizers[testkey], _ = _setup_gridsearch(
+                stimulus_dict,
+                train_dict,
+                mu_taus,
+                sigma_taus,
+                param_ranges,
+                mu_scale,
+                sigma_scale,
+                bounds,
+                method,
+                loss,
+                **kwargs
+            )
+        return wrapped_minimizers[testkey]
+
+    def map_folds(fold_starts):
+        """ runs the minimizer of each fold from its starts, in parallel over the starts """
+        return {
+            testkey: _map_starts(fold_minimizer(testkey), x0, workers, cache=cache)
+            for testkey, x0 in fold_starts.items()
+        }
+
+    def run_folds(fold_starts):
+        """ runs the minimizer of each fold from its (few) warm starts """
+        if not fold_starts:
+            return {}
+        if not batched:
+            return map_folds(fold_starts)
+
+        folds = np.concatenate(
+            [
+                np.full(len(x0), test_keys.index(testkey))
+                for testkey, x0 in fold_starts.items()
+            ]
+        )
+        results = _minimize_batch(
+            lambda X, rows: crossvalidation.loss_and_grad(X, folds[rows]),
+            np.concatenate(list(fold_starts.values())),
+            batch_bounds,
+            **kwargs.get("options", {})
+        )
+        split = np.cumsum([len(x0) for x0 in fold_starts.values()])[:-1]
+        return dict(zip(fold_starts, np.split(np.array(results), split)))
+
+    if len(optima) == 0:
+        # no local optimum of the full data to warm-start the folds from
+        print("- No start converged on all protocols, no warm starts for the folds")
+        warm_starts = {testkey: starts[:0] for testkey in test_keys}
+        warm_res = {testkey: [] for testkey in test_keys}
+        restarts = list(test_keys)
+
+    else:
+        # 2. WARM-STARTED FOLDS
+        # rank the local optima of the full data by the loss of each fold
+        if batched:
+            fold_loss = crossvalidation.fold_losses(optima).T
+        else:
+            fold_loss = np.array(
+                [
+                    [_evaluate_objective(fold_minimizer(testkey), x) for x in optima]
+                    for testkey in test_keys
+                ]
+            )
+
+        warm_starts = {
+            testkey: _diverse_solutions(
+                optima,
+                fold_loss[fold],
+                _parameter_scales(mu_taus, sigma_taus),
+                n_warm_starts,
+            )
+            for fold, testkey in enumerate(test_keys)
+        }
+        print("- Refining {} folds from warm starts".format(len(test_keys)))
+        warm_res = run_folds(warm_starts)
+
+        # folds whose best-ranked warm start did not converge or was beaten
+        restarts = []
+        for testkey in test_keys:
+            fval = np.array(
+                [
+                    res["fun"] if res["success"] is True else np.nan
+                    for res in warm_res[testkey]
+                ]
+            )
+            if np.isnan(fval[0]) or (
+                fval[0] - np.nanmin(fval) > restart_tol * np.abs(np.nanmin(fval))
+            ):
+                restarts.append(testkey)
+
+    # 3. FULL GRIDSEARCH FOR FOLDS WITH A CHANGED LOSS LANDSCAPE
+    # (one task per start, such that the grid is spread over the workers and cached per start)
+    if restarts:
+        print("- Running the full gridsearch for {}".format(restarts))
+    grid_res = map_folds({testkey: starts for testkey in restarts})
+
+    fold_params = {}
+    fold_bestsols = {}
+    for testkey in test_keys:
+        if testkey in grid_res:
+            result = _gridsearch_result(
+                [*warm_res[testkey], *grid_res[testkey]],
+                np.concatenate([warm_starts[testkey], starts]),
+                mu_taus,
+                sigma_taus,
+                mu_scale,
+            )
+        else:
+            result = _gridsearch_result(
+                warm_res[testkey], warm_starts[testkey], mu_taus, sigma_taus, mu_scale
+            )
+
+        fold_params[testkey] = result[0]
+        fold_bestsols[testkey] = result[1]
+        fold_bestsols[testkey]["grid_restart"] = testkey in grid_res
+
+    result = fitted_params, bestsol, fold_params, fold_bestsols
+    if cache is not None:
+        cache.scoped("fit_srp_model_crossvalidation").save(fitkey, result)
+
+    return result
+
+
+def _laplace_approximation(objective, x, bounds, level=0.95):
+    """
+    Laplace approximation of the posterior of the parameters around the maximum likelihood
+    estimate: the covariance is the inverse of the Hessian of the NLL. Parameters at one of
+    their bounds are treated as fixed (zero variance).
+
+    :param objective: instance of `SRPObjective` with the default loss (NLL)
+    :param x: maximum likelihood estimate
+    :param bounds: parameter bounds
+    :param level: confidence level of the prediction bands
+    :return: dictionary with the Hessian, covariance, standard errors and, for each protocol,
+             prediction bands of the mean response (rows: lower bound, mean, upper bound)
+    """
+    x = np.asarray(x, dtype=float)
+    lower, upper = _bounds_to_arrays(bounds, len(x))
+    tol = 1e-8 * (1 + np.abs(x))
+    free = (x - lower > tol) & (upper - x > tol)
+
+    hessian = objective.hessian(x)
+    covariance = np.zeros(hessian.shape)
+    # pseudo-inverse: parameters that are not identifiable get no (infinite) variance
+    covariance[np.ix_(free, free)] = np.linalg.pinv(hessian[np.ix_(free, free)])
+
+    z = ndtri(0.5 + level / 2)
+    bands = {}
+    for key in objective.keys:
+        mu, jacobian = objective.mean_and_jacobian(x, key)
+        stderr = np.sqrt(
+            np.maximum(np.einsum("ip,pq,iq->i", jacobian, covariance, jacobian), 0)
+        )
+        bands[key] = np.array([mu - z * stderr, mu, mu + z * stderr])
+
+    return {
+        "hessian": hessian,
+        "covariance": covariance,
+        "stderr": np.sqrt(np.maximum(np.diag(covariance), 0)),
+        "prediction_bands": bands,
+    }
+
+
+def fit_srp_model(
+    initial_guess,
+    stimulus_dict,
+    target_dict,
     mu_taus,
     sigma_taus,
     mu_scale=None,
     bounds="default",
     loss="default",
     algo="L-BFGS-B",
+    uncertainty=False,
+    level=0.95,
     **kwargs
 ):
     """
@@ -466,6 +2728,7 @@ def fit_srp_model(
 
     :param stimulus_dict: mapping of protocol keys to isi stimulation vectors
     :param target_dict: mapping of protocol keys to response matrices
+            (arrays, memory-mapped arrays or `ChunkedTargets`)
     :param mu_taus: predefined time constants for mean kernel
     :param sigma_taus: predefined time constants for sigma kernel
     :param mu_scale: mean scale, defaults to None for normalized data
@@ -475,6 +2738,12 @@ def fit_srp_model(
             'equal':    Assign equal weight to each stimulation protocol instead of each observation.
                         This computes the mean squared error for each protocol separately.
     :param algo: Algorithm for fitting procedure
+    :param uncertainty: Laplace approximation of the parameter uncertainty (requires the
+            default loss, i.e. the NLL). The optimizer result then also contains the
+            `hessian` of the NLL at the optimum, the parameter `covariance`, standard errors
+            `stderr` and `prediction_bands` of the mean response for each protocol
+            (rows: lower bound, mean, upper bound).
+    :param level: confidence level of the prediction bands
     :param kwargs: keyword args to be passed to scipy.optimize.brute
     :return: output of scipy.minimize
     """
@@ -485,15 +2754,624 @@ def fit_srp_model(
     if bounds == "default":
         bounds = _default_parameter_bounds(mu_taus, sigma_taus)
 
+    if uncertainty and loss != "default":
+        raise ValueError("The Laplace approximation requires the default loss (NLL)")
+
+    objective, args, jac = _make_objective(
+        stimulus_dict, target_dict, mu_taus, sigma_taus, mu_scale, loss
+    )
     optimizer_res = minimize(
-        _objective_function,
+        objective,
         x0=initial_guess,
         method=algo,
+        jac=jac,
         bounds=bounds,
-        args=(target_dict, stimulus_dict, mu_taus, sigma_taus, mu_scale, loss),
+        args=args,
+        **kwargs
+    )
+
+    params = _convert_fitting_params(optimizer_res["x"], mu_taus, sigma_taus, mu_scale)
+
+    if uncertainty:
+        optimizer_res.update(
+            _laplace_approximation(objective, optimizer_res["x"], bounds, level)
+        )
+
+    return params, optimizer_res
+
+
+def fit_srp_model_batch(
+    stimulus_dict,
+    target_dicts,
+    mu_taus,
+    sigma_taus,
+    initial_guess=None,
+    param_ranges="default",
+    mu_scale=None,
+    sigma_scale=1,
+    bounds="default",
+    loss="default",
+    options=None,
+):
+    """
+    Fitting the SRP model to many cells in one vectorized optimization.
+
+    Independent parameter vectors for all cells (and, if no initial guess is given,
+    for all starts of the parameter grid of each cell) are optimized simultaneously
+    with a batched L-BFGS method. Finished problems are dropped from the active set.
+
+    :param stimulus_dict: mapping of protocol keys to isi stimulation vectors (shared by all cells)
+    :param target_dicts: list of mappings of protocol keys to response matrices, one per cell
+    :param mu_taus: mu time constants
+    :param sigma_taus: sigma time constants
+    :param initial_guess: Optional - list of parameters
+            [mu_baseline, *mu_amps,sigma_baseline, *sigma_amps, sigma_scale]
+            used for all cells, or array of shape [n_cells, n_params].
+            Defaults to None, in which case each cell is fitted from every start of the grid.
+    :param param_ranges: Optional - ranges of parameters in form of a tuple of slice objects
+    :param mu_scale: mu scale (defaults to None for normalized data)
+    :param sigma_scale: sigma scale in case param_ranges only covers 2 dimensions
+    :param bounds: bounds for parameters
+    :param loss: type of loss to be used. One of:
+            'default':  NLL across all observations
+            'equal':    Assign equal weight to each stimulation protocol instead of each observation.
+    :param options: dictionary of optimizer options (maxiter, ftol, gtol, maxcor, maxls, disp).
+            Other options raise a ValueError.
+    :return: list of fitted parameters and list of best optimizer results, one per cell
+    """
+
+    mu_taus = np.atleast_1d(mu_taus)
+    sigma_taus = np.atleast_1d(sigma_taus)
+
+    if bounds == "default":
+        bounds = _default_parameter_bounds(mu_taus, sigma_taus)
+
+    objective = SRPObjective(
+        stimulus_dict, target_dicts, mu_taus, sigma_taus, mu_scale, loss
+    )
+    ncells = objective.ncells
+
+    # Stack initializations of all cells
+    if initial_guess is None:
+        if param_ranges == "default":
+            param_ranges = _default_parameter_ranges()
+        grid_starts = _starts_from_grid(
+            _get_grid(param_ranges), mu_taus, sigma_taus, sigma_scale
+        )
+        starts = np.tile(grid_starts, (ncells, 1))
+        cells = np.repeat(np.arange(ncells), len(grid_starts))
+    else:
+        starts = np.atleast_2d(np.asarray(initial_guess, dtype=float))
+        if len(starts) == 1:
+            starts = np.repeat(starts, ncells, axis=0)
+        cells = np.arange(ncells)
+
+    print("STARTING BATCH FITTING PROCEDURE")
+    print("- Fitting {} cells from {} initial starts".format(ncells, len(starts)))
+
+    listres = _minimize_batch(
+        lambda X, rows: objective.loss_and_grad(X, cells[rows]),
+        starts,
+        bounds,
+        **(options or {})
+    )
+
+    # Best solution per cell
+    fitted_params = []
+    bestsols = []
+    for cell in range(ncells):
+        rows = np.where(cells == cell)[0]
+        fval = np.array(
+            [listres[i]["fun"] if listres[i]["success"] else np.nan for i in rows]
+        )
+        if np.all(np.isnan(fval)):
+            fval = np.array([listres[i]["fun"] for i in rows])
+
+        bestsol_ix = rows[np.nanargmin(fval)]
+        bestsol = listres[bestsol_ix]
+        bestsol["initial_guess"] = starts[bestsol_ix]
+
+        bestsols.append(bestsol)
+        fitted_params.append(
+            _convert_fitting_params(bestsol["x"], mu_taus, sigma_taus, mu_scale)
+        )
+
+    return fitted_params, bestsols
+
+
+def fit_srp_model_hierarchical(
+    initial_guess,
+    stimulus_dict,
+    target_dicts,
+    mu_taus,
+    sigma_taus,
+    shared=("mu_amps", "sigma_amps"),
+    mu_scale=None,
+    bounds="default",
+    loss="default",
+    algo="L-BFGS-B",
+    **kwargs
+):
+    """
+    Fitting the SRP model jointly to many cells, with parameters that are
+    shared across cells (by default the kernel amplitudes, i.e. the kernel shape)
+    and parameters that are fitted for every cell (by default baselines and sigma scale).
+    All cells are fitted in a single optimization.
+
+    :param initial_guess: list of parameters:
+            [mu_baseline, *mu_amps,sigma_baseline, *sigma_amps, sigma_scale]
+            used for all cells, or array of shape [n_cells, n_params]
+
+    :param stimulus_dict: mapping of protocol keys to isi stimulation vectors (shared by all cells)
+    :param target_dicts: list of mappings of protocol keys to response matrices, one per cell
+    :param mu_taus: predefined time constants for mean kernel
+    :param sigma_taus: predefined time constants for sigma kernel
+    :param shared: parameter groups shared across cells. Any of
+            'mu_baseline', 'mu_amps', 'sigma_baseline', 'sigma_amps', 'sigma_scale'
+    :param mu_scale: mean scale, defaults to None for normalized data
+    :param bounds: bounds for parameters
+    :param loss: type of loss to be used. One of:
+            'default':  NLL across all observations
+            'equal':    Assign equal weight to each stimulation protocol instead of each observation.
+    :param algo: Algorithm for fitting procedure
+    :param kwargs: keyword args to be passed to scipy.optimize.minimize
+    :return: list of fitted parameters (one per cell) and output of scipy.minimize
+    """
+
+    mu_taus = np.atleast_1d(mu_taus)
+    sigma_taus = np.atleast_1d(sigma_taus)
+
+    if bounds == "default":
+        bounds = _default_parameter_bounds(mu_taus, sigma_taus)
+
+    objective = HierarchicalSRPObjective(
+        stimulus_dict,
+        target_dicts,
+        mu_taus,
+        sigma_taus,
+        mu_scale=mu_scale,
+        loss=loss,
+        shared=shared,
+    )
+
+    optimizer_res = minimize(
+        objective,
+        x0=objective.to_joint(initial_guess),
+        method=algo,
+        jac=True,
+        bounds=objective.joint_bounds(bounds),
         **kwargs
     )
 
+    params = [
+        _convert_fitting_params(x, mu_taus, sigma_taus, mu_scale)
+        for x in objective.to_cells(optimizer_res["x"])
+    ]
+
+    return params, optimizer_res
+
+
+def fit_srp_model_stochastic(
+    initial_guess,
+    stimulus_dict,
+    target_dict,
+    mu_taus,
+    sigma_taus,
+    mu_scale=None,
+    bounds="default",
+    loss="default",
+    segment_length=1000,
+    batch_size=8,
+    epochs=5,
+    method="adam",
+    learning_rate=None,
+    polish=True,
+    seed=None,
+    disp=False,
+    **kwargs
+):
+    """
+    Fitting the SRP model to long recordings using minibatch stochastic optimization.
+
+    Stimulus trains are split into contiguous segments that carry over the kernel state
+    from preceding spikes. Stochastic steps are taken on random minibatches of segments,
+    followed by a final full-batch polish with scipy.optimize.minimize.
+
+    :param initial_guess: list of parameters:
+            [mu_baseline, *mu_amps,sigma_baseline, *sigma_amps, sigma_scale]
+
+    :param stimulus_dict: mapping of protocol keys to isi stimulation vectors
+    :param target_dict: mapping of protocol keys to response matrices
+    :param mu_taus: predefined time constants for mean kernel
+    :param sigma_taus: predefined time constants for sigma kernel
+    :param mu_scale: mean scale, defaults to None for normalized data
+    :param bounds: bounds for parameters
+    :param loss: type of loss to be used. One of:
+            'default':  NLL across all observations
+            'equal':    Assign equal weight to each stimulation protocol instead of each observation.
+    :param segment_length: number of stimuli per segment
+    :param batch_size: number of segments per minibatch
+    :param epochs: number of passes over all segments
+    :param method: 'adam' or 'svrg' (stochastic variance-reduced gradient)
+    :param learning_rate: step size of the stochastic optimizer.
+            Defaults to 0.01 for 'adam' and 0.002 for 'svrg'
+    :param polish: finish with a full-batch L-BFGS-B optimization
+    :param seed: seed for the random order of segments
+    :param disp: print progress
+    :param kwargs: keyword args to be passed to scipy.optimize.minimize for the polish
+    :return: fitted parameters and optimizer result
+    """
+
+    mu_taus = np.atleast_1d(mu_taus)
+    sigma_taus = np.atleast_1d(sigma_taus)
+
+    if bounds == "default":
+        bounds = _default_parameter_bounds(mu_taus, sigma_taus)
+
+    objective = SRPObjective(
+        stimulus_dict, target_dict, mu_taus, sigma_taus, mu_scale, loss
+    )
+
+    x, data_passes = _minimize_stochastic(
+        objective.segment(segment_length),
+        initial_guess,
+        bounds,
+        _parameter_scales(mu_taus, sigma_taus),
+        batch_size=batch_size,
+        epochs=epochs,
+        method=method,
+        learning_rate=learning_rate,
+        seed=seed,
+        disp=disp,
+    )
+
+    if polish:
+        optimizer_res = minimize(
+            objective, x0=x, method="L-BFGS-B", jac=True, bounds=bounds, **kwargs
+        )
+        data_passes += optimizer_res["nfev"]
+    else:
+        fun, jac = objective(x)
+        optimizer_res = OptimizeResult(
+            x=x, fun=fun, jac=jac, success=True, message="Stochastic optimization"
+        )
+        data_passes += 1
+
+    optimizer_res["data_passes"] = data_passes
     params = _convert_fitting_params(optimizer_res["x"], mu_taus, sigma_taus, mu_scale)
 
     return params, optimizer_res
+
+
+class IncrementalSRPFit(object):
+    """
+    Incremental fitting of the SRP model as new sweeps are recorded.
+
+    Per-protocol sufficient statistics are updated with every batch of new sweeps
+    and the model is re-fitted with a warm start from the previous optimum.
+    The cost of an update therefore does not depend on the total amount of accumulated data.
+
+    :param initial_guess: list of parameters:
+            [mu_baseline, *mu_amps,sigma_baseline, *sigma_amps, sigma_scale]
+    :param stimulus_dict: mapping of protocol keys to isi stimulation vectors
+    :param mu_taus: predefined time constants for mean kernel
+    :param sigma_taus: predefined time constants for sigma kernel
+    :param target_dict: Optional - mapping of protocol keys to already recorded response matrices
+    :param mu_scale: mean scale, defaults to None for normalized data
+    :param bounds: bounds for parameters
+    :param loss: type of loss to be used. One of:
+            'default':  NLL across all observations
+            'equal':    Assign equal weight to each stimulation protocol instead of each observation.
+    :param kwargs: keyword args to be passed to scipy.optimize.minimize
+    """
+
+    def __init__(
+        self,
+        initial_guess,
+        stimulus_dict,
+        mu_taus,
+        sigma_taus,
+        target_dict=None,
+        mu_scale=None,
+        bounds="default",
+        loss="default",
+        **kwargs
+    ):
+
+        self.stimulus_dict = stimulus_dict
+        self.mu_taus = np.atleast_1d(mu_taus)
+        self.sigma_taus = np.atleast_1d(sigma_taus)
+        self.mu_scale = mu_scale
+        self.kwargs = kwargs
+
+        if bounds == "default":
+            bounds = _default_parameter_bounds(self.mu_taus, self.sigma_taus)
+        self.bounds = bounds
+
+        self.objective = SRPObjective(
+            stimulus_dict,
+            target_dict or {},
+            self.mu_taus,
+            self.sigma_taus,
+            mu_scale,
+            loss,
+        )
+
+        self.x = np.array(initial_guess, dtype=float)
+        self.optimizer_res = None
+
+        if target_dict:
+            self._refit()
+
+    @property
+    def params(self):
+        """ current parameters that can be passed to the `ExpSRP` class """
+        return _convert_fitting_params(
+            self.x, self.mu_taus, self.sigma_taus, self.mu_scale
+        )
+
+    def _refit(self):
+        """ re-fits the model starting from the previous optimum """
+        self.optimizer_res = minimize(
+            self.objective,
+            x0=self.x,
+            method="L-BFGS-B",
+            jac=True,
+            bounds=self.bounds,
+            **self.kwargs
+        )
+        self.x = self.optimizer_res["x"]
+
+    def partial_fit(self, protocol_key, new_sweeps):
+        """
+        Updates the fit with newly recorded sweeps of a stimulation protocol.
+
+        :param protocol_key: protocol key in the stimulus dictionary
+        :param new_sweeps: np.array with response amplitudes of shape [n_sweep, n_stimulus]
+        :return: fitted parameters and output of scipy.minimize
+        """
+        self.objective.add_targets(
+            protocol_key, self.stimulus_dict[protocol_key], new_sweeps
+        )
+        self._refit()
+
+        return self.params, self.optimizer_res
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# LIKELIHOOD LANDSCAPES AND PROFILES
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def _parameter_index(parameter, mu_taus, sigma_taus):
+    """
+    :param parameter: index in the parameter vector, or name of a parameter group
+                      with a single parameter (e.g. 'mu_baseline' or 'sigma_scale')
+    :return: index in the parameter vector
+    """
+    if isinstance(parameter, str):
+        groups = _parameter_groups(len(mu_taus), len(sigma_taus))
+        if parameter not in groups:
+            raise ValueError("Unknown parameter '{}'".format(parameter))
+        if len(groups[parameter]) != 1:
+            raise ValueError(
+                "'{}' contains several parameters. Use the index in the parameter vector".format(
+                    parameter
+                )
+            )
+        return int(groups[parameter][0])
+    return int(parameter)
+
+
+def _map_chunks(function, chunks, workers):
+    """
+    Maps a function over a list of inputs, possibly in parallel
+
+    :param function: picklable function (or callable object)
+    :param chunks: list of inputs
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :return: list of outputs
+    """
+    if callable(workers) or int(workers) == 1:
+        with MapWrapper(pool=workers) as mapper:
+            return list(mapper(function, chunks))
+    else:
+        # objective and data are sent to the workers once through shared memory
+        with SharedMemoryPool(function, workers) as pool:
+            return list(pool.map(chunks))
+
+
+def _split_batches(objective, X, memory_budget):
+    """
+    Splits parameter vectors into batches for vectorized evaluation
+
+    :param objective: `SRPObjective`
+    :param X: parameter matrix of shape [n_vectors, n_params]
+    :param memory_budget: approximate memory (in bytes) available for one batch
+    :return: list of parameter matrices
+    """
+    # about 16 intermediate arrays of the size of the longest protocol per vector
+    nstim = max(objective.stats[key].shape[-1] for key in objective.keys)
+    chunksize = max(1, int(memory_budget // (16 * 8 * nstim)))
+    return [X[start : start + chunksize] for start in range(0, len(X), chunksize)]
+
+
+class _LandscapeChunk(object):
+    """ Picklable evaluation of the loss of a chunk of parameter vectors """
+
+    def __init__(self, objective):
+        self.objective = objective
+
+    def __call__(self, X):
+        return self.objective.loss_and_grad(X, jac=False)[0]
+
+
+def nll_landscape(
+    x,
+    axes,
+    stimulus_dict,
+    target_dict,
+    mu_taus,
+    sigma_taus,
+    mu_scale=None,
+    loss="default",
+    memory_budget=2 ** 27,
+    workers=1,
+):
+    """
+    NLL of the SRP model over a 1-D, 2-D or N-D slice of parameter space.
+    Grid points are evaluated in vectorized batches whose size is chosen such that
+    the intermediate arrays stay within `memory_budget`.
+
+    :param x: parameter vector [mu_baseline, *mu_amps, sigma_baseline, *sigma_amps, sigma_scale]
+              at which all parameters that are not varied are held
+    :param axes: dictionary mapping parameters (see below) to arrays of values
+    :param stimulus_dict: mapping of protocol keys to isi stimulation vectors
+    :param target_dict: mapping of protocol keys to response matrices
+    :param mu_taus: mu time constants
+    :param sigma_taus: sigma time constants
+    :param mu_scale: mu scale (defaults to None for normalized data)
+    :param loss: type of loss to be used. One of:
+            'default':  NLL across all observations
+            'equal':    Assign equal weight to each stimulation protocol instead of each observation.
+    :param memory_budget: approximate memory (in bytes) available for one batch
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :return: array of losses of shape [len(values) for values in axes.values()]
+
+    Parameters are given either as their index in the parameter vector or as the name
+    of a group with a single parameter: 'mu_baseline', 'mu_amps', 'sigma_baseline',
+    'sigma_amps' or 'sigma_scale'.
+    """
+    mu_taus = np.atleast_1d(mu_taus)
+    sigma_taus = np.atleast_1d(sigma_taus)
+    objective = SRPObjective(
+        stimulus_dict, target_dict, mu_taus, sigma_taus, mu_scale, loss
+    )
+
+    indices = [_parameter_index(p, mu_taus, sigma_taus) for p in axes.keys()]
+    values = [np.asarray(v, dtype=float) for v in axes.values()]
+    shape = tuple(len(v) for v in values)
+
+    # all grid points, all other parameters held at x
+    X = np.tile(np.asarray(x, dtype=float), (int(np.prod(shape)), 1))
+    for ix, grid in zip(indices, np.meshgrid(*values, indexing="ij")):
+        X[:, ix] = grid.ravel()
+
+    chunks = _split_batches(objective, X, memory_budget)
+    nll = np.concatenate(_map_chunks(_LandscapeChunk(objective), chunks, workers))
+    return nll.reshape(shape)
+
+
+class _ProfileBranch(object):
+    """
+    Picklable profile likelihood along one branch of values of a parameter. The nuisance
+    parameters are re-optimized at every value, starting from the optimum at the previous value.
+    """
+
+    def __init__(self, objective, bounds, **kwargs):
+        self.objective = objective
+        self.bounds = bounds
+        self.kwargs = kwargs
+
+    def __call__(self, branch):
+        index, values, x0 = branch
+        x = np.array(x0, dtype=float)
+        nll = []
+        optima = []
+
+        for value in values:
+            # the profiled parameter is fixed through its bounds
+            x[index] = value
+            bounds = list(self.bounds)
+            bounds[index] = (value, value)
+            res = minimize(
+                self.objective,
+                x0=x,
+                method="L-BFGS-B",
+                jac=True,
+                bounds=bounds,
+                **self.kwargs
+            )
+            # copy, as the next value is set in place
+            x = res["x"].copy()
+            nll.append(res["fun"])
+            optima.append(res["x"])
+
+        return np.array(nll), np.reshape(optima, (len(values), len(x)))
+
+
+def nll_profile(
+    x,
+    profiles,
+    stimulus_dict,
+    target_dict,
+    mu_taus,
+    sigma_taus,
+    mu_scale=None,
+    bounds="default",
+    loss="default",
+    workers=1,
+    **kwargs
+):
+    """
+    Profile likelihoods of the SRP model: for each value of a profiled parameter,
+    the NLL is minimized over all other (nuisance) parameters.
+
+    Every profile is computed by continuation outward from the optimum `x`: the values
+    above and below the optimal value are traversed in two branches, and at each value
+    the nuisance parameters are warm-started from the optimum at the previous value.
+    All branches of all profiles run in parallel.
+
+    :param x: parameter vector at the optimum (e.g. the output of `fit_srp_model`)
+    :param profiles: dictionary mapping parameters to arrays of values. Parameters are given
+                     as for `nll_landscape`.
+    :param stimulus_dict: mapping of protocol keys to isi stimulation vectors
+    :param target_dict: mapping of protocol keys to response matrices
+    :param mu_taus: mu time constants
+    :param sigma_taus: sigma time constants
+    :param mu_scale: mu scale (defaults to None for normalized data)
+    :param bounds: bounds for parameters
+    :param loss: type of loss to be used (see `nll_landscape`)
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :param kwargs: keyword args to be passed to scipy.optimize.minimize
+    :return: dictionary mapping parameters to dictionaries with sorted `values`, the
+             profile `nll` and the optimal parameter vectors `x` at each value
+    """
+    mu_taus = np.atleast_1d(mu_taus)
+    sigma_taus = np.atleast_1d(sigma_taus)
+    x = np.asarray(x, dtype=float)
+
+    if bounds == "default":
+        bounds = _default_parameter_bounds(mu_taus, sigma_taus)
+
+    objective = SRPObjective(
+        stimulus_dict, target_dict, mu_taus, sigma_taus, mu_scale, loss
+    )
+
+    # two branches per profile, both starting at the optimum
+    branches = []
+    for parameter, values in profiles.items():
+        index = _parameter_index(parameter, mu_taus, sigma_taus)
+        values = np.sort(np.asarray(values, dtype=float))
+        above = values >= x[index]
+        branches.append((index, values[above], x))
+        branches.append((index, values[~above][::-1], x))
+
+    results = _map_chunks(
+        _ProfileBranch(objective, bounds, **kwargs), branches, workers
+    )
+
+    output = {}
+    for n, parameter in enumerate(profiles.keys()):
+        (nll_above, x_above), (nll_below, x_below) = results[2 * n : 2 * n + 2]
+        output[parameter] = {
+            "values": np.concatenate(
+                [branches[2 * n + 1][1][::-1], branches[2 * n][1]]
+            ),
+            "nll": np.concatenate([nll_below[::-1], nll_above]),
+            "x": np.concatenate([x_below[::-1], x_above]),
+        }
+
+    return output
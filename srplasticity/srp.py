@@ -22,9 +22,11 @@ Copyright (C) 2021 Julian Rossbroich, Daniel Trotter, John Beninger, Richard Nau
 """
 
 from abc import ABC, abstractmethod
+from collections import namedtuple
 import numpy as np
 from scipy.signal import lfilter
 from srplasticity.tools import get_stimvec
+from srplasticity._recurrences import exp_kernel_states
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -55,6 +57,23 @@ def _convolve_spiketrain_with_kernel(spiketrain, kernel):
     return lfilter(kernel, 1, spktr)
 
 
+def _exp_kernel_design(isivec, taus):
+    """
+    Integrates normalized exponential kernels (amplitude 1 / tau) between spikes.
+
+    Row n holds the state of each exponential at spike n, such that the filtered spike train
+    of the `ExpSRP` model at spike n equals `baseline + design[n] @ amps`.
+    As the time constants are fixed during fitting, this matrix only needs to be computed once
+    per stimulation protocol.
+
+    :param isivec: ISI vector (in ms)
+    :param taus: time constants of the exponential decays
+    :return: np.array of shape [n_spikes, n_taus]
+    """
+    taus = np.atleast_1d(taus).astype(float)
+    return exp_kernel_states(isivec, 1 / taus, taus)
+
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #
 # EFFICIENCY KERNELS
@@ -336,6 +355,113 @@ class ProbSRP(DetSRP):
         )
 
 
+def _readonly(values):
+    """ :return: read-only float array of `values` """
+    values = np.array(np.atleast_1d(values), dtype=float)
+    values.setflags(write=False)
+    return values
+
+
+class ExpSRPParameters(
+    namedtuple(
+        "ExpSRPParameters",
+        [
+            "mu_baseline",
+            "mu_amps",
+            "mu_taus",
+            "sigma_baseline",
+            "sigma_amps",
+            "sigma_taus",
+            "mu_scale",
+            "sigma_scale",
+        ],
+    )
+):
+    """
+    Immutable parameters of the `ExpSRP` model, in the order of its constructor arguments.
+    Parameters can be shared between threads and evaluated with `run_srp_ISIvec`.
+    If no scaling parameters are given, amplitudes are normalized to baseline.
+    """
+
+    __slots__ = ()
+
+    def __new__(
+        cls,
+        mu_baseline,
+        mu_amps,
+        mu_taus,
+        sigma_baseline,
+        sigma_amps,
+        sigma_taus,
+        mu_scale=None,
+        sigma_scale=None,
+    ):
+        if mu_scale is None:
+            mu_scale = 1 / _sigmoid(mu_baseline)
+        if sigma_scale is None:
+            sigma_scale = 1 / _sigmoid(sigma_baseline)
+
+        return super().__new__(
+            cls,
+            mu_baseline,
+            _readonly(mu_amps),
+            _readonly(mu_taus),
+            sigma_baseline,
+            _readonly(sigma_amps),
+            _readonly(sigma_taus),
+            mu_scale,
+            sigma_scale,
+        )
+
+    def initial_state(self):
+        """ :return: state of a synapse whose kernels have decayed to zero """
+        return SRPState(np.zeros(len(self.mu_taus)), np.zeros(len(self.sigma_taus)))
+
+
+# states of the mu and sigma exponential kernels at the last spike
+SRPState = namedtuple("SRPState", ["mu", "sigma"])
+
+
+def run_srp_ISIvec(params, isivec, ntrials=1, state=None, rng=None, nlin=_sigmoid):
+    """
+    Evaluates the `ExpSRP` model integrated between spikes. The function does not modify
+    its arguments, such that threads can evaluate protocols and parameters concurrently.
+
+    :param params: `ExpSRPParameters`
+    :param isivec: ISI vector
+    :param ntrials: number of sampled responses (0 to skip sampling)
+    :param state: Optional - `SRPState` at the first spike. Defaults to the initial state.
+    :param rng: Optional - np.random.Generator or RandomState used for sampling.
+                Defaults to the global numpy random state.
+    :param nlin: nonlinear readout. Defaults to the sigmoid function
+    :return: tuple (means, sigmas, efficacies) and `SRPState` at the last spike
+    """
+    if state is None:
+        state = params.initial_state()
+
+    # normalize amplitudes by time constant to ensure equal integrals of exponentials
+    mu_states = exp_kernel_states(
+        isivec, params.mu_amps / params.mu_taus, params.mu_taus, state.mu
+    )
+    sigma_states = exp_kernel_states(
+        isivec, params.sigma_amps / params.sigma_taus, params.sigma_taus, state.sigma
+    )
+
+    # Apply nonlinear readout
+    means = nlin(mu_states.sum(1) + params.mu_baseline) * params.mu_scale
+    sigmas = nlin(sigma_states.sum(1) + params.sigma_baseline) * params.sigma_scale
+
+    # Sample from gamma distribution
+    rng = np.random if rng is None else rng
+    efficacies = rng.gamma(
+        *_refactor_gamma_parameters(means, sigmas), size=(ntrials, len(means))
+    )
+
+    if len(isivec) > 0:
+        state = SRPState(mu_states[-1], sigma_states[-1])
+    return (means, sigmas, efficacies), state
+
+
 class ExpSRP(ProbSRP):
     """
     SRP model in which mu and sigma kernels are parameterized by a set of amplitudes and respective exponential
@@ -373,17 +499,17 @@ class ExpSRP(ProbSRP):
             mu_kernel, mu_baseline, sigma_kernel, sigma_baseline, mu_scale, sigma_scale
         )
 
-        # Save amps and taus for version that is integrated between spikes
-        self._mu_taus = np.array(mu_taus)
-        self._sigma_taus = np.array(sigma_taus)
-
-        # normalize amplitudes by time constant to ensure equal integrals of exponentials
-        self._mu_amps = np.array(mu_amps) / self._mu_taus
-        self._sigma_amps = np.array(sigma_amps) / self._sigma_taus
-
-        # number of exp decays
-        self._nexp_mu = len(self._mu_amps)
-        self._nexp_sigma = len(self._sigma_amps)
+        # immutable parameters for the version that is integrated between spikes
+        self.params = ExpSRPParameters(
+            mu_baseline,
+            mu_amps,
+            mu_taus,
+            sigma_baseline,
+            sigma_amps,
+            sigma_taus,
+            self.mu_scale,
+            self.sigma_scale,
+        )
 
     def run_ISIvec(self, isivec, ntrials=1, fast=True, **kwargs):
         """
@@ -397,39 +523,7 @@ class ExpSRP(ProbSRP):
 
         # Fast evaluation (integrate between spikes)
         if fast:
-
-            state_mu = np.zeros(self._nexp_mu)  # assume kernels have decayed to zero
-            state_sigma = np.zeros(
-                self._nexp_sigma
-            )  # assume kernels have decayed to zero
-
-            means = []
-            sigmas = []
-
-            for spike, dt in enumerate(isivec):
-
-                if spike > 0:
-                    # At the first spike, read out baseline efficacy
-                    # At every following spike, integrate over the ISI and then read out efficacy
-                    state_mu = (state_mu + self._mu_amps) * np.exp(-dt / self._mu_taus)
-                    state_sigma = (state_sigma + self._sigma_amps) * np.exp(
-                        -dt / self._sigma_taus
-                    )
-
-                # record value at spike
-                means.append(state_mu.sum())
-                sigmas.append(state_sigma.sum())
-
-            # Apply nonlinear readout
-            means = self.nlin(np.array(means) + self.mu_baseline) * self.mu_scale
-            sigmas = (
-                self.nlin(np.array(sigmas) + self.sigma_baseline) * self.sigma_scale
-            )
-
-            # Sample from gamma distribution
-            efficacies = self._sample(means, sigmas, ntrials)
-
-            return means, sigmas, efficacies
+            return run_srp_ISIvec(self.params, isivec, ntrials, nlin=self.nlin)[0]
 
         # Standard evaluation (convolution of spiketrain with kernel)
         else:
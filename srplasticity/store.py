@@ -0,0 +1,748 @@
+"""
+store.py Module
+
+This module contains tools to store the results of fitting procedures on disk:
+- checkpoints that journal completed units of work of long fitting procedures
+- an indexed, columnar store of fitted parameters, losses and convergence information
+- a columnar table of the results of all starts of a fitting procedure
+- a content-addressed, size-bounded cache of fitting results
+
+Copyright (C) 2021 Julian Rossbroich, Daniel Trotter, John Beninger, Richard Naud
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import csv
+import functools
+import os
+import struct
+import pickle
+import hashlib
+import tempfile
+import time
+from importlib import metadata
+from pathlib import Path
+import numpy as np
+from scipy.optimize import OptimizeResult
+from srplasticity.tools import iter_sweep_chunks
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# HELPER FUNCTIONS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def fingerprint(*objects):
+    """
+    Hash of (picklable) objects, e.g. of an objective function, its data and the optimizer settings
+
+    :return: hexadecimal string
+    """
+    return hashlib.sha1(pickle.dumps(objects, pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+def data_fingerprint(target_dict):
+    """
+    Hash of the response amplitudes of a dataset. Targets are read in chunks of sweeps,
+    such that memory-mapped arrays and `ChunkedTargets` are hashed without loading them.
+
+    :param target_dict: dictionary mapping protocol keys to response matrices
+    :return: hexadecimal string
+    """
+    sha = hashlib.sha1()
+    for key in sorted(target_dict.keys(), key=str):
+        sha.update(str(key).encode())
+        for chunk in iter_sweep_chunks(target_dict[key]):
+            sha.update(np.ascontiguousarray(chunk, dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# CHECKPOINTS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+# Journals that were checked for incomplete records by this process
+_verified_journals = set()
+
+# Time of the last sync to disk of each journal written by this process
+_last_sync = {}
+
+
+class Checkpoint(object):
+    """
+    Append-only on-disk journal of completed units of work (e.g. starts of a grid search).
+
+    Every result is appended to the journal file as soon as it is completed. When a fitting
+    procedure is restarted with the same checkpoint, completed work is read back instead of
+    being recomputed. The journal can be read at any time, also while a fit is in progress,
+    e.g. to inspect the best solution found so far.
+
+    Checkpoints can be scoped (see `scoped`), such that a single journal can hold all fits of
+    a study, e.g. one scope per bootstrap sample and held-out protocol. To resume many scopes,
+    read the journal once with `load` of the unscoped checkpoint.
+
+    Records are passed to the operating system as soon as they are saved, such that they
+    survive a crash of the fitting process, and synced to disk at most every `sync_interval`
+    seconds, which protects against a crash of the machine.
+
+    :param path: path to the journal file
+    :param scope: tuple of keys that prefix all keys of this checkpoint
+    :param sync_interval: minimum time (in seconds) between two syncs of the journal to disk
+    """
+
+    def __init__(self, path, scope=(), sync_interval=1.0):
+        self.path = Path(path)
+        self.scope = tuple(scope)
+        self.sync_interval = sync_interval
+
+    def scoped(self, *scope):
+        """
+        :return: checkpoint that shares the journal, with keys prefixed by `scope`
+        """
+        return Checkpoint(self.path, self.scope + scope, self.sync_interval)
+
+    def _read(self):
+        """
+        Reads the journal. Records are stored with a length prefix, such that a record
+        that was cut off by a crash can be detected and discarded.
+
+        :return: list of (key, result) records and file size up to the last complete record
+        """
+        records = []
+        size = 0
+        if not self.path.exists():
+            return records, size
+
+        with open(self.path, "rb") as file:
+            while True:
+                header = file.read(8)
+                if len(header) < 8:
+                    break
+                (length,) = struct.unpack("<Q", header)
+                payload = file.read(length)
+                if len(payload) < length:
+                    break
+                records.append(pickle.loads(payload))
+                size += 8 + length
+
+        return records, size
+
+    def load(self):
+        """
+        :return: dictionary mapping keys (without scope) to results of completed work in this scope
+        """
+        nscope = len(self.scope)
+        records, _ = self._read()
+        return {
+            key[nscope:]: result
+            for key, result in records
+            if key[:nscope] == self.scope
+        }
+
+    def save(self, key, result):
+        """
+        Appends a completed unit of work to the journal
+
+        :param key: tuple identifying the unit of work within the scope
+        :param result: picklable result
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        payload = pickle.dumps(
+            (self.scope + tuple(key), result), pickle.HIGHEST_PROTOCOL
+        )
+
+        # discard a record that was cut off by a crash before this process first wrote to the journal
+        if self.path not in _verified_journals:
+            _, size = self._read()
+            if self.path.exists() and os.path.getsize(self.path) > size:
+                os.truncate(self.path, size)
+            _verified_journals.add(self.path)
+
+        with open(self.path, "ab") as file:
+            file.write(struct.pack("<Q", len(payload)) + payload)
+            file.flush()
+            now = time.monotonic()
+            if now - _last_sync.get(self.path, -np.inf) >= self.sync_interval:
+                os.fsync(file.fileno())
+                _last_sync[self.path] = now
+
+    def sync(self):
+        """
+        Syncs the journal to disk, e.g. after the last record of a fit was saved
+        """
+        if self.path.exists():
+            with open(self.path, "ab") as file:
+                os.fsync(file.fileno())
+            _last_sync[self.path] = time.monotonic()
+
+    def best(self):
+        """
+        :return: result with the lowest function value `fun` in this scope (best solution so far)
+        """
+        results = [
+            result
+            for result in self.load().values()
+            if isinstance(result, dict) and np.isfinite(result.get("fun", np.nan))
+        ]
+        if not results:
+            return None
+
+        return min(results, key=lambda result: result["fun"])
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# FIT STORE
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+class FitStore(object):
+    """
+    Indexed, columnar on-disk table of fitting results.
+
+    Every row holds one fit (e.g. one start of a grid search): its parameter vector, loss,
+    convergence information and a hash of the data it was fitted to. Rows are indexed by
+    (dataset, model, fold, bootstrap, start).
+
+    Each call to `append` writes a segment, a directory with one .npy file per column.
+    Queries only read the (small) index columns of all segments, and then read the requested
+    rows of the other columns from memory-mapped files.
+
+    :param path: directory of the store
+    """
+
+    # columns of the index and their dtypes
+    index_columns = {
+        "dataset": str,
+        "model": str,
+        "fold": str,
+        "bootstrap": np.int64,
+        "start": np.int64,
+    }
+
+    # columns of the results and their dtypes
+    value_columns = {
+        "x": float,
+        "fun": float,
+        "success": bool,
+        "nit": np.int64,
+        "nfev": np.int64,
+        "data_hash": str,
+    }
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    @property
+    def segments(self):
+        """
+        :return: sorted list of segment directories
+        """
+        if not self.path.exists():
+            return []
+        return sorted(
+            segment
+            for segment in self.path.iterdir()
+            if segment.is_dir() and not segment.name.startswith(".")
+        )
+
+    def append(
+        self, dataset, model, results, fold="", bootstrap=-1, starts=None, data=None
+    ):
+        """
+        Appends the results of a fitting procedure to the store
+
+        :param dataset: name of the dataset
+        :param model: name of the model
+        :param results: list of optimizer results or dictionaries with entries `x` and `fun`
+                        and optionally `success`, `nit` and `nfev` (e.g. all starts of a grid search)
+        :param fold: name of the cross-validation fold (e.g. held-out protocol)
+        :param bootstrap: index of the bootstrap sample (-1 for the original data)
+        :param starts: indices of the starts (defaults to the position in `results`)
+        :param data: Optional - target dictionary the models were fitted to, used to compute
+                     the data hash (see `data_fingerprint`)
+        """
+        nrows = len(results)
+        if starts is None:
+            starts = np.arange(nrows)
+
+        # parameter vectors are padded with NaN to a common length
+        nparams = max(np.size(res["x"]) for res in results)
+        x = np.full((nrows, nparams), np.nan)
+        for row, res in enumerate(results):
+            x[row, : np.size(res["x"])] = np.ravel(res["x"])
+
+        columns = {
+            "dataset": np.full(nrows, str(dataset)),
+            "model": np.full(nrows, str(model)),
+            "fold": np.full(nrows, str(fold)),
+            "bootstrap": np.full(nrows, bootstrap, dtype=np.int64),
+            "start": np.asarray(starts, dtype=np.int64),
+            "x": x,
+            "fun": np.array([res["fun"] for res in results], dtype=float),
+            "success": np.array(
+                [res.get("success", True) for res in results], dtype=bool
+            ),
+            "nit": np.array([res.get("nit", -1) for res in results], dtype=np.int64),
+            "nfev": np.array([res.get("nfev", -1) for res in results], dtype=np.int64),
+            "data_hash": np.full(
+                nrows, data_fingerprint(data) if data is not None else ""
+            ),
+        }
+
+        # write to a hidden directory first, such that readers never see incomplete segments
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmpdir = Path(tempfile.mkdtemp(prefix=".", dir=self.path))
+        for name, column in columns.items():
+            np.save(tmpdir / "{}.npy".format(name), column)
+
+        number = len(self.segments)
+        while True:
+            try:
+                os.rename(tmpdir, self.path / "{:08d}".format(number))
+                break
+            except OSError:
+                number += 1
+
+    def index(self, **where):
+        """
+        Reads the index columns of all segments
+
+        :param where: Optional - values that index columns have to match, e.g. model="SRP"
+        :return: dictionary of index columns, plus the segment and row of every matching fit
+        """
+        for name in where:
+            if name not in self.index_columns:
+                raise ValueError("{} is not an index column".format(name))
+
+        parts = {name: [] for name in [*self.index_columns, "segment", "row"]}
+        for number, segment in enumerate(self.segments):
+            keys = {
+                name: np.load(segment / "{}.npy".format(name))
+                for name in self.index_columns
+            }
+            mask = np.ones(len(keys["start"]), dtype=bool)
+            for name, value in where.items():
+                mask &= keys[name] == self.index_columns[name](value)
+
+            for name in self.index_columns:
+                parts[name].append(keys[name][mask])
+            parts["segment"].append(np.full(np.count_nonzero(mask), number))
+            parts["row"].append(np.flatnonzero(mask))
+
+        if not parts["row"]:
+            return {
+                name: np.array([], dtype=self.index_columns.get(name, np.int64))
+                for name in parts
+            }
+
+        return {name: np.concatenate(part) for name, part in parts.items()}
+
+    def select(self, columns=None, **where):
+        """
+        Reads the rows matching `where`. Only the selected rows are read from disk.
+
+        :param columns: Optional - list of value columns to read (defaults to all)
+        :param where: Optional - values that index columns have to match, e.g. model="SRP"
+        :return: dictionary of index and value columns
+        """
+        table = self.index(**where)
+        if columns is None:
+            columns = self.value_columns
+        segments = self.segments
+
+        for name in columns:
+            parts = []
+            for number in np.unique(table["segment"]):
+                rows = table["row"][table["segment"] == number]
+                column = np.load(
+                    segments[number] / "{}.npy".format(name), mmap_mode="r"
+                )
+                parts.append(np.array(column[rows]))
+
+            if name == "x" and parts:
+                nparams = max(part.shape[1] for part in parts)
+                parts = [
+                    np.pad(
+                        part,
+                        ((0, 0), (0, nparams - part.shape[1])),
+                        constant_values=np.nan,
+                    )
+                    for part in parts
+                ]
+            if parts:
+                table[name] = np.concatenate(parts)
+            else:
+                table[name] = np.array([], dtype=self.value_columns[name])
+
+        return table
+
+    def best(self, by=("fold",), successful=True, **where):
+        """
+        Best fit (lowest loss) in each group of rows, e.g. the best SRP fit per held-out protocol:
+            store.best(by="fold", model="SRP", bootstrap=-1)
+
+        :param by: index column or tuple of index columns to group by
+        :param successful: only consider fits that converged successfully
+        :param where: Optional - values that index columns have to match
+        :return: dictionary of index and value columns with one row per group
+        """
+        if isinstance(by, str):
+            by = (by,)
+        table = self.select(columns=("fun", "success"), **where)
+
+        fun = np.where(table["success"] | (not successful), table["fun"], np.nan)
+        fun = np.where(np.isnan(fun), np.inf, fun)
+        groups = {}
+        for row, group in enumerate(zip(*[table[name] for name in by])):
+            if group not in groups or fun[row] < fun[groups[group]]:
+                groups[group] = row
+
+        rows = [row for row in groups.values() if np.isfinite(fun[row])]
+        best = {name: column[rows] for name, column in table.items()}
+
+        # read the remaining columns of the best rows only
+        segments = self.segments
+        for name in self.value_columns:
+            if name in best:
+                continue
+            values = [
+                np.load(segments[segment] / "{}.npy".format(name), mmap_mode="r")[row]
+                for segment, row in zip(best["segment"], best["row"])
+            ]
+            if name == "x" and values:
+                nparams = max(len(value) for value in values)
+                values = [
+                    np.pad(value, (0, nparams - len(value)), constant_values=np.nan)
+                    for value in values
+                ]
+            best[name] = np.array(values, dtype=self.value_columns[name])
+
+        return best
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# RESULTS TABLE
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+class ResultsTable(object):
+    """
+    Columnar table of the results of all starts of a fitting procedure, held in a
+    NumPy structured array with one row per start.
+
+    Columns are read as arrays, e.g. `table["fun"]`. Indexing with a boolean mask or an
+    index array returns a new table, e.g. the converged starts sorted by their loss:
+        table[table["success"]].sort("fun")
+    Indexing with an integer returns the row as an optimizer result, including the
+    `message` of the optimizer (e.g. the traceback of a start that raised) and the flags
+    of starts that `failed`, were `lost` with their worker or exceeded their budget.
+
+    :param data: structured array with the fields of `columns`
+    """
+
+    # columns and their dtypes. x0 (initial guess) and x hold one parameter vector per row,
+    # messages are stored as strings of the length of the longest message.
+    columns = {
+        "x0": float,
+        "x": float,
+        "fun": float,
+        "success": bool,
+        "nit": np.int64,
+        "nfev": np.int64,
+        "njev": np.int64,
+        "status": np.int64,
+        "time": float,
+        "worker": np.int64,
+        "basin": np.int64,
+        "message": str,
+        "failed": bool,
+        "lost": bool,
+        "budget_exceeded": bool,
+    }
+
+    # values of columns that an optimizer result does not report
+    missing = {
+        "fun": np.nan,
+        "success": False,
+        "time": np.nan,
+        "message": "",
+        "failed": False,
+        "lost": False,
+        "budget_exceeded": False,
+    }
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_results(cls, results, starts):
+        """
+        :param results: list of optimizer results, one per start
+        :param starts: array of initial guesses of shape [n_starts, n_params]
+        :return: `ResultsTable`
+        """
+        starts = np.asarray(starts, dtype=float).reshape(len(results), -1)
+        messages = [str(res.get("message", "")) for res in results]
+        width = max([len(message) for message in messages] + [1])
+
+        dtype = []
+        for name, column_dtype in cls.columns.items():
+            if name in ("x0", "x"):
+                dtype.append((name, column_dtype, starts.shape[1:]))
+            elif column_dtype is str:
+                dtype.append((name, "U{}".format(width)))
+            else:
+                dtype.append((name, column_dtype))
+
+        data = np.zeros(len(results), dtype=dtype)
+        data["x0"] = starts
+        data["x"] = [np.ravel(res["x"]) for res in results]
+        data["message"] = messages
+        for name in list(cls.columns)[2:]:
+            if name != "message":
+                data[name] = [
+                    res.get(name, cls.missing.get(name, -1)) for res in results
+                ]
+
+        return cls(data)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        :param path: .npy file written by `save`
+        :param mmap_mode: Optional - memory-map the file instead of reading it (see np.load)
+        :return: `ResultsTable`
+        """
+        return cls(np.load(path, mmap_mode=mmap_mode))
+
+    def save(self, path):
+        """
+        :param path: .npy file
+        """
+        np.save(path, self.data)
+
+    def to_csv(self, path):
+        """
+        Writes the table to a csv file, with one column per parameter of x0 and x.
+        Messages are quoted, as they can span several lines.
+
+        :param path: csv file
+        """
+        header = []
+        columns = []
+        for name in self.data.dtype.names:
+            column = self.data[name]
+            if column.dtype.kind == "U":
+                header.append(name)
+                columns.append(column.tolist())
+            elif column.ndim > 1:
+                header += ["{}_{}".format(name, k) for k in range(column.shape[1])]
+                columns += [["%.17g" % value for value in part] for part in column.T]
+            else:
+                header.append(name)
+                columns.append(["%.17g" % value for value in column])
+
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            writer.writerows(zip(*columns))
+
+    def sort(self, by="fun"):
+        """
+        :param by: column or list of columns to sort by, the first one being the primary key
+        :return: table sorted in ascending order (NaN last)
+        """
+        if isinstance(by, str):
+            by = (by,)
+        order = np.lexsort([self.data[name] for name in reversed(by)])
+        return ResultsTable(self.data[order])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        if isinstance(key, (int, np.integer)):
+            row = self.data[key]
+            return OptimizeResult(
+                {
+                    name: np.array(row[name])
+                    if name in ("x0", "x")
+                    else row[name].item()
+                    for name in self.data.dtype.names
+                }
+            )
+        return ResultsTable(self.data[key])
+
+    def __repr__(self):
+        return "ResultsTable({} starts, {} converged)".format(
+            len(self), np.count_nonzero(self.data["success"])
+        )
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# FIT CACHE
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+@functools.lru_cache(maxsize=None)
+def _package_version():
+    """ :return: installed version of srplasticity (empty if it is not installed) """
+    try:
+        return metadata.version("srplasticity")
+    except metadata.PackageNotFoundError:
+        return ""
+
+
+@functools.lru_cache(maxsize=None)
+def _source_fingerprint():
+    """
+    :return: hash of the source files of srplasticity, such that changes of the code
+             invalidate cached results even if the version number is unchanged
+    """
+    digest = hashlib.sha256()
+    for source in sorted(Path(__file__).parent.glob("*.py")):
+        digest.update(source.name.encode())
+        digest.update(source.read_bytes())
+    return digest.hexdigest()
+
+
+def fit_key(target_dict, *inputs):
+    """
+    Key of a fit in a `FitCache`. The targets enter through the hash of their content
+    (see `data_fingerprint`), such that memory-mapped arrays and `ChunkedTargets`
+    are keyed by their data instead of their files.
+
+    :param target_dict: dictionary mapping protocol keys to response matrices
+    :param inputs: all other (picklable) inputs of the fit
+    :return: tuple
+    """
+    return (data_fingerprint(target_dict),) + inputs
+
+
+# Bytes written to each cache directory by this process since its last eviction
+_cache_written = {}
+
+
+class FitCache(object):
+    """
+    Content-addressed on-disk cache of fitting results.
+
+    Results are stored under a hash of everything they depend on (e.g. targets, stimuli,
+    time constants, bounds, loss, method and options of the minimizer) and of the version and
+    source code of srplasticity. A fit with the same inputs returns the stored result instead of being
+    recomputed, a fit with changed inputs misses the cache. The fitting functions also cache
+    every start, such that only the starts that changed are run again.
+
+    Once the cache grows beyond `max_bytes`, the least recently used results are evicted.
+
+    :param path: directory of the cache
+    :param max_bytes: maximum size of the cache
+    :param scope: tuple of keys that prefix all keys of this cache
+    """
+
+    def __init__(self, path, max_bytes=2 ** 30, scope=()):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.scope = tuple(scope)
+
+    def scoped(self, *scope):
+        """
+        :return: cache that shares the directory, with keys prefixed by `scope`
+        """
+        return FitCache(self.path, self.max_bytes, self.scope + scope)
+
+    def _file(self, key):
+        digest = fingerprint(
+            _package_version(), _source_fingerprint(), self.scope, tuple(key)
+        )
+        return self.path / digest[:2] / "{}.pkl".format(digest)
+
+    def get(self, key):
+        """
+        :param key: tuple of the inputs of a result within the scope
+        :return: stored result, or None if the cache holds no result for `key`
+        """
+        file = self._file(key)
+        try:
+            with open(file, "rb") as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.UnpicklingError):
+            # incomplete file of an interrupted process
+            file.unlink(missing_ok=True)
+            return None
+
+        # mark as recently used
+        os.utime(file)
+        return result
+
+    def save(self, key, result):
+        """
+        Stores a result and evicts the least recently used results if the cache is too large
+
+        :param key: tuple of the inputs of the result within the scope
+        :param result: picklable result
+        """
+        file = self._file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to a temporary file first, such that readers never see incomplete results
+        fd, tmp = tempfile.mkstemp(prefix=".", dir=file.parent)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, file)
+
+        # evict after every tenth of the maximum size written, as eviction scans all files
+        written = _cache_written.get(self.path, 0) + os.path.getsize(file)
+        _cache_written[self.path] = written
+        if written > self.max_bytes / 10:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache is within `max_bytes`
+        """
+        _cache_written[self.path] = 0
+        files = []
+        for file in self.path.glob("*/*.pkl"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+
+        size = sum(filesize for _, filesize, _ in files)
+        for _, filesize, file in sorted(files, key=lambda entry: entry[0]):
+            if size <= self.max_bytes:
+                break
+            file.unlink(missing_ok=True)
+            size -= filesize
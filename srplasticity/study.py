@@ -0,0 +1,429 @@
+"""
+study.py Module
+
+This module contains tools to run studies that consist of many model fits, such as
+bootstrap and cross-validation procedures:
+- a scheduler that runs all starts of all fits of a study on a single process pool
+
+Copyright (C) 2021 Julian Rossbroich, Daniel Trotter, John Beninger, Richard Naud
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+from scipy._lib._util import MapWrapper
+from srplasticity.inference import (
+    _setup_gridsearch,
+    _gridsearch_result,
+    _reproducible,
+)
+from srplasticity.tm import (
+    _tm_objective,
+    _brute_grid,
+    _brute_result,
+    _GridChunkEvaluator,
+)
+from srplasticity.store import Checkpoint, FitStore, fingerprint, data_fingerprint
+from srplasticity.tools import Executor, SharedMemoryPool, failed_result
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# FITS AS UNITS OF WORK
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+class _SRPGridsearchFit(object):
+    """
+    SRP model gridsearch (see `fit_srp_model_gridsearch`), split into one task per start
+    """
+
+    model = "SRP"
+
+    def __init__(
+        self,
+        stimulus_dict,
+        target_dict,
+        mu_taus,
+        sigma_taus,
+        param_ranges="default",
+        mu_scale=None,
+        sigma_scale=1,
+        bounds="default",
+        method="L-BFGS-B",
+        loss="default",
+        **kwargs
+    ):
+        self.target_dict = target_dict
+        self.mu_taus = np.atleast_1d(mu_taus)
+        self.sigma_taus = np.atleast_1d(sigma_taus)
+        self.mu_scale = mu_scale
+
+        self.function, self.inputs = _setup_gridsearch(
+            stimulus_dict,
+            target_dict,
+            self.mu_taus,
+            self.sigma_taus,
+            param_ranges,
+            mu_scale,
+            sigma_scale,
+            bounds,
+            method,
+            loss,
+            **kwargs
+        )
+
+        # same journal scope and keys as `fit_srp_model_gridsearch`
+        self.scope = fingerprint(self.function)
+
+    def task_key(self, ix):
+        return (self.inputs[ix].tobytes(),)
+
+    def to_record(self, ix, output):
+        return output
+
+    def from_record(self, record):
+        return record
+
+    def reproducible(self, output):
+        """ :return: True if the output of a task is journaled (see `_reproducible`) """
+        return _reproducible([output])
+
+    def lost(self, ix, message):
+        """ :return: output of a task whose worker died """
+        return failed_result(self.inputs[ix], message, lost=True)
+
+    def result(self, outputs):
+        """ :return: output of `fit_srp_model_gridsearch` """
+        return _gridsearch_result(
+            outputs, self.inputs, self.mu_taus, self.sigma_taus, self.mu_scale
+        )
+
+    def store_records(self, result):
+        """ :return: results of all starts """
+        return list(result[4])
+
+
+class _TMGridsearchFit(object):
+    """
+    TM model gridsearch (see `fit_tm_model`), split into one task per chunk of grid points
+    """
+
+    model = "TM"
+
+    def __init__(
+        self,
+        stimulus_dict,
+        target_dict,
+        parameter_ranges,
+        loss="default",
+        Ns=20,
+        chunksize=1000,
+    ):
+        self.target_dict = target_dict
+        objective, args = _tm_objective(stimulus_dict, target_dict, loss)
+
+        self.grid, self.points = _brute_grid(parameter_ranges, Ns)
+        self.chunkstarts = range(0, len(self.points), chunksize)
+        self.function = _GridChunkEvaluator(objective, args)
+        self.inputs = [
+            self.points[start : start + chunksize] for start in self.chunkstarts
+        ]
+
+        # same journal scope and keys as `fit_tm_model`
+        self.scope = fingerprint(objective, args, self.points.tobytes(), chunksize)
+
+    def task_key(self, ix):
+        return (self.chunkstarts[ix],)
+
+    def to_record(self, ix, output):
+        best = np.argmin(output)
+        return {
+            "x": self.points[self.chunkstarts[ix] + best],
+            "fun": output[best],
+            "Jout": output,
+        }
+
+    def from_record(self, record):
+        return record["Jout"]
+
+    def reproducible(self, output):
+        """ :return: True if the output of a task is journaled """
+        return True
+
+    def lost(self, ix, message):
+        """ :return: output of a task whose worker died (grid points are not evaluated) """
+        return np.full(len(self.inputs[ix]), np.inf)
+
+    def result(self, outputs):
+        """ :return: output of `fit_tm_model` with `full_output=True` """
+        return _brute_result(
+            self.grid, self.points, np.concatenate(outputs), full_output=True
+        )
+
+    def store_records(self, result):
+        """ :return: best grid point """
+        return [{"x": result[0], "fun": result[1]}]
+
+
+class _StudyTasks(object):
+    """
+    Picklable dispatcher of the tasks of all fits of a study.
+    Tasks are tuples (fit index, task index, input).
+    """
+
+    def __init__(self, functions):
+        self.functions = functions
+
+    def __call__(self, task):
+        fit_ix, task_ix, x = task
+        return fit_ix, task_ix, self.functions[fit_ix](x)
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# STUDY
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+class Study(object):
+    """
+    A bootstrap / cross-validation study of SRP and TM model fits.
+
+    All fits are added first, the study is then flattened into units of work of
+    (bootstrap, fold, model, start) - one per start of an SRP gridsearch and one per chunk
+    of a TM grid - that run on a single process pool. The function and data of every fit
+    are sent to the workers once. Results are reduced as they arrive: as soon as the last
+    task of a fit is completed, its result is computed, recorded and passed to the callback,
+    while the workers continue with the tasks of other fits.
+
+    :param dataset: name of the dataset, used for the fit store
+    :param workers: number of processors (-1 for all available CPU cores), an `Executor`
+            or a map-like callable
+    :param checkpoint: Optional - `Checkpoint` or path of a journal file. Completed tasks
+            are journaled, such that an interrupted study can be resumed.
+    :param fitstore: Optional - `FitStore` or directory to record all fits in
+    """
+
+    def __init__(self, dataset="", workers=-1, checkpoint=None, fitstore=None):
+        if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        if fitstore is not None and not isinstance(fitstore, FitStore):
+            fitstore = FitStore(fitstore)
+
+        self.dataset = dataset
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.fitstore = fitstore
+        self.fits = {}
+
+    def _add(self, bootstrap, fold, fit):
+        key = (bootstrap, fold, fit.model)
+        if key in self.fits:
+            raise ValueError("Study already contains a fit {}".format(key))
+        self.fits[key] = fit
+
+    def add_srp_fit(
+        self,
+        stimulus_dict,
+        target_dict,
+        mu_taus,
+        sigma_taus,
+        bootstrap=-1,
+        fold="",
+        **kwargs
+    ):
+        """
+        Adds an SRP model gridsearch to the study
+
+        :param stimulus_dict: dictionary of protocol key - isivec mapping
+        :param target_dict: dictionary of protocol key - target amplitudes
+        :param mu_taus: mu time constants
+        :param sigma_taus: sigma time constants
+        :param bootstrap: index of the bootstrap sample (-1 for the original data)
+        :param fold: name of the cross-validation fold (e.g. held-out protocol)
+        :param kwargs: keyword args of `fit_srp_model_gridsearch` (param_ranges, mu_scale,
+                       sigma_scale, bounds, method, loss and options for the minimizer)
+        """
+        self._add(
+            bootstrap,
+            fold,
+            _SRPGridsearchFit(
+                stimulus_dict, target_dict, mu_taus, sigma_taus, **kwargs
+            ),
+        )
+
+    def add_tm_fit(
+        self,
+        stimulus_dict,
+        target_dict,
+        parameter_ranges,
+        bootstrap=-1,
+        fold="",
+        **kwargs
+    ):
+        """
+        Adds a TM model gridsearch to the study
+
+        :param stimulus_dict: mapping of protocol keys to isi stimulation vectors
+        :param target_dict: mapping of protocol keys to response matrices
+        :param parameter_ranges: slice objects for parameters
+        :param bootstrap: index of the bootstrap sample (-1 for the original data)
+        :param fold: name of the cross-validation fold (e.g. held-out protocol)
+        :param kwargs: loss, Ns and chunksize (number of grid points per task)
+        """
+        self._add(
+            bootstrap,
+            fold,
+            _TMGridsearchFit(stimulus_dict, target_dict, parameter_ranges, **kwargs),
+        )
+
+    def run(self, callback=None):
+        """
+        Runs all fits of the study
+
+        :param callback: Optional - function called with the key (bootstrap, fold, model)
+                         and the result of each fit as soon as the fit is completed
+        :return: dictionary mapping keys (bootstrap, fold, model) to the output of
+                 `fit_srp_model_gridsearch` or `fit_tm_model` (with `full_output=True`)
+        """
+        keys = list(self.fits.keys())
+        fits = list(self.fits.values())
+        outputs = [[None] * len(fit.inputs) for fit in fits]
+        checkpoints = [None] * len(fits)
+        results = {}
+
+        # 1. READ COMPLETED TASKS FROM CHECKPOINT
+        if self.checkpoint is not None:
+            # the journal is read once for all fits
+            done = self.checkpoint.load()
+            for fit_ix, (key, fit) in enumerate(zip(keys, fits)):
+                bootstrap, fold, model = key
+                scope = (model, bootstrap, fold, fit.scope)
+                checkpoints[fit_ix] = self.checkpoint.scoped(*scope)
+                for task_ix in range(len(fit.inputs)):
+                    record = done.get(scope + fit.task_key(task_ix))
+                    if record is not None:
+                        outputs[fit_ix][task_ix] = fit.from_record(record)
+            del done
+
+        tasks = [
+            (fit_ix, task_ix, fit.inputs[task_ix])
+            for fit_ix, fit in enumerate(fits)
+            for task_ix in range(len(fit.inputs))
+            if outputs[fit_ix][task_ix] is None
+        ]
+        remaining = [
+            sum(output is None for output in fit_outputs) for fit_outputs in outputs
+        ]
+
+        # fits that are already in the fit store (e.g. when resuming) are not appended again
+        stored = set()
+        if self.fitstore is not None:
+            table = self.fitstore.select(columns=("data_hash",), dataset=self.dataset)
+            stored = set(
+                zip(
+                    table["model"],
+                    table["fold"],
+                    table["bootstrap"].tolist(),
+                    table["data_hash"],
+                )
+            )
+
+        def complete(fit_ix):
+            key, fit = keys[fit_ix], fits[fit_ix]
+            results[key] = fit.result(outputs[fit_ix])
+            outputs[fit_ix] = None
+
+            if self.fitstore is not None:
+                bootstrap, fold, model = key
+                storekey = (
+                    model,
+                    str(fold),
+                    bootstrap,
+                    data_fingerprint(fit.target_dict),
+                )
+                if storekey not in stored:
+                    self.fitstore.append(
+                        self.dataset,
+                        model,
+                        fit.store_records(results[key]),
+                        fold=fold,
+                        bootstrap=bootstrap,
+                        data=fit.target_dict,
+                    )
+                    stored.add(storekey)
+            print("- Completed {} of {} fits: {}".format(len(results), len(fits), key))
+            if callback is not None:
+                callback(key, results[key])
+
+        print("STARTING STUDY")
+        print("- Using {} cores in parallel".format(self.workers))
+        ntasks = sum(len(fit.inputs) for fit in fits)
+        print("- Running {} fits with a total of {} tasks".format(len(fits), ntasks))
+        if len(tasks) < ntasks:
+            print("- Resuming: {} tasks completed before".format(ntasks - len(tasks)))
+
+        # 2. FITS THAT WERE COMPLETED BEFORE
+        for fit_ix in range(len(fits)):
+            if remaining[fit_ix] == 0:
+                complete(fit_ix)
+
+        if not tasks:
+            return results
+
+        # 3. RUN REMAINING TASKS AND REDUCE AS RESULTS ARRIVE
+        dispatcher = _StudyTasks([fit.function for fit in fits])
+
+        # tasks whose worker died are recorded as lost, but not journaled
+        lost_tasks = set()
+
+        def lost(task, message):
+            fit_ix, task_ix, _ = task
+            print("- Lost task {} of fit {}: {}".format(task_ix, keys[fit_ix], message))
+            lost_tasks.add((fit_ix, task_ix))
+            return fit_ix, task_ix, fits[fit_ix].lost(task_ix, message)
+
+        def reduce(completed):
+            for fit_ix, task_ix, output in completed:
+                outputs[fit_ix][task_ix] = output
+                if (
+                    checkpoints[fit_ix] is not None
+                    and (fit_ix, task_ix) not in lost_tasks
+                    and fits[fit_ix].reproducible(output)
+                ):
+                    checkpoints[fit_ix].save(
+                        fits[fit_ix].task_key(task_ix),
+                        fits[fit_ix].to_record(task_ix, output),
+                    )
+
+                remaining[fit_ix] -= 1
+                if remaining[fit_ix] == 0:
+                    complete(fit_ix)
+
+        if isinstance(self.workers, Executor):
+            reduce(self.workers.map_unordered(dispatcher, tasks, on_lost=lost))
+        elif callable(self.workers) or int(self.workers) == 1:
+            with MapWrapper(pool=self.workers) as mapper:
+                reduce(mapper(dispatcher, tasks))
+        else:
+            # all fits are sent to the workers once through shared memory
+            with SharedMemoryPool(dispatcher, self.workers) as pool:
+                reduce(pool.map_unordered(tasks, on_lost=lost))
+
+        if self.checkpoint is not None:
+            self.checkpoint.sync()
+        return results
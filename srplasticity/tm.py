@@ -23,8 +23,13 @@ Copyright (C) 2021 Julian Rossbroich, Daniel Trotter, John Beninger, Richard Nau
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from collections import namedtuple
 import numpy as np
 from scipy.optimize import brute
+from scipy._lib._util import MapWrapper
+from srplasticity.store import Checkpoint, FitCache, fingerprint, fit_key
+from srplasticity.tools import ChunkedTargets, Executor, iter_sweep_chunks
+from srplasticity._recurrences import tm_isivec, tm_spiketrain
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -81,6 +86,75 @@ def _total_loss_equal_protocol_weights(target_dict, estimates_dict):
     return loss
 
 
+def _sse_statistics(targets):
+    """
+    Per-stimulus sufficient statistics for the sum of squared errors,
+    accumulated in a single pass over chunks of sweeps.
+
+    :param targets: 2D np.array with response amplitudes of shape [n_sweep, n_stimulus],
+                    memory-mapped array or `ChunkedTargets`
+    :return: np.array of shape [3, n_stimulus]: counts, means and centered sums of squares
+    """
+    count, mean, m2 = 0, 0, 0
+
+    for chunk in iter_sweep_chunks(targets):
+        n = np.count_nonzero(~np.isnan(chunk), axis=0)
+        chunk_mean = np.divide(
+            np.nansum(chunk, axis=0), n, out=np.zeros(n.shape), where=n > 0
+        )
+        chunk_m2 = np.nansum((chunk - chunk_mean) ** 2, axis=0)
+
+        # merge with statistics of previous chunks
+        total = count + n
+        weight = np.divide(n, total, out=np.zeros(n.shape), where=total > 0)
+        delta = chunk_mean - mean
+        mean = mean + delta * weight
+        m2 = m2 + chunk_m2 + delta ** 2 * count * weight
+        count = total
+
+    return np.array([count, mean, m2])
+
+
+def _sse_from_statistics(stats, estimate):
+    """
+    :param stats: sufficient statistics as returned by `_sse_statistics`
+    :param estimate: 1D np.array with estimated response amplitudes of shape [n_stimulus]
+    :return: sum of squared errors
+    """
+    count, mean, m2 = stats
+    return np.sum(m2 + count * (mean - estimate) ** 2)
+
+
+def _objective_function_from_statistics(x, *args):
+    """
+    Objective function for scipy.optimize.brute gridsearch using sufficient statistics
+    of the targets instead of response matrices (see `_sse_statistics`)
+
+    :param x: parameters for TM model
+    :param args: statistics dictionary, stimulus dictionary and loss
+    :return: total loss to be minimized
+    """
+    stats_dict, stimulus_dict, loss = args
+    params = TMParameters(*x)
+
+    n_protocols = len(stats_dict.keys())
+    total = 0
+    for key, stats in stats_dict.items():
+        estimate, _ = run_tm_ISIvec(params, stimulus_dict[key])
+        sse = _sse_from_statistics(stats, estimate)
+
+        if loss == "default":
+            total += sse
+        elif loss == "equal":
+            total += sse / stats[0].sum() * 1 / n_protocols
+        else:
+            raise ValueError(
+                "Invalid loss function. Check the documentation for valid loss values"
+            )
+
+    return total
+
+
 def _objective_function(x, *args):
     """
     Objective function for scipy.optimize.brute gridsearch
@@ -91,13 +165,12 @@ def _objective_function(x, *args):
     """
     # initialize
     target_dict, stimulus_dict, loss = args
-    model = TsodyksMarkramModel(*x)
+    params = TMParameters(*x)
 
     # compute estimates
     estimates_dict = {}
     for key, ISIvec in stimulus_dict.items():
-        estimates_dict[key] = model.run_ISIvec(ISIvec)
-        model.reset()
+        estimates_dict[key], _ = run_tm_ISIvec(params, ISIvec)
 
     # return loss
     if loss == "default":
@@ -115,6 +188,134 @@ def _objective_function(x, *args):
         )
 
 
+class _GridChunkEvaluator(object):
+    """
+    Picklable evaluation of an objective function at all points of a chunk of a parameter grid
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def __call__(self, points):
+        return np.array([self.func(x, *self.args) for x in points])
+
+
+def _brute_with_checkpoint(
+    func,
+    ranges,
+    args=(),
+    Ns=20,
+    full_output=False,
+    disp=False,
+    workers=1,
+    checkpoint=None,
+    chunksize=1000,
+):
+    """
+    Equivalent of scipy.optimize.brute without finishing function, that evaluates the grid
+    in chunks and journals every completed chunk to a checkpoint. Chunks that were completed
+    by a previous run with the same objective, data and grid are not evaluated again.
+    Without checkpoint, the grid is only evaluated in chunks.
+
+    :param func: objective function
+    :param ranges: slice objects or (low, high) tuples for parameters
+    :param args: extra arguments passed to the objective function
+    :param Ns: number of grid points along the axes given as (low, high) tuples
+    :param full_output: return the grid and function values at all grid points
+    :param disp: print the result of the grid search
+    :param workers: number of processors, an `Executor` or a map-like callable
+    :param checkpoint: Optional - `Checkpoint` to journal completed chunks to
+    :param chunksize: number of grid points per chunk
+    :return: same output as scipy.optimize.brute
+    """
+    grid, points = _brute_grid(ranges, Ns)
+
+    if checkpoint is not None:
+        scope = fingerprint(func, args, points.tobytes(), chunksize)
+        checkpoint = checkpoint.scoped(scope)
+        done = checkpoint.load()
+    else:
+        done = {}
+
+    chunkstarts = range(0, len(points), chunksize)
+    todo = [start for start in chunkstarts if (start,) not in done]
+    if len(todo) < len(chunkstarts):
+        print(
+            "- Resuming grid search: {} of {} chunks completed".format(
+                len(chunkstarts) - len(todo), len(chunkstarts)
+            )
+        )
+
+    # evaluate and journal remaining chunks
+    with MapWrapper(pool=workers) as mapper:
+        chunks = [points[start : start + chunksize] for start in todo]
+        for start, Jout in zip(todo, mapper(_GridChunkEvaluator(func, args), chunks)):
+            best = np.argmin(Jout)
+            done[(start,)] = {
+                "x": points[start + best],
+                "fun": Jout[best],
+                "Jout": Jout,
+            }
+            if checkpoint is not None:
+                checkpoint.save((start,), done[(start,)])
+
+    Jout = np.concatenate([done[(start,)]["Jout"] for start in chunkstarts])
+    return _brute_result(grid, points, Jout, full_output, disp)
+
+
+def _brute_grid(ranges, Ns=20):
+    """
+    CODE ADAPTED FROM SCIPY.OPTIMIZE.BRUTE: grid of parameters
+
+    :param ranges: slice objects or (low, high) tuples for parameters
+    :param Ns: number of grid points along the axes given as (low, high) tuples
+    :return: grid as returned by np.mgrid and array of grid points of shape [n_points, n_params]
+    """
+    lrange = [
+        r if isinstance(r, slice) else slice(r[0], r[1], complex(Ns)) for r in ranges
+    ]
+    grid = np.mgrid[tuple(lrange)]
+    points = np.reshape(grid, (grid.shape[0], -1)).T
+    return grid, points
+
+
+def _brute_result(grid, points, Jout, full_output=False, disp=False):
+    """
+    :param grid: grid as returned by `_brute_grid`
+    :param points: grid points as returned by `_brute_grid`
+    :param Jout: function values at all grid points
+    :return: same output as scipy.optimize.brute
+    """
+    xmin = points[np.argmin(Jout)]
+    Jmin = np.min(Jout)
+
+    if disp:
+        print("Grid search minimum {} at {}".format(Jmin, xmin))
+
+    if full_output:
+        return xmin, Jmin, grid, np.reshape(Jout, grid.shape[1:])
+    else:
+        return xmin
+
+
+def _tm_objective(stimulus_dict, target_dict, loss):
+    """
+    Objective function for the gridsearch of `fit_tm_model` and its arguments
+
+    :return: objective function and tuple of arguments
+    """
+    if callable(loss):
+        if any(isinstance(targets, ChunkedTargets) for targets in target_dict.values()):
+            raise ValueError("Custom loss functions require in-memory target arrays")
+
+        return _objective_function, (target_dict, stimulus_dict, loss)
+
+    # Built-in losses only depend on sufficient statistics of the targets
+    stats_dict = {key: _sse_statistics(targets) for key, targets in target_dict.items()}
+    return _objective_function_from_statistics, (stats_dict, stimulus_dict, loss)
+
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #
 # TSODYKS-MARKRAM MODEL
@@ -122,10 +323,98 @@ def _objective_function(x, *args):
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
+class TMParameters(namedtuple("TMParameters", ["U", "f", "tau_u", "tau_r", "amp"])):
+    """
+    Immutable parameters of the Tsodyks-Markram model, in the order of the arguments
+    of `TsodyksMarkramModel`. Parameters can be shared between threads and evaluated
+    with `run_tm_ISIvec` and `run_tm_spiketrain`.
+    If no amplitude is given, EPSC amplitudes are normalized to baseline.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, U, f, tau_u, tau_r, amp=None):
+        if amp is None:
+            amp = 1 / U
+        return super().__new__(cls, U, f, tau_u, tau_r, amp)
+
+    def initial_state(self):
+        """ :return: state of a synapse that has recovered from previous spikes """
+        return TMState(self.U, 1)
+
+
+# facilitation state `u` and depression state `r`
+TMState = namedtuple("TMState", ["u", "r"])
+
+
+def run_tm_ISIvec(params, ISIvec, state=None, adapted=False):
+    """
+    Evaluates the TM model integrated between spikes. The function does not modify
+    its arguments, such that threads can evaluate protocols and parameters concurrently.
+
+    :param params: `TMParameters`
+    :param ISIvec: vector of inter-spike intervals
+    :param state: Optional - `TMState` at the first spike. Defaults to the initial state.
+    :param adapted: use the adapted TM model (see `AdaptedTsodyksMarkramModel`)
+    :return: vector of response efficacies and `TMState` at the last spike
+    """
+    if state is None:
+        state = params.initial_state()
+
+    efficacies, u, r = tm_isivec(ISIvec, state.u, state.r, *params, adapted=adapted)
+    return efficacies, TMState(u, r)
+
+
+def run_tm_spiketrain(params, spiketrain, dt=0.1, state=None, adapted=False):
+    """
+    Evaluates the TM model at every timestep using forward Euler integration.
+    The function does not modify its arguments.
+
+    :param params: `TMParameters`
+    :param spiketrain: binary spiketrain
+    :param dt: timestep (defaults to 0.1 ms)
+    :param state: Optional - initial `TMState`. Defaults to the initial state.
+    :param adapted: use the adapted TM model (see `AdaptedTsodyksMarkramModel`)
+    :return: dictionary of state variables `u` and `r` and vector of efficacies at each
+             spike, and `TMState` after the last timestep
+    """
+    if state is None:
+        state = params.initial_state()
+
+    efficacies, u, r, u_end, r_end = tm_spiketrain(
+        spiketrain, dt, state.u, state.r, *params, adapted=adapted
+    )
+    return {"u": u, "r": r, "efficacies": efficacies}, TMState(u_end, r_end)
+
+
+def _field(container, name, doc):
+    """
+    :return: property for the field `name` of the namedtuple attribute `container`.
+             Assigning to the property replaces the namedtuple, which is never modified.
+    """
+
+    def fget(self):
+        return getattr(getattr(self, container), name)
+
+    def fset(self, value):
+        setattr(self, container, getattr(self, container)._replace(**{name: value}))
+
+    return property(fget, fset, doc=doc)
+
+
 class TsodyksMarkramModel:
+
+    # `run_ISIvec` and `run_spiketrain` use the compiled recurrences in `_recurrences.py`,
+    # which implement `_update` and `_update_ode` of the classic or the adapted model
+    _adapted = False
+
     def __init__(self, U, f, tau_u, tau_r, amp=None):
         """
-        Initialization method for the Tsodyks-Markram model
+        Initialization method for the Tsodyks-Markram model.
+        The model holds immutable parameters `params` and the current state `state`,
+        which is advanced by `run_ISIvec` and `run_spiketrain`. Parameters and state
+        variables can also be assigned as attributes (e.g. `model.u = 0.5`), which
+        replaces `params` or `state`.
 
         :param U: baseline efficacy
         :param f: facilitation constant
@@ -133,19 +422,16 @@ class TsodyksMarkramModel:
         :param tau_r: depression timescale
         :param amp: baseline amplitude
         """
+        self.params = TMParameters(U, f, tau_u, tau_r, amp)
+        self.state = self.params.initial_state()
 
-        # if no amplitude is given, normalize EPSC amplitude to baseline
-        if amp is None:
-            amp = 1 / U
-
-        self.amp = amp
-        self.r = 1
-        self.U = U
-
-        self.u = U
-        self.f = f
-        self.tau_u = tau_u
-        self.tau_r = tau_r
+    U = _field("params", "U", "baseline efficacy")
+    f = _field("params", "f", "facilitation constant")
+    tau_u = _field("params", "tau_u", "facilitation timescale")
+    tau_r = _field("params", "tau_r", "depression timescale")
+    amp = _field("params", "amp", "baseline amplitude")
+    u = _field("state", "u", "facilitation state")
+    r = _field("state", "r", "depression state")
 
     @property
     def _efficacy(self):
@@ -158,8 +444,7 @@ class TsodyksMarkramModel:
         """
         reset state variables
         """
-        self.u = self.U
-        self.r = 1
+        self.state = self.params.initial_state()
 
     def _update(self, dt):
         """
@@ -192,18 +477,10 @@ class TsodyksMarkramModel:
         :param ISIvec: vector of inter-spike intervals
         :return: vector of response efficacies
         """
-
-        efficacies = []
-
-        for spike, dt in enumerate(ISIvec):
-
-            if spike > 0:
-                # At the first spike, read out baseline efficacy
-                # At every following spike, integrate over the ISI and then read out efficacy
-                self._update(dt)
-            efficacies.append(self._efficacy)
-
-        return np.array(efficacies)
+        efficacies, self.state = run_tm_ISIvec(
+            self.params, ISIvec, self.state, self._adapted
+        )
+        return efficacies
 
     def run_spiketrain(self, spiketrain, dt=0.1):
         """
@@ -215,18 +492,10 @@ class TsodyksMarkramModel:
 
         :return: dictionary of state variables `u` and `r` and vector of efficacies at each spike
         """
-        efficacies = []
-        u = np.zeros(len(spiketrain))
-        r = np.zeros(len(spiketrain))
-
-        for ix, s in enumerate(spiketrain):
-            if s == 1:
-                efficacies.append(self._efficacy)
-            self._update_ode(dt, s)
-
-            u[ix], r[ix] = self.u, self.r
-
-        return {"u": u, "r": r, "efficacies": np.array(efficacies)}
+        output, self.state = run_tm_spiketrain(
+            self.params, spiketrain, dt, self.state, self._adapted
+        )
+        return output
 
 
 class AdaptedTsodyksMarkramModel(TsodyksMarkramModel):
@@ -242,6 +511,8 @@ class AdaptedTsodyksMarkramModel(TsodyksMarkramModel):
 
     """
 
+    _adapted = True
+
     def _update(self, dt):
         """
         integrated between spikes given inter-spike-interval dt
@@ -276,26 +547,84 @@ class AdaptedTsodyksMarkramModel(TsodyksMarkramModel):
 
 
 def fit_tm_model(
-    stimulus_dict, target_dict, parameter_ranges, loss="default", **kwargs
+    stimulus_dict,
+    target_dict,
+    parameter_ranges,
+    loss="default",
+    checkpoint=None,
+    cache=None,
+    **kwargs
 ):
     """
     Fitting the TM model to data using a brute Grid-search
 
     :param stimulus_dict: mapping of protocol keys to isi stimulation vectors
     :param target_dict: mapping of protocol keys to response matrices
+            (arrays, memory-mapped arrays or `ChunkedTargets`)
     :param parameter_ranges: slice objects for parameters
     :param loss: type of loss to be used. One of:
             'default':  Sum of squared error across all observations
             'equal':    Assign equal weight to each stimulation protocol instead of each observation.
                         This computes the mean squared error for each protocol separately.
-    :param kwargs: keyword args to be passed to scipy.optimize.brute
+            or a callable taking the target and estimates dictionaries
+    :param checkpoint: Optional - `Checkpoint` or path of a journal file. The grid is evaluated
+            in chunks and completed chunks are journaled, such that an interrupted fit can
+            be resumed by calling this function again with the same checkpoint.
+    :param cache: Optional - `FitCache` or directory of a cache. A fit with the same data
+            and settings returns the cached result.
+    :param kwargs: keyword args to be passed to scipy.optimize.brute.
+            `workers` can be an `Executor` to reuse its workers.
     :return: output of scipy.optimize.brute
     """
 
-    return brute(
-        _objective_function,
-        ranges=parameter_ranges,
-        args=(target_dict, stimulus_dict, loss),
-        finish=None,
-        **kwargs
+    if cache is not None:
+        if not isinstance(cache, FitCache):
+            cache = FitCache(cache).scoped("fit_tm_model")
+        else:
+            cache = cache.scoped("fit_tm_model")
+        settings = {
+            key: value
+            for key, value in kwargs.items()
+            if key not in ("workers", "disp")
+        }
+        fitkey = fit_key(
+            target_dict,
+            stimulus_dict,
+            parameter_ranges,
+            loss,
+            sorted(settings.items()),
+        )
+        result = cache.get(fitkey)
+        if result is not None:
+            print("Loaded grid search result from cache {}".format(cache.path))
+            return result
+
+    result = _fit_tm_model(
+        stimulus_dict, target_dict, parameter_ranges, loss, checkpoint, **kwargs
     )
+    if cache is not None:
+        cache.save(fitkey, result)
+
+    return result
+
+
+def _fit_tm_model(
+    stimulus_dict, target_dict, parameter_ranges, loss, checkpoint, **kwargs
+):
+    """ grid search of `fit_tm_model` """
+    objective, args = _tm_objective(stimulus_dict, target_dict, loss)
+
+    if checkpoint is not None or isinstance(kwargs.get("workers"), Executor):
+        # grid is evaluated in chunks: one task per chunk instead of one per grid point
+        if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+
+        return _brute_with_checkpoint(
+            objective,
+            ranges=parameter_ranges,
+            args=args,
+            checkpoint=checkpoint,
+            **kwargs
+        )
+
+    return brute(objective, ranges=parameter_ranges, args=args, finish=None, **kwargs)
@@ -20,8 +20,23 @@ Copyright (C) 2021 Julian Rossbroich, Daniel Trotter, John Beninger, Richard Nau
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+import functools
+import importlib
+import io
+import itertools
+import os
+import pickle
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+import traceback
+from multiprocessing import resource_tracker, shared_memory
 import numpy as np
-from scipy.optimize import minimize
+from scipy.optimize import minimize, OptimizeResult
 
 
 def get_stimvec(ISIvec, dt=0.1, null=0, extra=10):
@@ -64,6 +79,88 @@ def get_ISIvec(freq, nstim):
         return [0] + list(np.array([1000 / freq]).astype(int)) * (nstim - 1)
 
 
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# OUT-OF-CORE DATA
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+class ChunkedTargets(object):
+    """
+    Response amplitude matrix that is read in chunks of sweeps instead of being held in memory.
+    Can be passed in place of a response matrix in the target dictionary of the fitting functions.
+
+    :param sources: array-like of shape [n_sweep, n_stimulus] (e.g. np.memmap), path to a .npy file,
+                    or a list of those to be pooled across sweeps (e.g. one per recording session)
+    :param chunksize: maximum number of sweeps per chunk
+    """
+
+    def __init__(self, sources, chunksize=10000):
+
+        if not isinstance(sources, (list, tuple)):
+            sources = [sources]
+
+        self.sources = [
+            np.load(source, mmap_mode="r")
+            if isinstance(source, (str, Path))
+            else source
+            for source in sources
+        ]
+        self.chunksize = chunksize
+
+    @property
+    def shape(self):
+        """ shape of the pooled response matrix """
+        return (
+            sum(len(source) for source in self.sources),
+            np.shape(self.sources[0])[1],
+        )
+
+    def __iter__(self):
+        # Chunks hold `chunksize` consecutive sweeps of the pooled matrix, irrespective of the
+        # boundaries between sources. This makes the accumulation of statistics identical to
+        # that of the equivalent in-memory array.
+        buffer = []
+        nbuffered = 0
+        for source in self.sources:
+            start = 0
+            while start < len(source):
+                stop = min(start + self.chunksize - nbuffered, len(source))
+                buffer.append(
+                    np.atleast_2d(np.asarray(source[start:stop], dtype=float))
+                )
+                nbuffered += stop - start
+                start = stop
+
+                if nbuffered == self.chunksize:
+                    yield np.concatenate(buffer)
+                    buffer = []
+                    nbuffered = 0
+
+        if buffer:
+            yield np.concatenate(buffer)
+
+
+def iter_sweep_chunks(targets, chunksize=10000):
+    """
+    Iterates over a response matrix in chunks of sweeps.
+    Arrays (including memory-mapped arrays) are sliced so that only one chunk is loaded at a time.
+
+    :param targets: response matrix of shape [n_sweep, n_stimulus] or `ChunkedTargets`
+    :param chunksize: maximum number of sweeps per chunk for arrays
+    :return: generator of 2D arrays
+    """
+    if isinstance(targets, ChunkedTargets):
+        yield from targets
+    else:
+        targets = targets if isinstance(targets, np.ndarray) else np.asarray(targets)
+        if targets.ndim < 2:
+            targets = np.atleast_2d(targets)
+        for start in range(0, len(targets), chunksize):
+            yield np.asarray(targets[start : start + chunksize], dtype=float)
+
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #
 # MULTIPROCESSING
@@ -71,20 +168,640 @@ def get_ISIvec(freq, nstim):
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
+class _BudgetExceeded(Exception):
+    """ raised by `_BudgetedObjective` when a start has used up its budget """
+
+
+class _BudgetedObjective(object):
+    """
+    Objective function that keeps track of the best evaluated point and stops the minimizer
+    by raising `_BudgetExceeded` once a wall-clock or evaluation budget is used up
+    """
+
+    def __init__(self, func, jac, max_time=None, max_nfev=None):
+        self.func = func
+        self.jac = jac
+        self.max_time = max_time
+        self.max_nfev = max_nfev
+        self.nfev = 0
+        self.start = time.monotonic()
+        self.best_x = None
+        self.best_fun = np.inf
+
+    def __call__(self, x, *args):
+        if self.max_nfev is not None and self.nfev >= self.max_nfev:
+            raise _BudgetExceeded(
+                "Evaluation budget of {} evaluations exceeded".format(self.max_nfev)
+            )
+        if self.max_time is not None and time.monotonic() - self.start > self.max_time:
+            raise _BudgetExceeded(
+                "Wall-clock budget of {} s exceeded".format(self.max_time)
+            )
+
+        value = self.func(x, *args)
+        self.nfev += 1
+
+        fun = value[0] if self.jac is True else value
+        if fun < self.best_fun:
+            self.best_fun = float(fun)
+            self.best_x = np.array(x, dtype=float)
+        return value
+
+
+def failed_result(x0, message, **fields):
+    """
+    :param x0: initial guess of a start
+    :param message: reason of the failure
+    :return: optimizer result of a start that failed
+    """
+    result = OptimizeResult(
+        x=np.array(x0, dtype=float),
+        fun=np.nan,
+        success=False,
+        status=-1,
+        message=message,
+        nfev=0,
+        failed=True,
+    )
+    result.update(fields)
+    return result
+
+
 class MinimizeWrapper(object):
     """
-    Object to wrap scipy optimize.minimize function for grid search
+    Object to wrap scipy optimize.minimize function for grid search.
+    Starts that raise an exception are returned as failed results (see `failed_result`)
+    instead of aborting the grid search. Results report the wall time of the start (`time`)
+    and the process it ran in (`worker`).
 
     :param func: objective function to call the minimizer on
     :param args: arguments for objective function
+    :param max_time: Optional - wall-clock budget of each start (in seconds)
+    :param max_nfev: Optional - budget of objective function evaluations of each start
     :param kwargs: other keyword arguments for minimizer
     """
 
-    def __init__(self, func, args, **kwargs):
+    def __init__(self, func, args, max_time=None, max_nfev=None, **kwargs):
         self.minimizer = minimize
         self.func = func
         self.args = args
+        self.max_time = max_time
+        self.max_nfev = max_nfev
         self.kwargs = kwargs
 
     def __call__(self, x):
-        return self.minimizer(self.func, x0=x, args=self.args, **self.kwargs)
+        start = time.perf_counter()
+        result = self._minimize(x)
+        result["time"] = time.perf_counter() - start
+        result["worker"] = os.getpid()
+        return result
+
+    def _minimize(self, x):
+        objective = _BudgetedObjective(
+            self.func, self.kwargs.get("jac"), self.max_time, self.max_nfev
+        )
+        try:
+            return self.minimizer(objective, x0=x, args=self.args, **self.kwargs)
+
+        except _BudgetExceeded as stop:
+            # the start is cut short: return the best point evaluated so far
+            if objective.best_x is None:
+                return failed_result(x, str(stop), nfev=objective.nfev)
+            return OptimizeResult(
+                x=objective.best_x,
+                fun=objective.best_fun,
+                success=False,
+                status=-2,
+                message=str(stop),
+                nfev=objective.nfev,
+                budget_exceeded=True,
+            )
+
+        except Exception:
+            return failed_result(x, traceback.format_exc(), nfev=objective.nfev)
+
+
+class _SharedMemoryPickler(pickle.Pickler):
+    """ Pickler that moves numpy arrays into shared memory blocks """
+
+    def __init__(self, file, blocks, min_nbytes):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.blocks = blocks
+        self.min_nbytes = min_nbytes
+
+    def persistent_id(self, obj):
+        if (
+            type(obj) is np.ndarray
+            and not obj.dtype.hasobject
+            and obj.nbytes >= self.min_nbytes
+        ):
+            block = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+            np.ndarray(obj.shape, obj.dtype, buffer=block.buf)[...] = obj
+            self.blocks.append(block)
+            return block.name, obj.shape, obj.dtype.str
+        return None
+
+
+# Shared memory blocks attached by this process. Blocks stay mapped for the lifetime
+# of the process, as arrays do not keep a reference to the memory they are attached to.
+_attached_blocks = {}
+
+
+def _attach_shared_memory(name):
+    """
+    Attaches to a shared memory block created by another process. Only the creating
+    process tracks the block, which unlinks it (see `SharedMemoryPayload.close`).
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers attached blocks with the resource tracker, which is
+        # harmless as long as workers share the tracker of the creating process
+        return shared_memory.SharedMemory(name=name)
+
+
+class _SharedMemoryUnpickler(pickle.Unpickler):
+    """ Unpickler that attaches to arrays in shared memory blocks without copying them """
+
+    def persistent_load(self, pid):
+        name, shape, dtype = pid
+        if name not in _attached_blocks:
+            _attached_blocks[name] = _attach_shared_memory(name)
+        array = np.ndarray(shape, dtype, buffer=_attached_blocks[name].buf)
+        array.flags.writeable = False
+        return array
+
+
+class SharedMemoryPayload(object):
+    """
+    Pickled object whose numpy arrays are placed in shared memory once.
+    Unpickling the payload (e.g. in a worker process) attaches to the arrays without copying them,
+    such that only the small remainder of the pickled object is sent to workers.
+
+    :param obj: object to share (e.g. a wrapped minimizer holding objective and data)
+    :param min_nbytes: minimum size of arrays to be placed in shared memory
+    """
+
+    def __init__(self, obj, min_nbytes=1024):
+        self._blocks = []
+        buffer = io.BytesIO()
+        _SharedMemoryPickler(buffer, self._blocks, min_nbytes).dump(obj)
+        self.pickled = buffer.getvalue()
+        self.names = [block.name for block in self._blocks]
+
+    def __getstate__(self):
+        return {"pickled": self.pickled, "names": self.names, "_blocks": []}
+
+    def load(self):
+        """ unpickles the object, attaching to its arrays in shared memory """
+        return _SharedMemoryUnpickler(io.BytesIO(self.pickled)).load()
+
+    def close(self):
+        """ releases the shared memory blocks (only in the process that created them) """
+        for block in self._blocks:
+            if block.name in _attached_blocks:
+                _attached_blocks.pop(block.name).close()
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class WorkerLost(RuntimeError):
+    """ Raised by a map when the worker process running one of its tasks died """
+
+
+# Queue to which the workers of a pool report the tasks they start (see `_TaskTracker`)
+_started_tasks = None
+
+
+def _run_tracked(call, key, x):
+    """ reports the start of a task to the `_TaskTracker` of the pool, then runs it """
+    _started_tasks.put((key, os.getpid()))
+    return call(x)
+
+
+class _TaskTracker(object):
+    """
+    Maps over a multiprocessing pool and detects tasks that will never complete.
+
+    A pool replaces worker processes that died (e.g. killed by the out-of-memory killer or
+    by a crash in compiled code), but the result of the task they were running never
+    arrives and a plain map blocks forever. Workers therefore report each task they start,
+    with their process id, and tasks whose worker is no longer alive are lost.
+
+    :param context: multiprocessing context of the pool
+    :param grace: seconds a worker has to be dead before its task is lost, such that a
+                  result that was sent just before the worker exited is still received
+    :param poll_interval: seconds between checks of the workers while waiting for results
+    """
+
+    def __init__(self, context=multiprocessing, grace=1.0, poll_interval=0.1):
+        self.started = context.SimpleQueue()
+        self.grace = grace
+        self.poll_interval = poll_interval
+        # maps (map tag, task index) to (process id, start time) of running tasks
+        self.owners = {}
+        self.active = set()
+        self._tags = itertools.count()
+
+    def _collect(self):
+        """ reads the tasks that were started since the last call """
+        while not self.started.empty():
+            (tag, index), pid = self.started.get()
+            if tag in self.active:
+                self.owners[(tag, index)] = (pid, time.monotonic())
+
+    @staticmethod
+    def _alive(pool):
+        """
+        Process ids of the live workers of a pool. Liveness is read from the sentinels of
+        the worker processes, which (unlike `multiprocessing.active_children` or
+        `Process.is_alive`) does not reap exited workers that the pool still has to join.
+
+        :return: set of process ids
+        """
+        sentinels = {}
+        for process in list(pool._pool):
+            try:
+                sentinels[process.sentinel] = process.pid
+            except ValueError:
+                # closed process object
+                continue
+        exited = set(multiprocessing.connection.wait(list(sentinels), timeout=0))
+        return {pid for sentinel, pid in sentinels.items() if sentinel not in exited}
+
+    @staticmethod
+    def _raise_lost(index, message):
+        raise WorkerLost("Task {}: {}".format(index, message))
+
+    def imap(
+        self, pool, call, iterable, window, ordered=True, timeout=None, on_lost=None,
+    ):
+        """
+        Maps `call` over `iterable` on `pool`, whose workers were initialized with the
+        queue of this tracker (see `_init_tracked_worker`)
+
+        :param window: maximum number of tasks submitted to the pool, or completed but
+                       not yet yielded, at a time
+        :param ordered: yield results in the order of `iterable`. All running tasks are
+                        checked for lost workers, not only the next one in order.
+        :param timeout: Optional - seconds after which a running task without result is lost
+        :param on_lost: Optional - function called with the input of a lost task and a
+                        message as soon as the task is lost, whose return value is yielded
+                        as the result of the task. By default, `WorkerLost` is raised.
+        """
+        tag = next(self._tags)
+        self.active.add(tag)
+        inputs = enumerate(iterable)
+        pending = OrderedDict()
+        # maps task indices to functions returning the result of completed or lost tasks
+        finished = {}
+        next_index = 0
+        dead = {}
+
+        # set whenever a task completes
+        completed = threading.Event()
+
+        def notify(_):
+            completed.set()
+
+        try:
+            while True:
+                nfree = window - len(pending) - len(finished)
+                for index, x in itertools.islice(inputs, max(nfree, 0)):
+                    pending[index] = (
+                        x,
+                        pool.apply_async(
+                            _run_tracked,
+                            (call, (tag, index), x),
+                            callback=notify,
+                            error_callback=notify,
+                        ),
+                    )
+                if not pending and not finished:
+                    return
+
+                completed.clear()
+                self._collect()
+                for index in [ix for ix in pending if pending[ix][1].ready()]:
+                    _, asyncres = pending.pop(index)
+                    self.owners.pop((tag, index), None)
+                    finished[index] = asyncres.get
+
+                # check the workers of all running tasks
+                alive = self._alive(pool) if pending else set()
+                now = time.monotonic()
+                for index in list(pending):
+                    if (tag, index) not in self.owners:
+                        continue
+                    pid, start = self.owners[(tag, index)]
+                    if pid not in alive:
+                        if now - dead.setdefault(pid, now) <= self.grace:
+                            continue
+                        message = "Worker process {} died".format(pid)
+                    elif timeout is not None and now - start > timeout:
+                        message = "No result from worker within {} s".format(timeout)
+                    else:
+                        continue
+
+                    x, asyncres = pending.pop(index)
+                    self.owners.pop((tag, index), None)
+                    if asyncres.ready():
+                        finished[index] = asyncres.get
+                    elif on_lost is None:
+                        finished[index] = functools.partial(
+                            self._raise_lost, index, message
+                        )
+                    else:
+                        # called as soon as the task is lost, also if it is yielded later
+                        finished[index] = functools.partial(
+                            lambda result: result, on_lost(x, message)
+                        )
+
+                if ordered:
+                    ready = []
+                    while next_index in finished:
+                        ready.append(next_index)
+                        next_index += 1
+                else:
+                    ready = list(finished)
+                for index in ready:
+                    yield finished.pop(index)()
+
+                if not ready:
+                    completed.wait(self.poll_interval)
+        finally:
+            self.active.discard(tag)
+            for index in pending:
+                self.owners.pop((tag, index), None)
+
+
+_worker_function = None
+
+
+def _init_tracked_worker(started):
+    """ pool initializer: sets the queue that tasks are reported to (see `_TaskTracker`) """
+    global _started_tasks
+    _started_tasks = started
+
+
+def _init_shared_worker(payload, started):
+    """ pool initializer: loads the shared function once per worker process """
+    global _worker_function
+    _init_tracked_worker(started)
+    _worker_function = payload.load()
+
+
+def _call_shared_worker(x):
+    return _worker_function(x)
+
+
+class SharedMemoryPool(object):
+    """
+    Process pool to map a function over many inputs (e.g. a minimizer over initial starts).
+    The function and its data are placed in shared memory once and loaded by each worker
+    in a pool initializer, such that tasks only carry the inputs.
+
+    Tasks whose worker process died (or, with a `timeout`, that ran for too long) are lost:
+    maps raise `WorkerLost`, or yield the result of `on_lost` for them.
+
+    :param func: function (or callable object) to map
+    :param workers: number of processes. -1 uses all available CPU cores.
+    """
+
+    def __init__(self, func, workers=-1):
+        self.func = func
+        self.workers = os.cpu_count() if workers == -1 else int(workers)
+        self.payload = None
+        self.pool = None
+        self.tracker = None
+
+    def __enter__(self):
+        self.payload = SharedMemoryPayload(self.func)
+        self.tracker = _TaskTracker()
+        self.pool = multiprocessing.Pool(
+            processes=self.workers,
+            initializer=_init_shared_worker,
+            initargs=(self.payload, self.tracker.started),
+        )
+        return self
+
+    def map(self, iterable, timeout=None, on_lost=None):
+        """ maps the shared function over `iterable`, preserving order """
+        return self.tracker.imap(
+            self.pool,
+            _call_shared_worker,
+            iterable,
+            8 * self.workers,
+            timeout=timeout,
+            on_lost=on_lost,
+        )
+
+    def map_unordered(self, iterable, timeout=None, on_lost=None):
+        """ maps the shared function over `iterable`, yielding results as they are completed """
+        return self.tracker.imap(
+            self.pool,
+            _call_shared_worker,
+            iterable,
+            8 * self.workers,
+            ordered=False,
+            timeout=timeout,
+            on_lost=on_lost,
+        )
+
+    def __exit__(self, *exc):
+        self.pool.terminate()
+        self.pool.join()
+        self.payload.close()
+
+
+# Functions loaded by an executor worker, mapping tokens to (function, names of attached
+# shared memory blocks, cancellation flag of the map). Only the most recently used
+# functions are kept loaded.
+_executor_functions = OrderedDict()
+_executor_cache_size = 4
+
+
+def _init_executor_worker(preload, started):
+    """ executor initializer: imports modules once per worker process """
+    _init_tracked_worker(started)
+    for module in preload:
+        importlib.import_module(module)
+
+
+def _release_shared_blocks(names):
+    """ detaches this process from shared memory blocks that are no longer referenced """
+    for name in names:
+        block = _attached_blocks.pop(name, None)
+        if block is not None:
+            try:
+                block.close()
+            except BufferError:
+                # arrays in the block are still in use
+                _attached_blocks[name] = block
+
+
+def _load_executor_function(stub):
+    """ loads a function from the shared memory published by `FitExecutor.map` """
+    pickled, names = stub.load()
+    pickled = pickled.tobytes()
+    _release_shared_blocks(stub.names)
+    return _SharedMemoryUnpickler(io.BytesIO(pickled)).load(), names
+
+
+def _call_executor_worker(task):
+    token, stub, flag, x = task
+
+    if token not in _executor_functions:
+        try:
+            cancelled = _attach_shared_memory(flag)
+        except FileNotFoundError:
+            # the map was closed before this worker loaded its function
+            return None
+
+        while len(_executor_functions) >= _executor_cache_size:
+            _, names, evicted = _executor_functions.popitem(last=False)[1]
+            _release_shared_blocks(names)
+            evicted.close()
+        _executor_functions[token] = (*_load_executor_function(stub), cancelled)
+
+    _executor_functions.move_to_end(token)
+    function, _, cancelled = _executor_functions[token]
+    if cancelled.buf[0]:
+        # the map was closed (e.g. stopped early), remaining tasks are skipped
+        return None
+    return function(x)
+
+
+class Executor(ABC):
+    """
+    Abstract base class of executors that map functions over many inputs on long-lived
+    workers. An executor can be passed as `workers` to all fitting functions and to `Study`.
+
+    Maps take an optional function `on_lost`, called with the input of a task that was lost
+    because its worker died and a message. Its return value is yielded as the result of
+    the task. Without `on_lost`, maps raise `WorkerLost` for lost tasks.
+    """
+
+    @abstractmethod
+    def map(self, func, iterable, on_lost=None):
+        """ maps `func` over `iterable`, preserving order """
+
+    @abstractmethod
+    def map_unordered(self, func, iterable, on_lost=None):
+        """ maps `func` over `iterable`, yielding results as they are completed """
+
+    def __call__(self, func, iterable):
+        """ map-like interface, such that the executor can be used as `workers` """
+        return self.map(func, iterable)
+
+    def close(self):
+        """ stops the workers """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FitExecutor(Executor):
+    """
+    Long-lived process pool that is reused across fits.
+    Workers are started once and import numpy, scipy and srplasticity once. For each map,
+    the function and its data are placed in shared memory and loaded once per worker, such
+    that tasks only carry the inputs and a reference to the function.
+
+    With the 'spawn' and 'forkserver' start methods, the main module of a script is
+    imported by the workers and has to guard its fitting code with `if __name__ == "__main__"`.
+
+    :param workers: number of processes. -1 uses all available CPU cores.
+    :param start_method: 'spawn', 'forkserver' or 'fork'.
+            Defaults to 'forkserver' where available and 'spawn' otherwise.
+    :param preload: modules to import in the workers before the first task
+    """
+
+    def __init__(
+        self,
+        workers=-1,
+        start_method=None,
+        preload=("srplasticity.inference", "srplasticity.tm"),
+    ):
+        if start_method is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                start_method = "forkserver"
+            else:
+                start_method = "spawn"
+
+        context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            # modules are imported once by the server, workers are forked from it
+            context.set_forkserver_preload(list(preload))
+
+        # workers share the resource tracker of this process (forked workers would
+        # otherwise start their own and report blocks that this process unlinks as leaked)
+        resource_tracker.ensure_running()
+
+        self.workers = os.cpu_count() if workers == -1 else int(workers)
+        self.start_method = start_method
+        self.tracker = _TaskTracker(context)
+        self.pool = context.Pool(
+            processes=self.workers,
+            initializer=_init_executor_worker,
+            initargs=(tuple(preload), self.tracker.started),
+        )
+        self._tokens = itertools.count()
+
+    def __repr__(self):
+        return "FitExecutor({} workers, {})".format(self.workers, self.start_method)
+
+    def _map(self, func, iterable, ordered, on_lost):
+        payload = SharedMemoryPayload(func)
+        # the pickled function is shared as well, such that tasks only carry a reference
+        stub = SharedMemoryPayload(
+            (np.frombuffer(payload.pickled, dtype=np.uint8), payload.names),
+            min_nbytes=0,
+        )
+        token = "{}-{}".format(os.getpid(), next(self._tokens))
+        # set when the map is closed, such that workers skip the tasks that were
+        # already submitted to the pool
+        cancelled = shared_memory.SharedMemory(create=True, size=1)
+        cancelled.buf[0] = 0
+
+        def lost(task, message):
+            return on_lost(task[-1], message)
+
+        try:
+            yield from self.tracker.imap(
+                self.pool,
+                _call_executor_worker,
+                ((token, stub, cancelled.name, x) for x in iterable),
+                8 * self.workers,
+                ordered=ordered,
+                on_lost=None if on_lost is None else lost,
+            )
+        finally:
+            cancelled.buf[0] = 1
+            cancelled.close()
+            cancelled.unlink()
+            stub.close()
+            payload.close()
+
+    def map(self, func, iterable, on_lost=None):
+        """ maps `func` over `iterable`, preserving order """
+        return self._map(func, iterable, True, on_lost)
+
+    def map_unordered(self, func, iterable, on_lost=None):
+        """ maps `func` over `iterable`, yielding results as they are completed """
+        return self._map(func, iterable, False, on_lost)
+
+    def close(self):
+        """ stops the worker processes """
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,41 @@
+"""
+Shared fixtures: small synthetic data sets of the ExpSRP model
+"""
+
+import numpy as np
+import pytest
+from srplasticity.srp import ExpSRP
+
+MU_TAUS = [15, 100]
+SIGMA_TAUS = [15, 100]
+
+# parameter vector [mu_baseline, *mu_amps, sigma_baseline, *sigma_amps, sigma_scale]
+TRUE_X = np.array([-1.5, 0.5, 1.0, -1.8, 0.3, 0.1, 4.0])
+
+
+def simulate(stimulus_dict, ntrials=100, seed=0, x=TRUE_X):
+    model = ExpSRP(x[0], x[1:3], MU_TAUS, x[3], x[4:6], SIGMA_TAUS, sigma_scale=x[6])
+    np.random.seed(seed)
+    return {
+        key: model.run_ISIvec(isivec, ntrials=ntrials)[2]
+        for key, isivec in stimulus_dict.items()
+    }
+
+
+@pytest.fixture
+def stimulus_dict():
+    return {
+        "20hz": np.array([0, 50, 50, 50, 50, 50, 50, 50.0]),
+        "50hz": np.array([0, 20, 20, 20, 20, 20, 20.0]),
+        "100hz": np.array([0, 10, 10, 10, 10, 10.0]),
+    }
+
+
+@pytest.fixture
+def target_dict(stimulus_dict):
+    return simulate(stimulus_dict)
+
+
+@pytest.fixture
+def target_dicts(stimulus_dict):
+    return [simulate(stimulus_dict, seed=seed) for seed in (1, 2)]
@@ -0,0 +1,109 @@
+"""
+Tests of the distributed execution backend: brokers, executor and local workers
+"""
+
+import os
+import time
+import pytest
+from srplasticity.distributed import (
+    DirectoryBroker,
+    SocketBroker,
+    DistributedExecutor,
+    start_workers,
+)
+
+
+def square(x):
+    return x * x
+
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError("three")
+    return x
+
+
+def crash_once(task):
+    """ kills its worker the first time it is called with x = 3 """
+    marker, x = task
+    if x == 3 and not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return x * x
+
+
+@pytest.fixture(params=["directory", "socket"])
+def executor(request, tmp_path):
+    if request.param == "directory":
+        broker = DirectoryBroker(tmp_path / "queue", lease=3.0)
+        executor = DistributedExecutor(broker)
+        workers = start_workers(2, directory=broker.path)
+    else:
+        broker = SocketBroker()
+        executor = DistributedExecutor(broker)
+        workers = start_workers(2, address=broker.address, authkey=broker.authkey)
+
+    yield executor
+
+    executor.close()
+    for worker in workers:
+        worker.join(timeout=30)
+        if worker.is_alive():
+            worker.terminate()
+
+
+def test_map(executor):
+    assert list(executor.map(square, range(20))) == [x * x for x in range(20)]
+
+
+def test_map_unordered(executor):
+    results = list(executor.map_unordered(square, range(20)))
+    assert sorted(results) == [x * x for x in range(20)]
+
+
+def test_failing_task(executor):
+    with pytest.raises(RuntimeError, match="Task 3 failed"):
+        list(executor.map(fail_on_three, range(6)))
+
+    # the executor is still usable after a failed map
+    assert list(executor.map(square, range(4))) == [0, 1, 4, 9]
+
+
+def test_killed_worker(executor, tmp_path):
+    marker = str(tmp_path / "crashed")
+    tasks = [(marker, x) for x in range(6)]
+
+    assert list(executor.map(crash_once, tasks)) == [x * x for x in range(6)]
+    assert os.path.exists(marker)
+
+
+def sleep_after_three(x):
+    if x > 3:
+        time.sleep(0.5)
+    return fail_on_three(x)
+
+
+def test_cleanup(executor):
+    broker = executor.broker
+    assert list(executor.map(square, range(4))) == [0, 1, 4, 9]
+    with pytest.raises(RuntimeError, match="Task 3 failed"):
+        list(executor.map(sleep_after_three, range(8)))
+
+    # functions are retracted after their maps, and results of tasks that still ran
+    # after the failed map was cancelled are discarded
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if isinstance(broker, DirectoryBroker):
+            left = [
+                path.name
+                for subdir in ("functions", "tasks", "claimed", "results")
+                for path in (broker.path / subdir).iterdir()
+            ]
+        else:
+            with broker._lock:
+                left = list(broker._functions) + list(broker._results)
+                left += list(broker._tasks)
+        if not left:
+            break
+        time.sleep(0.1)
+    assert left == []
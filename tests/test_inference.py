@@ -0,0 +1,850 @@
+"""
+Tests of the fitting procedures of the SRP model
+"""
+
+import numpy as np
+import pytest
+import srplasticity.inference as inference
+from scipy.optimize import OptimizeResult, approx_fprime, minimize, rosen, rosen_der
+from srplasticity.inference import (
+    _map_starts,
+    _minimize_batch,
+    _race_starts,
+    _setup_gridsearch,
+    BasinClusters,
+    CrossValidationObjective,
+    HierarchicalSRPObjective,
+    IncrementalSRPFit,
+    LatinHypercubeDesign,
+    SobolDesign,
+    StartDesign,
+    StratifiedDesign,
+    SRPObjective,
+    fit_srp_model,
+    fit_srp_model_basinhopping,
+    fit_srp_model_batch,
+    fit_srp_model_crossvalidation,
+    fit_srp_model_gridsearch,
+    fit_srp_model_hierarchical,
+    fit_srp_model_stochastic,
+    nll_landscape,
+    nll_profile,
+)
+from srplasticity.store import Checkpoint
+from srplasticity.tools import MinimizeWrapper
+from conftest import MU_TAUS, SIGMA_TAUS, TRUE_X
+
+GRID = (slice(-2, 0, 0.5), slice(-2, 0, 0.5))
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# BATCH FITTING
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_minimize_batch_matches_scipy():
+    # independent, bound-constrained Rosenbrock problems
+    x0 = np.array([[-1.2, 1.0], [0.5, 0.5], [2.0, -1.0]])
+    bounds = [(-2, 2), (-0.5, 1.5)]
+
+    def fun(X, rows):
+        return np.array([rosen(x) for x in X]), np.array([rosen_der(x) for x in X])
+
+    results = _minimize_batch(fun, x0, bounds)
+    for x, res in zip(x0, results):
+        ref = minimize(rosen, x, jac=rosen_der, method="L-BFGS-B", bounds=bounds)
+        assert res["success"]
+        np.testing.assert_allclose(res["x"], ref["x"], atol=1e-4)
+        np.testing.assert_allclose(res["fun"], ref["fun"], atol=1e-8)
+
+
+def test_batch_fit_matches_single_fits(stimulus_dict, target_dicts):
+    _, bestsols = fit_srp_model_batch(
+        stimulus_dict, target_dicts, MU_TAUS, SIGMA_TAUS, initial_guess=TRUE_X
+    )
+    assert len(bestsols) == len(target_dicts)
+
+    for target_dict, res in zip(target_dicts, bestsols):
+        _, ref = fit_srp_model(TRUE_X, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+        # the likelihood is flat along some directions: compare the optimal losses
+        np.testing.assert_allclose(res["fun"], ref["fun"], rtol=1e-5)
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# HIERARCHICAL FITTING
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_hierarchical_gradient(stimulus_dict, target_dicts):
+    objective = HierarchicalSRPObjective(
+        stimulus_dict, target_dicts, MU_TAUS, SIGMA_TAUS
+    )
+    x = objective.to_joint(TRUE_X)
+    fun, jac = objective(x)
+
+    assert np.isfinite(fun)
+    np.testing.assert_allclose(
+        jac, approx_fprime(x, lambda x: objective(x)[0], 1e-6), rtol=1e-4, atol=1e-3
+    )
+
+
+def test_hierarchical_without_sharing_matches_single_fits(stimulus_dict, target_dicts):
+    _, res = fit_srp_model_hierarchical(
+        TRUE_X, stimulus_dict, target_dicts, MU_TAUS, SIGMA_TAUS, shared=()
+    )
+    single = [
+        fit_srp_model(TRUE_X, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)[1]
+        for target_dict in target_dicts
+    ]
+    np.testing.assert_allclose(res["fun"], sum(ref["fun"] for ref in single), rtol=1e-5)
+
+
+def test_hierarchical_shares_parameters(stimulus_dict, target_dicts):
+    params, res = fit_srp_model_hierarchical(
+        TRUE_X, stimulus_dict, target_dicts, MU_TAUS, SIGMA_TAUS
+    )
+    assert res["success"]
+    assert len(params) == len(target_dicts)
+
+    # shared kernel amplitudes, individual baselines
+    np.testing.assert_array_equal(params[0][1], params[1][1])
+    np.testing.assert_array_equal(params[0][4], params[1][4])
+    assert params[0][0] != params[1][0]
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# STOCHASTIC FITTING
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_segments_add_up_to_full_objective(stimulus_dict, target_dict):
+    objective = SRPObjective(stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+    segmented = objective.segment(3)
+
+    assert len(segmented.keys) > len(objective.keys)
+    fun, jac = objective(TRUE_X)
+    seg_fun, seg_jac = segmented(TRUE_X)
+    np.testing.assert_allclose(seg_fun, fun, rtol=1e-12)
+    np.testing.assert_allclose(seg_jac, jac, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize("method", ["adam", "svrg"])
+def test_stochastic_fit(stimulus_dict, target_dict, method):
+    x0 = TRUE_X + 0.3
+    kwargs = dict(segment_length=3, batch_size=2, epochs=3, method=method, seed=0)
+
+    _, res = fit_srp_model_stochastic(
+        x0, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, polish=False, **kwargs
+    )
+    _, again = fit_srp_model_stochastic(
+        x0, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, polish=False, **kwargs
+    )
+    start_loss = SRPObjective(stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)(x0)[0]
+
+    # seeded runs are reproducible and improve on the start
+    np.testing.assert_array_equal(res["x"], again["x"])
+    assert res["fun"] < start_loss
+    assert res["data_passes"] > 0
+
+    # the full-batch polish reaches the optimum of a regular fit
+    _, polished = fit_srp_model_stochastic(
+        x0, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, **kwargs
+    )
+    _, ref = fit_srp_model(x0, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+    np.testing.assert_allclose(polished["fun"], ref["fun"], rtol=1e-5)
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# INCREMENTAL FITTING
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_partial_fit_matches_full_refit(stimulus_dict, target_dict):
+    # first half of the sweeps of two protocols are recorded before the fit starts
+    initial = {key: target_dict[key][:50] for key in ("20hz", "50hz")}
+    fit = IncrementalSRPFit(
+        TRUE_X, stimulus_dict, MU_TAUS, SIGMA_TAUS, target_dict=initial
+    )
+
+    for key in ("20hz", "50hz"):
+        fit.partial_fit(key, target_dict[key][50:])
+    warm_start = fit.x.copy()
+    params, res = fit.partial_fit("100hz", target_dict["100hz"])
+
+    full = SRPObjective(stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+    np.testing.assert_allclose(fit.objective(TRUE_X)[0], full(TRUE_X)[0], rtol=1e-12)
+
+    # same warm start and same data give the same optimum as a full refit
+    _, ref = fit_srp_model(warm_start, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+    np.testing.assert_allclose(res["fun"], ref["fun"], rtol=1e-6)
+    assert params[0] == res["x"][0]
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# RACING
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_racing_keeps_best_starts():
+    starts = np.array([[x, y] for x in (-1.5, 0.0, 1.5) for y in (-1.0, 2.0, 3.0)])
+    minimizer = MinimizeWrapper(rosen, (), jac=rosen_der, method="L-BFGS-B")
+    first_rung = MinimizeWrapper(
+        rosen, (), jac=rosen_der, method="L-BFGS-B", options={"maxiter": 2}
+    )
+
+    rung = _map_starts(first_rung, starts, 1)
+    listres = _race_starts(minimizer, starts, [2], 0.25, 1)
+
+    # the best quarter of the unfinished starts of the first rung is run to convergence
+    unfinished = [ix for ix, res in enumerate(rung) if not res["success"]]
+    ranked = sorted(unfinished, key=lambda ix: rung[ix]["fun"])
+    survivors = ranked[: int(np.ceil(0.25 * len(unfinished)))]
+    continued = [ix for ix, res in enumerate(listres) if res["nit"] > 2]
+
+    assert continued == sorted(survivors)
+    for ix in survivors:
+        assert listres[ix]["success"]
+        np.testing.assert_allclose(listres[ix]["x"], [1, 1], atol=1e-4)
+
+
+def test_racing_gridsearch(stimulus_dict, target_dict):
+    kwargs = dict(param_ranges=GRID, sigma_scale=4)
+    _, _, _, fval, _ = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, **kwargs
+    )
+    _, bestsol, starts, race_fval, _ = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, racing_rungs=[3], **kwargs
+    )
+
+    assert len(race_fval) == len(fval) == len(starts)
+    assert np.nanmin(race_fval) <= np.min(fval) + 1e-2
+    assert bestsol["nit"] > 3
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# CHECKPOINTS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_gridsearch_resumes_from_checkpoint(stimulus_dict, target_dict, tmp_path):
+    kwargs = dict(param_ranges=GRID, sigma_scale=4, checkpoint=tmp_path / "journal")
+    completed = []
+
+    def interrupt(res, best):
+        completed.append(res)
+        return len(completed) == 3
+
+    fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, callback=interrupt, **kwargs
+    )
+    assert len(completed) == 3
+
+    # only the remaining starts are run when resuming
+    completed.clear()
+    _, bestsol, starts, fval, _ = fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        callback=lambda res, best: completed.append(res),
+        **kwargs
+    )
+    assert len(completed) == len(starts) - 3
+
+    _, ref_bestsol, _, ref_fval, _ = fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        param_ranges=GRID,
+        sigma_scale=4,
+    )
+    np.testing.assert_array_equal(fval, ref_fval)
+    np.testing.assert_array_equal(bestsol["x"], ref_bestsol["x"])
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# CROSS-VALIDATION
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def fold_gridsearches(stimulus_dict, target_dict):
+    """ best solutions of independent grid searches of all leave-one-protocol-out folds """
+    bestsols = {}
+    for testkey in target_dict:
+        train_dict = {key: val for key, val in target_dict.items() if key != testkey}
+        bestsols[testkey] = fit_srp_model_gridsearch(
+            stimulus_dict,
+            train_dict,
+            MU_TAUS,
+            SIGMA_TAUS,
+            param_ranges=GRID,
+            sigma_scale=4,
+        )[1]
+    return bestsols
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"tol": 1e-9}], ids=["batched", "scipy"])
+def test_warm_started_crossvalidation(stimulus_dict, target_dict, kwargs):
+    _, bestsol, _, fold_bestsols = fit_srp_model_crossvalidation(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        param_ranges=GRID,
+        sigma_scale=4,
+        **kwargs
+    )
+    reference = fold_gridsearches(stimulus_dict, target_dict)
+
+    assert set(fold_bestsols) == set(target_dict)
+    for testkey, res in fold_bestsols.items():
+        assert res["success"]
+        assert res["fun"] < bestsol["fun"]
+        # warm starts are close to the optimum of a grid search of the fold
+        np.testing.assert_allclose(res["fun"], reference[testkey]["fun"], rtol=1e-3)
+
+
+def test_crossvalidation_grid_restart(stimulus_dict, target_dict):
+    # with a negative tolerance, every fold is refitted with the full grid search
+    _, _, _, fold_bestsols = fit_srp_model_crossvalidation(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        param_ranges=GRID,
+        sigma_scale=4,
+        restart_tol=-1,
+    )
+    reference = fold_gridsearches(stimulus_dict, target_dict)
+
+    for testkey, res in fold_bestsols.items():
+        assert res["grid_restart"]
+        assert res["fun"] <= reference[testkey]["fun"] + 1e-6
+
+
+@pytest.mark.parametrize(
+    "options, batched", [({"maxiter": 1000}, True), ({"maxfun": 1000}, False)]
+)
+def test_crossvalidation_unsupported_options(
+    stimulus_dict, target_dict, monkeypatch, options, batched
+):
+    calls = []
+
+    def minimize_batch(*args, **kwargs):
+        calls.append(kwargs)
+        return _minimize_batch(*args, **kwargs)
+
+    monkeypatch.setattr(inference, "_minimize_batch", minimize_batch)
+    _, _, _, fold_bestsols = fit_srp_model_crossvalidation(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        param_ranges=GRID,
+        sigma_scale=4,
+        options=options,
+    )
+
+    # options the batched method does not support fall back to scipy
+    assert bool(calls) == batched
+    assert all(res["success"] for res in fold_bestsols.values())
+
+
+def test_minimize_batch_rejects_unsupported_options(stimulus_dict, target_dicts):
+    with pytest.raises(ValueError, match="maxfun"):
+        _minimize_batch(lambda X, rows: (X.sum(1), np.ones(X.shape)), [[1.0]], maxfun=5)
+    with pytest.raises(ValueError, match="eps"):
+        fit_srp_model_batch(
+            stimulus_dict,
+            target_dicts,
+            MU_TAUS,
+            SIGMA_TAUS,
+            initial_guess=TRUE_X,
+            options={"eps": 1e-8},
+        )
+
+
+@pytest.mark.parametrize("loss", ["default", "equal"])
+def test_crossvalidation_objective(stimulus_dict, target_dict, loss):
+    testkeys = list(target_dict)
+    crossvalidation = CrossValidationObjective(
+        SRPObjective(stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, loss=loss),
+        testkeys,
+    )
+    X = np.array([TRUE_X, TRUE_X + 0.1, TRUE_X - 0.1])
+
+    fold_losses = crossvalidation.fold_losses(X)
+    for fold, testkey in enumerate(testkeys):
+        train_dict = {key: val for key, val in target_dict.items() if key != testkey}
+        train = SRPObjective(stimulus_dict, train_dict, MU_TAUS, SIGMA_TAUS, loss=loss)
+        loss_ref, grad_ref = train.loss_and_grad(X)
+
+        fun, grad = crossvalidation.loss_and_grad(X, np.full(len(X), fold))
+        np.testing.assert_allclose(fold_losses[:, fold], loss_ref, rtol=1e-10)
+        np.testing.assert_allclose(fun, loss_ref, rtol=1e-10)
+        np.testing.assert_allclose(grad, grad_ref, rtol=1e-8, atol=1e-10)
+
+
+def test_crossvalidation_contributions_are_cached(stimulus_dict, target_dict):
+    crossvalidation = CrossValidationObjective(
+        SRPObjective(stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS),
+        list(target_dict),
+        cache_size=3,
+    )
+    X = np.array([TRUE_X, TRUE_X + 0.1])
+    losses, _ = crossvalidation.contributions(X)
+    assert len(crossvalidation._cache) == 2
+
+    # the total of all contributions is the loss on all protocols
+    np.testing.assert_allclose(
+        losses.sum(1), crossvalidation.objective.loss_and_grad(X)[0], rtol=1e-10
+    )
+
+    # cached rows are not evaluated again, the cache is cleared once it is full
+    crossvalidation.contributions(X[::-1])
+    assert len(crossvalidation._cache) == 2
+    crossvalidation.contributions(X + 0.2)
+    assert len(crossvalidation._cache) == 2
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# LAPLACE APPROXIMATION
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+@pytest.mark.parametrize("x", [TRUE_X, TRUE_X + 0.2])
+def test_hessian_matches_finite_differences(stimulus_dict, target_dict, x):
+    objective = SRPObjective(stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+    hessian = objective.hessian(x)
+
+    eps = 1e-6
+    numerical = np.array(
+        [
+            (objective(x + eps * step)[1] - objective(x - eps * step)[1]) / (2 * eps)
+            for step in np.eye(len(x))
+        ]
+    )
+    np.testing.assert_allclose(hessian, hessian.T, rtol=1e-12)
+    np.testing.assert_allclose(hessian, numerical, rtol=1e-5, atol=1e-4)
+
+
+def test_laplace_approximation(stimulus_dict, target_dict):
+    _, res = fit_srp_model(
+        TRUE_X, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, uncertainty=True
+    )
+
+    assert res["stderr"].shape == TRUE_X.shape
+    assert np.all(res["stderr"] >= 0)
+    for key, bands in res["prediction_bands"].items():
+        lower, mean, upper = bands
+        assert mean.shape == stimulus_dict[key].shape
+        assert np.all(lower <= mean) and np.all(mean <= upper)
+
+    with pytest.raises(ValueError):
+        fit_srp_model(
+            TRUE_X,
+            stimulus_dict,
+            target_dict,
+            MU_TAUS,
+            SIGMA_TAUS,
+            loss="equal",
+            uncertainty=True,
+        )
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# LANDSCAPES AND PROFILES
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_nll_landscape(stimulus_dict, target_dict):
+    axes = {"mu_baseline": np.linspace(-2, -1, 4), 6: np.linspace(3, 5, 3)}
+    # a small memory budget splits the grid into several batches
+    landscape = nll_landscape(
+        TRUE_X,
+        axes,
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        memory_budget=2 ** 12,
+    )
+    objective = SRPObjective(stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+
+    assert landscape.shape == (4, 3)
+    for i, mu_baseline in enumerate(axes["mu_baseline"]):
+        for j, sigma_scale in enumerate(axes[6]):
+            x = TRUE_X.copy()
+            x[0], x[6] = mu_baseline, sigma_scale
+            np.testing.assert_allclose(landscape[i, j], objective(x)[0], rtol=1e-12)
+
+    with pytest.raises(ValueError):
+        nll_landscape(
+            TRUE_X, {"mu_amps": [0, 1]}, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS
+        )
+
+
+def test_nll_profile(stimulus_dict, target_dict):
+    _, res = fit_srp_model(TRUE_X, stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+    optimum = res["x"]
+    values = optimum[6] + np.array([0.5, -0.5, 0.0, 1.0])
+
+    profile = nll_profile(
+        optimum,
+        {"sigma_scale": values},
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+    )["sigma_scale"]
+
+    np.testing.assert_array_equal(profile["values"], np.sort(values))
+    np.testing.assert_array_equal(profile["x"][:, 6], profile["values"])
+    # the profile is minimal at the optimum, and never above the landscape
+    np.testing.assert_allclose(profile["nll"][1], res["fun"], rtol=1e-6)
+    assert np.all(profile["nll"] >= res["fun"] - 1e-6 * abs(res["fun"]))
+    landscape = nll_landscape(
+        optimum,
+        {"sigma_scale": profile["values"]},
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+    )
+    assert np.all(profile["nll"] <= landscape + 1e-8)
+
+
+def test_checkpoint_skips_unreproducible_starts(stimulus_dict, target_dict, tmp_path):
+    journal = tmp_path / "journal"
+    kwargs = dict(param_ranges=GRID, sigma_scale=4, checkpoint=journal, max_nfev=3)
+
+    *_, table = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, **kwargs
+    )
+    assert np.all(table["budget_exceeded"])
+
+    # starts cut short by their budget are run again when resuming
+    assert Checkpoint(journal).load() == {}
+    completed = []
+    fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        callback=lambda res, best: completed.append(res),
+        **kwargs
+    )
+    assert len(completed) == len(table)
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# CACHE
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_gridsearch_cache(stimulus_dict, target_dict, tmp_path):
+    kwargs = dict(sigma_scale=4, cache=tmp_path / "cache")
+    completed = []
+
+    def count(res, best):
+        completed.append(res)
+
+    first = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, GRID, callback=count, **kwargs
+    )
+    assert len(completed) == len(first[2])
+
+    # the same fit is loaded from the cache
+    completed.clear()
+    second = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, GRID, callback=count, **kwargs
+    )
+    assert not completed
+    np.testing.assert_array_equal(second[3], first[3])
+
+    # a larger grid only runs the new starts
+    larger = (slice(-2, 0.5, 0.5), slice(-2, 0, 0.5))
+    third = fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        larger,
+        callback=count,
+        **kwargs
+    )
+    assert len(completed) == len(third[2]) - len(first[2])
+    assert np.min(third[3]) <= np.min(first[3])
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# SCREENING
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+@pytest.mark.parametrize("diverse", [False, True])
+def test_screening_keeps_best_start(stimulus_dict, target_dict, diverse):
+    _, grid_starts = _setup_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        GRID,
+        None,
+        4,
+        "default",
+        "L-BFGS-B",
+        "default",
+    )
+    objective = SRPObjective(stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS)
+    grid_loss = objective.loss_and_grad(grid_starts, jac=False)[0]
+    ranked = grid_starts[np.argsort(grid_loss)]
+
+    _, _, starts, fval, _ = fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        GRID,
+        sigma_scale=4,
+        screen=4,
+        screen_diverse=diverse,
+    )
+
+    assert len(starts) == len(fval) == 4
+    np.testing.assert_allclose(starts[0], ranked[0])
+    if diverse:
+        # distinct starts among the better half of the grid
+        assert len(np.unique(starts, axis=0)) == 4
+        better_half = {tuple(x) for x in np.round(ranked[: len(ranked) // 2], 12)}
+        assert {tuple(x) for x in np.round(starts, 12)} <= better_half
+    else:
+        np.testing.assert_allclose(starts, ranked[:4])
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# START DESIGNS
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+@pytest.mark.parametrize(
+    "design", [SobolDesign, LatinHypercubeDesign, StratifiedDesign]
+)
+def test_start_design_bounds(design):
+    ranges = [(-2, 0), slice(-2, 0, 0.5), (1, 10)]
+    lower, upper = np.array([-1.5, -3, 0]), np.array([0, -1, 20])
+    starts = design(20, ranges, seed=1, blocksize=8)
+
+    blocks = list(starts.blocks(lower, upper))
+    points = np.concatenate(blocks)
+    assert [len(block) for block in blocks] == [8, 8, 4]
+    assert points.shape == (len(starts), 3)
+
+    # within the ranges intersected with the bounds
+    low, high = np.array([-1.5, -2, 1]), np.array([0, -1, 10])
+    assert np.all(points >= low) and np.all(points <= high)
+
+    # starts are reproducible
+    np.testing.assert_array_equal(
+        points, np.concatenate(list(starts.blocks(lower, upper)))
+    )
+
+
+def test_latin_hypercube_strata():
+    points = np.concatenate(
+        list(LatinHypercubeDesign(10, [(0, 1), (0, 1)], seed=0).blocks())
+    )
+    for column in points.T:
+        np.testing.assert_array_equal(np.sort(np.floor(column * 10)), np.arange(10))
+
+
+def test_stratified_cells():
+    points = np.concatenate(
+        list(StratifiedDesign(10, [(0, 1), (0, 1)], seed=0).blocks())
+    )
+    # one start in each of the 3 x 3 cells, the last start anywhere
+    cells = {tuple(cell) for cell in np.floor(points[:9] * 3).astype(int)}
+    assert len(cells) == 9
+
+
+def test_start_design_gridsearch(stimulus_dict, target_dict):
+    with pytest.raises(TypeError):
+        StartDesign(8)
+
+    design = SobolDesign(8, [(-2, 0), (-2, 0)], seed=0)
+    _, bestsol, starts, fval, _ = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, design, sigma_scale=4
+    )
+    assert len(starts) == len(fval) == 8
+    assert np.all(starts[:, 0] >= -2) and np.all(starts[:, 0] <= 0)
+    assert bestsol["success"]
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# BASIN-HOPPING
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def test_basinhopping(stimulus_dict, target_dict, tmp_path):
+    kwargs = dict(param_ranges=GRID, sigma_scale=4, n_chains=3, niter=3, seed=0)
+    _, bestsol, starts, fval, table = fit_srp_model_basinhopping(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, **kwargs
+    )
+
+    # the chains start from 3 screened grid points, and improve on their first minima
+    assert len(table) == len(starts) == len(fval)
+    assert 3 < len(fval) <= 3 * (1 + 3)
+    assert bestsol["success"]
+    assert bestsol["fun"] == np.nanmin(fval) <= np.nanmin(fval[:3])
+
+    # seeded runs are reproducible, also when resumed from a checkpoint
+    for _ in range(2):
+        _, _, again_starts, again_fval, _ = fit_srp_model_basinhopping(
+            stimulus_dict,
+            target_dict,
+            MU_TAUS,
+            SIGMA_TAUS,
+            checkpoint=tmp_path / "journal",
+            **kwargs
+        )
+        np.testing.assert_array_equal(again_starts, starts)
+        np.testing.assert_array_equal(again_fval, fval)
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+# BASINS AND EARLY STOPPING
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def optimum(x, fun, success=True):
+    return OptimizeResult(x=np.array(x, dtype=float), fun=fun, success=success)
+
+
+def test_basin_clusters():
+    basins = BasinClusters(np.array([1.0, 10.0]), tol=0.1, ftol=1e-2)
+
+    assert basins.add(optimum([0, 0], 5.0)) == 0
+    # close in rescaled parameter space
+    assert basins.add(optimum([0.05, 0.5], 4.0)) == 0
+    # far away, but the same loss (flat direction)
+    assert basins.add(optimum([3, 0], 4.005)) == 0
+    # a distinct optimum
+    assert basins.add(optimum([3, 0], 2.0)) == 1
+    assert basins.add(optimum([0, 0], 1.0, success=False)) == -1
+
+    summary = basins.summary()
+    np.testing.assert_array_equal(summary["count"], [3, 1])
+    np.testing.assert_array_equal(summary["fun"], [4.0, 2.0])
+    np.testing.assert_array_equal(summary["x"][0], [0.05, 0.5])
+
+    # one singleton among 4 starts in 2 basins: (1 + 1) / (4 + 1) / (2 + 1)
+    np.testing.assert_allclose(basins.p_unseen_better(), 2 / 15)
+
+
+def test_basin_clusters_stop_rule():
+    basins = BasinClusters(np.ones(2), threshold=0.05)
+    stops = [basins(optimum([0, 0], 1.0), None) for _ in range(12)]
+    # p = 1 / (n + 1) / 2 for n > 1 starts in one basin
+    assert stops == [n >= 10 for n in range(1, 13)]
+
+
+def test_gridsearch_stops_early(stimulus_dict, target_dict):
+    kwargs = dict(param_ranges=GRID, sigma_scale=4, stop_threshold=0.05, seed=0)
+    _, bestsol, starts, fval, table = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, **kwargs
+    )
+    not_run = table["message"] == "Not run"
+
+    assert 0 < np.count_nonzero(not_run) < len(starts)
+    assert np.all(np.isnan(fval[not_run]))
+    assert bestsol["fun"] == np.nanmin(fval)
+
+    # the random order of the starts is seeded
+    again = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, **kwargs
+    )
+    np.testing.assert_array_equal(again[2], starts)
+    np.testing.assert_array_equal(again[3], fval)
+
+
+def test_resumed_gridsearch_stops_early(stimulus_dict, target_dict, tmp_path):
+    kwargs = dict(param_ranges=GRID, sigma_scale=4, stop_threshold=0.05, seed=0)
+    completed = []
+
+    def interrupt(res, best):
+        completed.append(res)
+        return len(completed) == 3
+
+    *_, reference = fit_srp_model_gridsearch(
+        stimulus_dict, target_dict, MU_TAUS, SIGMA_TAUS, **kwargs
+    )
+    nrun = np.count_nonzero(reference["message"] != "Not run")
+    assert nrun > 3
+
+    # starts read from the checkpoint count towards the stop rule
+    checkpoint = tmp_path / "journal"
+    fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        checkpoint=checkpoint,
+        callback=interrupt,
+        **kwargs
+    )
+    completed.clear()
+    *_, table = fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        checkpoint=checkpoint,
+        callback=lambda res, best: completed.append(res),
+        **kwargs
+    )
+    assert len(completed) == nrun - 3
+    np.testing.assert_array_equal(
+        table["message"] == "Not run", reference["message"] == "Not run"
+    )
+
+    # a completed search does not run further starts
+    completed.clear()
+    fit_srp_model_gridsearch(
+        stimulus_dict,
+        target_dict,
+        MU_TAUS,
+        SIGMA_TAUS,
+        checkpoint=checkpoint,
+        callback=lambda res, best: completed.append(res),
+        **kwargs
+    )
+    assert not completed
@@ -0,0 +1,77 @@
+"""
+Tests of the model classes and their pure evaluation functions
+"""
+
+import numpy as np
+import pytest
+from srplasticity.srp import ExpSRP, _sigmoid
+from srplasticity.tm import (
+    AdaptedTsodyksMarkramModel,
+    TMParameters,
+    TsodyksMarkramModel,
+)
+
+ISIVEC = np.array([0, 20, 20, 50, 10, 100.0])
+
+
+def test_exp_srp_custom_nonlinearity():
+    model = ExpSRP(-1.5, [0.5, 1], [15, 100], -1.8, [0.3, 0.1], [15, 100])
+    means, sigmas, _ = model.run_ISIvec(ISIVEC, ntrials=0)
+
+    model.nlin = lambda x: 2 * _sigmoid(x)
+    custom_means, custom_sigmas, _ = model.run_ISIvec(ISIVEC, ntrials=0)
+
+    np.testing.assert_allclose(custom_means, 2 * means)
+    np.testing.assert_allclose(custom_sigmas, 2 * sigmas)
+
+
+def test_tm_attributes_are_assignable():
+    model = TsodyksMarkramModel(0.2, 0.1, 100, 200)
+    params = model.params
+
+    model.u = 0.5
+    model.r = 0.8
+    model.U = 0.3
+    assert (model.u, model.r, model.U) == (0.5, 0.8, 0.3)
+    assert model._efficacy == 0.5 * 0.8 * (1 / 0.2)
+
+    # parameters are replaced, not modified
+    assert params == TMParameters(0.2, 0.1, 100, 200)
+    assert model.params == TMParameters(0.3, 0.1, 100, 200, 1 / 0.2)
+
+    model.reset()
+    assert (model.u, model.r) == (0.3, 1)
+
+
+@pytest.mark.parametrize("cls", [TsodyksMarkramModel, AdaptedTsodyksMarkramModel])
+def test_tm_update_matches_recurrences(cls):
+    model = cls(0.2, 0.1, 100, 200)
+    reference = cls(0.2, 0.1, 100, 200)
+
+    efficacies = []
+    for spike, dt in enumerate(ISIVEC):
+        if spike > 0:
+            reference._update(dt)
+        efficacies.append(reference._efficacy)
+
+    np.testing.assert_allclose(model.run_ISIvec(ISIVEC), efficacies)
+    np.testing.assert_allclose([model.u, model.r], [reference.u, reference.r])
+
+
+@pytest.mark.parametrize("cls", [TsodyksMarkramModel, AdaptedTsodyksMarkramModel])
+def test_tm_update_ode_matches_recurrences(cls):
+    spiketrain = np.zeros(2000)
+    spiketrain[[100, 300, 400, 1500]] = 1
+    model = cls(0.2, 0.1, 100, 200)
+    reference = cls(0.2, 0.1, 100, 200)
+
+    output = model.run_spiketrain(spiketrain, dt=0.1)
+    u, r = [], []
+    for s in spiketrain:
+        reference._update_ode(0.1, s)
+        u.append(reference.u)
+        r.append(reference.r)
+
+    np.testing.assert_allclose(output["u"], u)
+    np.testing.assert_allclose(output["r"], r)
+    np.testing.assert_allclose([model.u, model.r], [reference.u, reference.r])
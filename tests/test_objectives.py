@@ -0,0 +1,82 @@
+"""
+Tests of the default objectives, which are evaluated from sufficient statistics of the
+targets, against the original objective functions on the full response matrices
+"""
+
+import numpy as np
+import pytest
+from srplasticity.inference import _make_objective, _objective_function
+from srplasticity.srp import ExpSRP
+from srplasticity.tm import (
+    _tm_objective,
+    _objective_function as _tm_objective_function,
+)
+
+MU_TAUS = [15, 100]
+SIGMA_TAUS = [15, 100]
+STIMULI = {
+    "20hz": np.array([0, 50, 50, 50, 50.0]),
+    "50hz": np.array([0, 20, 20, 20.0]),
+}
+X = np.array([-1.4, 0.4, 1.1, -1.7, 0.3, 0.2, 3.5])
+
+
+def targets(seed=0):
+    model = ExpSRP(-1.5, [0.5, 1], MU_TAUS, -1.8, [0.3, 0.1], SIGMA_TAUS, sigma_scale=4)
+    np.random.seed(seed)
+    return {
+        key: model.run_ISIvec(isivec, ntrials=20)[2] for key, isivec in STIMULI.items()
+    }
+
+
+def srp_losses(target_dict, loss):
+    objective, args, jac = _make_objective(
+        STIMULI, target_dict, MU_TAUS, SIGMA_TAUS, None, loss
+    )
+    assert jac
+    new = objective(X, *args)[0]
+    old = _objective_function(X, target_dict, STIMULI, MU_TAUS, SIGMA_TAUS, None, loss)
+    return new, old
+
+
+@pytest.mark.parametrize("loss", ["default", "equal"])
+def test_srp_objective_with_missing_values(loss):
+    target_dict = targets()
+    target_dict["20hz"][[0, 3], [1, 4]] = np.nan
+    target_dict["50hz"][:, 2] = np.nan
+
+    new, old = srp_losses(target_dict, loss)
+    assert np.isfinite(new)
+    np.testing.assert_allclose(new, old, rtol=1e-10)
+
+
+def test_srp_objective_with_negative_values():
+    target_dict = targets()
+    target_dict["20hz"][[0, 3], [1, 4]] = np.nan
+    target_dict["20hz"][2, 2] = -0.5
+    target_dict["50hz"][[1, 5], [0, 3]] = -1.0
+
+    new, old = srp_losses(target_dict, "default")
+    assert np.isfinite(new)
+    np.testing.assert_allclose(new, old, rtol=1e-10)
+
+
+def test_srp_objective_with_zero_values():
+    target_dict = targets()
+    target_dict["20hz"][2, 2] = 0.0
+
+    new, old = srp_losses(target_dict, "default")
+    assert new == old == np.inf
+
+
+@pytest.mark.parametrize("loss", ["default", "equal"])
+def test_tm_objective_with_invalid_values(loss):
+    target_dict = targets()
+    target_dict["20hz"][[0, 3], [1, 4]] = np.nan
+    target_dict["20hz"][2, 2] = -0.5
+    target_dict["50hz"][5, 0] = 0.0
+
+    x = np.array([0.3, 0.2, 100.0, 300.0, 1.0])
+    objective, args = _tm_objective(STIMULI, target_dict, loss)
+    old = _tm_objective_function(x, target_dict, STIMULI, loss)
+    np.testing.assert_allclose(objective(x, *args), old, rtol=1e-10)
@@ -0,0 +1,77 @@
+"""
+Tests of the per-spike recurrences: compiled (numba) and NumPy implementations agree
+"""
+
+import numpy as np
+import pytest
+from srplasticity import _recurrences
+from srplasticity._recurrences import (
+    _exp_kernel_states_loops,
+    _exp_kernel_states_numpy,
+    exp_kernel_states,
+    tm_isivec,
+    tm_spiketrain,
+)
+
+TM_PARAMS = dict(U=0.2, f=0.3, tau_u=50.0, tau_r=200.0, amp=2.0)
+
+
+@pytest.fixture
+def isivec():
+    return np.concatenate([[0], np.random.default_rng(0).uniform(5, 100, 30)])
+
+
+@pytest.fixture
+def spiketrain():
+    spiketrain = np.zeros(2000)
+    spiketrain[np.random.default_rng(1).choice(2000, 40, replace=False)] = 1
+    return spiketrain
+
+
+def test_exp_kernel_loops_match_numpy(isivec):
+    amps = np.array([0.5, -1.0, 2.0])
+    taus = np.array([15.0, 100.0, 650.0])
+    state = np.array([0.1, 0.2, -0.3])
+
+    np.testing.assert_allclose(
+        _exp_kernel_states_loops(isivec, amps, taus, state),
+        _exp_kernel_states_numpy(isivec, amps, taus, state),
+        rtol=1e-12,
+    )
+
+
+@pytest.mark.parametrize("state", [None, [0.1, 0.2, -0.3]])
+def test_exp_kernel_states_jit_matches_numpy(isivec, state):
+    pytest.importorskip("numba")
+    amps = np.array([0.5, -1.0, 2.0])
+    taus = np.array([15.0, 100.0, 650.0])
+
+    expected = _exp_kernel_states_numpy(
+        isivec, amps, taus, np.zeros(3) if state is None else np.array(state)
+    )
+    np.testing.assert_allclose(
+        exp_kernel_states(isivec, amps, taus, state), expected, rtol=1e-12
+    )
+
+
+@pytest.mark.parametrize("adapted", [False, True])
+def test_tm_isivec_jit_matches_numpy(isivec, adapted):
+    pytest.importorskip("numba")
+    args = (isivec, 0.2, 1.0, *TM_PARAMS.values(), adapted)
+
+    compiled = tm_isivec(*args)
+    python = _recurrences._tm_isivec.py_func(*args)
+    for a, b in zip(compiled, python):
+        np.testing.assert_allclose(a, b, rtol=1e-12)
+
+
+@pytest.mark.parametrize("adapted", [False, True])
+def test_tm_spiketrain_jit_matches_numpy(spiketrain, adapted):
+    pytest.importorskip("numba")
+    args = (spiketrain, 0.1, 0.2, 1.0, *TM_PARAMS.values(), adapted)
+
+    compiled = tm_spiketrain(*args)
+    python = _recurrences._tm_spiketrain.py_func(*args)
+    assert len(compiled[0]) == 40
+    for a, b in zip(compiled, python):
+        np.testing.assert_allclose(a, b, rtol=1e-12)
@@ -0,0 +1,151 @@
+"""
+Tests of the persistence formats: results tables, checkpoint journals, fit stores and caches
+"""
+
+import csv
+import os
+import numpy as np
+from scipy.optimize import OptimizeResult
+from srplasticity.store import Checkpoint, FitCache, FitStore, ResultsTable, fit_key
+from srplasticity.tools import failed_result
+
+
+def mixed_results():
+    return [
+        OptimizeResult(
+            x=np.array([1.0, 2.0]), fun=0.5, success=True, nit=3, nfev=7, message="ok"
+        ),
+        failed_result(np.array([0.0, 1.0]), "Traceback:\n  ValueError, with comma"),
+        failed_result(np.array([2.0, 3.0]), "Worker process 1 died", lost=True),
+        OptimizeResult(
+            x=np.array([4.0, 5.0]),
+            fun=1.5,
+            success=False,
+            message="Wall-clock budget of 1 s exceeded",
+            budget_exceeded=True,
+        ),
+    ]
+
+
+def test_results_table_round_trip(tmp_path):
+    results = mixed_results()
+    starts = np.array([[1.0, 1.0], [0.0, 1.0], [2.0, 3.0], [4.0, 4.0]])
+    table = ResultsTable.from_results(results, starts)
+
+    table.save(tmp_path / "table.npy")
+    loaded = ResultsTable.load(tmp_path / "table.npy")
+
+    for res, row in zip(results, loaded):
+        assert row["message"] == res["message"]
+        for flag in ("failed", "lost", "budget_exceeded"):
+            assert row[flag] == res.get(flag, False)
+        np.testing.assert_array_equal(row["x"], res["x"])
+        np.testing.assert_array_equal(row["fun"], res["fun"])
+
+    np.testing.assert_array_equal(loaded["failed"], [False, True, True, False])
+    np.testing.assert_array_equal(loaded["lost"], [False, False, True, False])
+    assert loaded[1]["success"] is False
+    assert loaded[1]["failed"] is True
+    assert len(list(loaded)) == 4
+
+
+def test_results_table_csv(tmp_path):
+    table = ResultsTable.from_results(mixed_results(), np.zeros((4, 2)))
+    table.to_csv(tmp_path / "table.csv")
+
+    with open(tmp_path / "table.csv", newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert len(rows) == 4
+    assert rows[1]["message"] == "Traceback:\n  ValueError, with comma"
+    assert rows[2]["lost"] == "1"
+    assert float(rows[0]["x_1"]) == 2.0
+
+
+def test_checkpoint(tmp_path):
+    checkpoint = Checkpoint(tmp_path / "journal")
+    first, second = checkpoint.scoped("a"), checkpoint.scoped("b")
+    first.save((1,), {"fun": 2.0})
+    first.save((2,), {"fun": 1.0})
+    second.save((1,), {"fun": 0.5})
+
+    assert first.load() == {(1,): {"fun": 2.0}, (2,): {"fun": 1.0}}
+    assert first.best() == {"fun": 1.0}
+    assert checkpoint.load() == {
+        ("a", 1): {"fun": 2.0},
+        ("a", 2): {"fun": 1.0},
+        ("b", 1): {"fun": 0.5},
+    }
+
+
+def test_checkpoint_discards_cut_off_record(tmp_path):
+    path = tmp_path / "journal"
+    Checkpoint(path).save((1,), {"fun": 1.0})
+    Checkpoint(path).save((2,), {"fun": 2.0})
+
+    # a crash while writing the last record
+    os.truncate(path, os.path.getsize(path) - 3)
+    assert Checkpoint(path).load() == {(1,): {"fun": 1.0}}
+
+
+def test_fit_store(tmp_path):
+    store = FitStore(tmp_path / "store")
+    for fold, offset in (("20hz", 0.0), ("50hz", 10.0)):
+        results = [
+            {"x": np.array([1.0, 2.0]), "fun": offset + 3.0, "success": True},
+            {"x": np.array([3.0]), "fun": offset + 1.0, "success": False},
+            {"x": np.array([5.0, 6.0, 7.0]), "fun": offset + 2.0, "success": True},
+        ]
+        store.append("cell1", "SRP", results, fold=fold, data={"20hz": np.ones(3)})
+    store.append("cell1", "TM", [{"x": np.zeros(4), "fun": 0.0}], fold="20hz")
+
+    table = store.select(model="SRP", fold="50hz")
+    np.testing.assert_array_equal(table["start"], [0, 1, 2])
+    np.testing.assert_array_equal(table["fun"], [13.0, 11.0, 12.0])
+    np.testing.assert_array_equal(table["x"][1], [3.0, np.nan, np.nan])
+    assert len(set(table["data_hash"])) == 1 and table["data_hash"][0]
+
+    best = store.best(by="fold", model="SRP")
+    np.testing.assert_array_equal(best["fold"], ["20hz", "50hz"])
+    np.testing.assert_array_equal(best["start"], [2, 2])
+    np.testing.assert_array_equal(best["x"][1], [5.0, 6.0, 7.0])
+
+    best = store.best(by="fold", model="SRP", successful=False)
+    np.testing.assert_array_equal(best["fun"], [1.0, 11.0])
+
+    assert len(store.index(model="TM")["row"]) == 1
+    assert len(store.index(model="GLM")["row"]) == 0
+
+
+def test_fit_cache(tmp_path):
+    cache = FitCache(tmp_path / "cache")
+    key = fit_key({"20hz": np.ones((2, 3))}, "L-BFGS-B", 1e-9)
+
+    assert cache.get(key) is None
+    cache.save(key, {"fun": 1.0})
+    assert cache.get(key) == {"fun": 1.0}
+
+    # other data, other inputs and other scopes miss the cache
+    assert cache.get(fit_key({"20hz": np.zeros((2, 3))}, "L-BFGS-B", 1e-9)) is None
+    assert cache.get(fit_key({"20hz": np.ones((2, 3))}, "L-BFGS-B", 1e-8)) is None
+    assert cache.scoped("start").get(key) is None
+
+    # incomplete files are discarded
+    file = cache._file(key)
+    file.write_bytes(file.read_bytes()[:5])
+    assert cache.get(key) is None
+    assert not file.exists()
+
+
+def test_fit_cache_evicts_least_recently_used(tmp_path):
+    cache = FitCache(tmp_path / "cache")
+    for n in range(4):
+        cache.save((n,), np.zeros(100))
+        # distinct modification times, oldest first
+        os.utime(cache._file((n,)), (n, n))
+    size = os.path.getsize(cache._file((0,)))
+
+    cache.get((0,))
+    cache.max_bytes = 2 * size
+    cache.evict()
+
+    assert [cache.get((n,)) is not None for n in range(4)] == [True, False, False, True]
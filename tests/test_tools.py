@@ -0,0 +1,53 @@
+"""
+Tests of the process pools: crashed workers are detected while other tasks run
+"""
+
+import os
+import time
+import pytest
+from srplasticity.tools import FitExecutor, SharedMemoryPool, WorkerLost
+
+
+def crash_second(x):
+    """ the first task runs long, the second kills its worker """
+    if x == 0:
+        time.sleep(4)
+        return time.monotonic()
+    if x == 1:
+        os._exit(1)
+    return x
+
+
+def lost(x, message):
+    return "lost", time.monotonic()
+
+
+def check_results(results):
+    # the lost task is reported in order, but long before the first task completes
+    assert results[1][0] == "lost"
+    assert results[1][1] < results[0] - 1
+    assert results[2:] == [2, 3, 4, 5]
+
+
+@pytest.fixture
+def pool():
+    with SharedMemoryPool(crash_second, workers=2) as pool:
+        yield pool
+
+
+def test_shared_memory_pool_detects_crash(pool):
+    check_results(list(pool.map(range(6), on_lost=lost)))
+
+    # the pool replaced the worker and is still usable
+    assert sorted(pool.map_unordered(range(2, 6))) == [2, 3, 4, 5]
+
+
+def test_shared_memory_pool_raises(pool):
+    with pytest.raises(WorkerLost, match="Task 1"):
+        list(pool.map(range(6)))
+
+
+def test_fit_executor_detects_crash():
+    with FitExecutor(workers=2, preload=()) as executor:
+        check_results(list(executor.map(crash_second, range(6), on_lost=lost)))
+        assert sorted(executor.map_unordered(crash_second, range(2, 6))) == [2, 3, 4, 5]